@@ -0,0 +1,260 @@
+__author__ = 'n3k'
+
+"""
+Concurrent front end for reading and extracting cabinets.
+
+Parsing, reads and decoding are blocking, so they run in a pool of threads and every
+call returns at once with a CabFuture. The cabinets are opened with positional_io, so
+the members of one cabinet are decoded at the same time, and a member is read in jobs
+of at most chunk_blocks CFDATA so a big file does not hold a thread for its whole length.
+"""
+
+import threading
+from multiprocessing import TimeoutError, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from pycab.CabReader import CabReader
+from pycab.CabExtractor import CabExtractor
+from pycab.CabWriter import CABException
+
+
+class CabFuture(object):
+    """
+    Usage:
+        future = pool.read_member(cab, "setup.exe")
+        future.add_done_callback(lambda f: ...)
+        data = future.result(timeout=10)
+    Handle of a job of a CabPool
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the job and returns its result, or raises its exception
+        Raises multiprocessing.TimeoutError when it is not done after timeout seconds
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError()
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        callback(future) is called in the thread that completes the job, or right
+        away when it is already done
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._set(result=result)
+
+    def set_exception(self, exception):
+        self._set(exception=exception)
+
+
+def _run(future, function, args):
+    try:
+        result = function(*args)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def _decode_slices(reader, slices):
+    return "".join([reader.decode_cfdata(cfdata)[start:end] for cfdata, start, end in slices])
+
+
+def as_completed(futures, timeout=None):
+    """
+    Yields the futures as they are done
+    Raises multiprocessing.TimeoutError when they are not all done after timeout seconds
+    """
+    done = []
+    condition = threading.Condition()
+
+    def notify(future):
+        with condition:
+            done.append(future)
+            condition.notify()
+
+    futures = list(futures)
+    for future in futures:
+        future.add_done_callback(notify)
+    for _ in range(len(futures)):
+        with condition:
+            if not done:
+                condition.wait(timeout)
+            if not done:
+                raise TimeoutError()
+            future = done.pop(0)
+        yield future
+
+
+class CabPool(object):
+    """
+    Usage:
+        with CabPool(workers=8) as pool:
+            cab = pool.open("setup_0.cab").result()
+            for future in as_completed([future for cffile, future in pool.read_members(cab)]):
+                data = future.result()
+    Runs the blocking work of the readers and extractors in a pool of threads
+    """
+
+    def __init__(self, workers=None, chunk_blocks=16, index_cache=None):
+        """
+        workers is the number of threads, the number of CPUs by default
+        chunk_blocks is the max number of CFDATA read and decoded per job
+        index_cache is an optional CabIndex for the cabinets opened by open()
+        """
+        self.workers = workers or cpu_count()
+        self.chunk_blocks = chunk_blocks
+        self.index_cache = index_cache
+        self._pool = ThreadPool(self.workers)
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        # The futures not done yet, close() waits for them before stopping the threads
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def _track(self, future):
+        with self._pending_lock:
+            self._pending.add(future)
+
+        def untrack(done):
+            with self._pending_lock:
+                self._pending.discard(done)
+
+        future.add_done_callback(untrack)
+        return future
+
+    def submit(self, function, *args):
+        """
+        Runs function(*args) in the pool
+        :return: a CabFuture with its result
+        """
+        future = self._track(CabFuture())
+        self._pool.apply_async(_run, (future, function, args))
+        return future
+
+    def _open(self, filename):
+        reader = CabReader(filename, index_cache=self.index_cache, load_data=False, positional_io=True)
+        with self._readers_lock:
+            self._readers.append(reader)
+        return reader
+
+    def open(self, filename):
+        """
+        Parses the tables of the cabinet in the pool, the future resolves to a CabReader
+        that reads the CFDATA on demand. It is closed with the pool.
+        """
+        return self.submit(self._open, filename)
+
+    def read_member(self, reader, name):
+        """
+        :return: a CabFuture with the data of the file called name
+        """
+        cffile = reader.get_cffile(name)
+        if cffile is None:
+            future = CabFuture()
+            future.set_exception(CABException("File %s not found in %s" % (name, reader.filename)))
+            return future
+        return self._read_cffile(reader, cffile)
+
+    def read_members(self, reader):
+        """
+        Starts reading every file whose data is entirely in the cabinet
+        :return: [(CFFILE, CabFuture with its data), ...] in folder order
+        """
+        return [(cffile, self._read_cffile(reader, cffile))
+                for cffolder in reader.cffolder_list
+                for cffile in sorted(cffolder.cffile_list, key=lambda x: x.uoffFolderStart)
+                if reader.is_member_local(cffile)]
+
+    def _read_cffile(self, reader, cffile):
+        future = self._track(CabFuture())
+        try:
+            slices = list(reader.get_member_slices(cffile))
+        except CABException as e:
+            future.set_exception(e)
+            return future
+        self._read_slices(future, reader, slices, [])
+        return future
+
+    def _read_slices(self, future, reader, slices, parts):
+        """
+        Schedules the CFDATA of a file one chunk at a time, the next chunk is queued
+        behind the jobs of the other files
+        """
+        if not slices:
+            future.set_result("".join(parts))
+            return
+
+        def done(job):
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+                return
+            parts.append(job.result())
+            self._read_slices(future, reader, slices[self.chunk_blocks:], parts)
+
+        self.submit(_decode_slices, reader, slices[:self.chunk_blocks]).add_done_callback(done)
+
+    def extract_to_directory(self, filename, output_directory, **kwargs):
+        """
+        Runs CabExtractor.extract_to_directory in the pool, the future resolves to the
+        paths written
+        """
+        return self.submit(lambda: CabExtractor().extract_to_directory(filename, output_directory, **kwargs))
+
+    def close(self):
+        """
+        Waits for the pending futures, stops the threads and closes the readers of open()
+        """
+        while True:
+            with self._pending_lock:
+                if not self._pending:
+                    break
+                future = next(iter(self._pending))
+            future.exception()
+        self._pool.close()
+        self._pool.join()
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
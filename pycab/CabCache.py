@@ -0,0 +1,117 @@
+__author__ = 'n3k'
+
+"""
+In-process cache of parsed cabinets and decoded CFDATA blocks.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from pycab.CabReader import CabReader
+from pycab.CabWriter import CABException
+
+
+class CabCache(object):
+    """
+    LRU cache bounded by bytes. It holds CabReader instances (accounted by the size of
+    the cabinet) and decoded CFDATA blocks (accounted by their uncompressed size).
+    Every entry of a cabinet is dropped as soon as its size or mtime changes on disk.
+    """
+
+    def __init__(self, max_bytes=64*1024*1024, index_cache=None):
+        """
+        index_cache is an optional CabIndex used when a cabinet has to be parsed
+        """
+        self.max_bytes = max_bytes
+        self.index_cache = index_cache
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (value, cost), the least recently used entries go first
+        self._entries = OrderedDict()
+        # path -> (size, mtime) of the cabinet when it was cached
+        self._stamps = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        try:
+            value, cost = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = (value, cost)
+        self.hits += 1
+        return value
+
+    def _put(self, key, value, cost):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if cost > self.max_bytes:
+            return
+        self._entries[key] = (value, cost)
+        self.size += cost
+        while self.size > self.max_bytes:
+            _, (_, evicted_cost) = self._entries.popitem(last=False)
+            self.size -= evicted_cost
+
+    def _check_stamp(self, path):
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime)
+        if self._stamps.get(path) != stamp:
+            self._invalidate(path)
+            self._stamps[path] = stamp
+
+    def _invalidate(self, path):
+        for key in [key for key in self._entries if key[1] == path]:
+            self.size -= self._entries.pop(key)[1]
+        self._stamps.pop(path, None)
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._invalidate(os.path.abspath(filename))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stamps.clear()
+            self.size = 0
+
+    def get_reader(self, filename):
+        """
+        Returns a CabReader for the cabinet, parsing it only if it isn't cached
+        """
+        path = os.path.abspath(filename)
+        with self._lock:
+            self._check_stamp(path)
+            reader = self._get(("reader", path))
+        if reader is None:
+            reader = CabReader(path, index_cache=self.index_cache)
+            with self._lock:
+                self._put(("reader", path), reader, reader.cfheader.cbCabinet)
+        return reader
+
+    def get_block(self, reader, cfdata):
+        """
+        Returns the uncompressed bytes of a CFDATA of the reader
+        """
+        key = ("block", os.path.abspath(reader.filename), cfdata.offset)
+        with self._lock:
+            data = self._get(key)
+        if data is None:
+            data = reader.decode_cfdata(cfdata)
+            with self._lock:
+                self._put(key, data, len(data))
+        return data
+
+    def read_member(self, filename, name):
+        """
+        Returns the data of the file called name inside the cabinet
+        """
+        reader = self.get_reader(filename)
+        cffile = reader.get_cffile(name)
+        if cffile is None:
+            raise CABException("File %s not found in %s" % (name, filename))
+        return "".join([self.get_block(reader, cfdata)[start:end]
+                        for cfdata, start, end in reader.get_member_slices(cffile)])
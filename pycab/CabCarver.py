@@ -0,0 +1,130 @@
+__author__ = 'n3k'
+
+"""
+This code finds cabinets embedded in bigger files (installers, MSI streams, firmware
+images, memory dumps...).
+"""
+
+import os
+import mmap
+import struct
+from multiprocessing import Pool
+
+from pycab.CabReader import CabReader
+from pycab.CabStructs import CFHEADER, CFFILE
+
+
+# signature, reserved1, cbCabinet, reserved2, coffFiles, reserved3, versionMinor, versionMajor,
+# cFolders, cFiles, flags, setID, iCabinet
+_fixed_header = struct.Struct("<4sIIIIIBBHHHHH")
+
+
+def _check_fixed_header(mm, offset, file_size):
+    """
+    Cheap checks over the fixed part of the CFHEADER, they discard most of the
+    "MSCF" that are not cabinets without parsing anything
+    """
+    if offset + _fixed_header.size > file_size:
+        return False
+    (signature, reserved1, cbCabinet, reserved2, coffFiles, reserved3, versionMinor, versionMajor,
+     cFolders, cFiles, flags, setID, iCabinet) = _fixed_header.unpack_from(mm, offset)
+    if versionMajor != 0x01 or versionMinor != 0x03:
+        return False
+    if flags & ~(CFHEADER.cfhdrPREV_CABINET | CFHEADER.cfhdrNEXT_CABINET | CFHEADER.cfhdrRESERVE_PRESENT):
+        return False
+    if cFolders == 0 or cFiles == 0:
+        return False
+    if cbCabinet > file_size - offset or coffFiles >= cbCabinet:
+        return False
+    if coffFiles < _fixed_header.size + 8 * cFolders:
+        return False
+    return True
+
+
+def _validate(filename, offset, file_size):
+    """
+    Parses the CFHEADER and the tables with the CabReader
+    :return: the cbCabinet of the cabinet or None if it is not valid
+    """
+    try:
+        cab = CabReader.probe(filename, tables=True, offset=offset)
+    except Exception:
+        return None
+    cfheader = cab.cfheader
+    if cfheader.cbCabinet > file_size - offset:
+        return None
+    for cffolder in cab.cffolder_list:
+        if not cfheader.coffFiles < cffolder.coffCabStart < cfheader.cbCabinet:
+            return None
+    for cffile in cab.cffile_list:
+        if cffile.iFolder >= cfheader.cFolders and cffile.iFolder not in CFFILE.get_iFolder_options():
+            return None
+    return cfheader.cbCabinet
+
+
+def _scan_region(args):
+    """
+    Returns the (offset, length) of the cabinets starting in [start, end) of the file
+    """
+    filename, start, end = args
+    result = []
+    with open(filename, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = mm.find("MSCF", start, min(end + 3, file_size))
+            while offset != -1:
+                if _check_fixed_header(mm, offset, file_size):
+                    length = _validate(filename, offset, file_size)
+                    if length is not None:
+                        result.append((offset, length))
+                offset = mm.find("MSCF", offset + 1, min(end + 3, file_size))
+        finally:
+            mm.close()
+    return result
+
+
+class CabCarver(object):
+    """
+    Usage:
+        for offset, length in CabCarver("firmware.bin", workers=4).find():
+            ...
+    The file is mapped with mmap and searched for the "MSCF" signature. Every candidate
+    is checked with the fixed fields of the CFHEADER and then parsed with the CabReader.
+    Big files are split in regions that are scanned by a pool of processes.
+    """
+
+    def __init__(self, filename, workers=1, region_size=64*1024*1024):
+        self.filename = filename
+        self.workers = workers
+        self.region_size = region_size
+
+    def _get_regions(self):
+        file_size = os.path.getsize(self.filename)
+        return [(self.filename, start, min(start + self.region_size, file_size))
+                for start in range(0, file_size, self.region_size)]
+
+    def find(self):
+        """
+        Yields (offset, length) of every embedded cabinet, ordered by offset
+        """
+        regions = self._get_regions()
+        if self.workers > 1 and len(regions) > 1:
+            pool = Pool(self.workers)
+            try:
+                for result in pool.imap(_scan_region, regions):
+                    for candidate in result:
+                        yield candidate
+            finally:
+                pool.terminate()
+        else:
+            for region in regions:
+                for candidate in _scan_region(region):
+                    yield candidate
+
+    def readers(self, load_data=False):
+        """
+        Yields a CabReader for every embedded cabinet
+        """
+        for offset, length in self.find():
+            yield CabReader(self.filename, load_data=load_data, offset=offset)
@@ -0,0 +1,180 @@
+__author__ = 'n3k'
+
+"""
+Searchable SQLite catalog of the CFFILE of many cabinets.
+"""
+
+import os
+import sqlite3
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from pycab.CabReader import CabReader
+from pycab.CabInventory import CabInventory
+
+
+class CabCatalog(object):
+    """
+    Usage:
+        catalog = CabCatalog("cabs.db", hashes=True)
+        catalog.update("/srv/cabs")
+        catalog.find(name="setup.inf")
+    Only the cabinets whose size or mtime changed since the last update are read again.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cabinets (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            setID INTEGER,
+            iCabinet INTEGER,
+            flags INTEGER,
+            error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            cabinet_id INTEGER NOT NULL REFERENCES cabinets(id),
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            date INTEGER,
+            time INTEGER,
+            attribs INTEGER,
+            iFolder INTEGER,
+            md5 TEXT
+        );
+        CREATE INDEX IF NOT EXISTS members_name ON members(name);
+        CREATE INDEX IF NOT EXISTS members_md5 ON members(md5);
+        CREATE INDEX IF NOT EXISTS members_cabinet ON members(cabinet_id);
+    """
+
+    def __init__(self, database, workers=4, hashes=False, batch_size=256, extensions=(".cab",)):
+        """
+        hashes=True stores the md5 of every file whose data is entirely in its cabinet,
+        which means reading the CFDATA and not only the tables
+        """
+        self.database = database
+        self.workers = workers
+        self.hashes = hashes
+        self.batch_size = batch_size
+        self.inventory = CabInventory(extensions=extensions)
+
+        self.connection = sqlite3.connect(database)
+        self.connection.text_factory = str
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _read_cabinet(self, args):
+        """
+        Runs in the thread pool, it returns what has to be stored for a cabinet
+        """
+        path, size, mtime = args
+        record = {"path": path, "size": size, "mtime": mtime, "members": []}
+        try:
+            if self.hashes:
+                cab = CabReader(path, load_data=False)
+            else:
+                cab = CabReader.probe(path, tables=True)
+        except Exception as e:
+            record["error"] = str(e)
+            return record
+
+        hashes = {}
+        if self.hashes:
+            for cffile, stream in cab.iter_members():
+                md5 = hashlib.md5()
+                chunk = stream.read(0x10000)
+                while chunk:
+                    md5.update(chunk)
+                    chunk = stream.read(0x10000)
+                hashes[id(cffile)] = md5.hexdigest()
+
+        record["setID"] = cab.cfheader.setID
+        record["iCabinet"] = cab.cfheader.iCabinet
+        record["flags"] = cab.cfheader.flags
+        record["members"] = [(cffile.szName[:-1], cffile.cbFile, cffile.date, cffile.time, cffile.attribs,
+                              cffile.iFolder, hashes.get(id(cffile))) for cffile in cab.cffile_list]
+        return record
+
+    def _get_changed(self, path):
+        """
+        Returns the (path, size, mtime) of the new or modified cabinets under path and
+        the ids of the cataloged cabinets under path that don't exist anymore
+        """
+        known = {}
+        prefix = os.path.join(os.path.abspath(path), "")
+        for cabinet_id, cabinet_path, size, mtime in self.connection.execute(
+                "SELECT id, path, size, mtime FROM cabinets WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)):
+            known[cabinet_path] = (cabinet_id, size, mtime)
+
+        changed = []
+        for filename in self.inventory.iter_files(path):
+            filename = os.path.abspath(filename)
+            st = os.stat(filename)
+            cabinet_id, size, mtime = known.pop(filename, (None, None, None))
+            if (size, mtime) != (st.st_size, st.st_mtime):
+                changed.append((filename, st.st_size, st.st_mtime))
+        return changed, [cabinet_id for cabinet_id, size, mtime in known.values()]
+
+    def _store(self, record):
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM members WHERE cabinet_id IN (SELECT id FROM cabinets WHERE path = ?)",
+                       (record["path"],))
+        cursor.execute("DELETE FROM cabinets WHERE path = ?", (record["path"],))
+        cursor.execute("INSERT INTO cabinets (path, size, mtime, setID, iCabinet, flags, error) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (record["path"], record["size"], record["mtime"], record.get("setID"),
+                        record.get("iCabinet"), record.get("flags"), record.get("error")))
+        cabinet_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO members (cabinet_id, name, size, date, time, attribs, iFolder, md5) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(cabinet_id,) + member for member in record["members"]])
+
+    def update(self, path):
+        """
+        Catalogs the new and modified cabinets under path and forgets the deleted ones
+        :return: the number of cabinets read
+        """
+        changed, deleted = self._get_changed(path)
+
+        with self.connection:
+            for cabinet_id in deleted:
+                self.connection.execute("DELETE FROM members WHERE cabinet_id = ?", (cabinet_id,))
+                self.connection.execute("DELETE FROM cabinets WHERE id = ?", (cabinet_id,))
+
+        pool = ThreadPool(self.workers)
+        try:
+            pending = 0
+            for record in pool.imap_unordered(self._read_cabinet, changed):
+                self._store(record)
+                pending += 1
+                if pending == self.batch_size:
+                    self.connection.commit()
+                    pending = 0
+            self.connection.commit()
+        finally:
+            pool.terminate()
+        return len(changed)
+
+    def find(self, name=None, md5=None, size=None):
+        """
+        Returns a list of dictionaries with the members that match every given criteria
+        and the cabinet that holds them
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("members.name", name), ("members.md5", md5), ("members.size", size)):
+            if value is not None:
+                conditions.append("%s = ?" % column)
+                parameters.append(value)
+
+        query = "SELECT cabinets.path, cabinets.setID, cabinets.iCabinet, members.name, members.size, " \
+                "members.date, members.time, members.attribs, members.iFolder, members.md5 " \
+                "FROM members JOIN cabinets ON cabinets.id = members.cabinet_id"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        columns = ["cabinet", "setID", "iCabinet", "name", "size", "date", "time", "attribs", "iFolder", "md5"]
+        return [dict(zip(columns, row)) for row in self.connection.execute(query, parameters)]
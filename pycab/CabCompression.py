@@ -0,0 +1,79 @@
+__author__ = 'n3k'
+
+"""
+Codecs for the data of the CFDATA blocks.
+"""
+
+import zlib
+import struct
+
+from pycab.CabStructs import CFFOLDER
+
+
+# Every MSZIP block starts with this signature
+MSZIP_SIGNATURE = "CK"
+# The back references of a MSZIP block can reach the last 32K of the previous blocks
+MSZIP_WINDOW = 0x8000
+
+
+def encode_none(data):
+    return data
+
+
+def encode_mszip(data, level=6):
+    """
+    Every block is a complete deflate stream that doesn't reference the previous ones,
+    so they can be encoded in parallel and a folder can be split anywhere
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return MSZIP_SIGNATURE + compressor.compress(data) + compressor.flush()
+
+
+class NoneDecoder(object):
+
+    def decode(self, ab):
+        return ab
+
+
+class MSZIPDecoder(object):
+    """
+    Decodes the CFDATA of a folder, which must be given in order because the
+    history of the previous blocks is carried over
+    """
+
+    def __init__(self):
+        self.window = ""
+
+    def decode(self, ab):
+        if ab[:2] != MSZIP_SIGNATURE:
+            raise zlib.error("The MSZIP signature is missing")
+        # The zlib of python 2 can't preset the dictionary of a raw deflate stream,
+        # so the window goes in front of the data as a stored block
+        prefix = "\x00" + struct.pack("<HH", len(self.window), len(self.window) ^ 0xFFFF) + self.window
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(prefix + ab[2:])[len(self.window):]
+        self.window = (self.window + data)[-MSZIP_WINDOW:]
+        return data
+
+
+def get_encoder(compression):
+    """
+    Returns a function that encodes the data of one CFDATA, None if the type is not supported
+    """
+    compression &= CFFOLDER.tcompMASK_TYPE
+    if compression == CFFOLDER.tcompTYPE_NONE:
+        return encode_none
+    if compression == CFFOLDER.tcompTYPE_MSZIP:
+        return encode_mszip
+    return None
+
+
+def get_decoder(compression):
+    """
+    Returns a new decoder for the CFDATA of one folder, None if the type is not supported
+    """
+    compression &= CFFOLDER.tcompMASK_TYPE
+    if compression == CFFOLDER.tcompTYPE_NONE:
+        return NoneDecoder()
+    if compression == CFFOLDER.tcompTYPE_MSZIP:
+        return MSZIPDecoder()
+    return None
@@ -0,0 +1,147 @@
+__author__ = 'n3k'
+
+"""
+Conversion of cabinets and sets to tar and zip archives, the files go from the CFDATA
+straight into the archive without being extracted.
+"""
+
+import time
+import zlib
+import tarfile
+import zipfile
+
+from pycab.CabReader import CabReader
+from pycab.CabStructs import CFFILE
+from pycab.CabTranscoder import FolderReader, MemberSource
+
+
+class CabConverter(object):
+    """
+    Usage:
+        CabConverter(workers=4).to_tar(["in_0.cab", "in_1.cab"], sys.stdout, mode="w|gz")
+        CabConverter().to_zip("in.cab", "out.zip")
+    Only buffer_blocks uncompressed CFDATA per folder are kept in memory. With workers > 1
+    the next folders are decoded by threads while the current one is written.
+    """
+
+    def __init__(self, workers=1, buffer_blocks=32):
+        self.workers = workers
+        self.buffer_blocks = buffer_blocks
+
+    def iter_members(self, filenames):
+        """
+        Yields (CFFILE, stream) of every file of the cabinet or set, the stream must be
+        read before asking for the next one
+        """
+        if isinstance(filenames, basestring):
+            filenames = [filenames]
+        readers = [CabReader(filename, load_data=False) for filename in filenames]
+        folder_reader = FolderReader(CabReader.get_set_folders(readers), workers=self.workers,
+                                     buffer_blocks=self.buffer_blocks)
+        try:
+            for folder_index, (blocks, cffile_list) in enumerate(folder_reader.folders):
+                for cffile in sorted(cffile_list, key=lambda x: x.uoffFolderStart):
+                    yield cffile, MemberSource(folder_reader, folder_index, cffile)
+        finally:
+            folder_reader.stop()
+
+    def _get_name(self, cffile):
+        name = cffile.szName[:-1].replace("\\", "/")
+        if cffile.attribs & CFFILE._A_NAME_IS_UTF:
+            name = name.decode("utf-8")
+        return name
+
+    def _get_mode(self, cffile):
+        mode = 0444 if cffile.attribs & CFFILE._A_RDONLY else 0644
+        if cffile.attribs & CFFILE._A_EXEC:
+            mode |= 0111
+        return mode
+
+    def _get_date_time(self, cffile):
+        date_time = cffile.get_date_time()
+        if not (1 <= date_time[1] <= 12 and 1 <= date_time[2] <= 31):
+            return 1980, 1, 1, 0, 0, 0
+        return date_time
+
+    def to_tar(self, filenames, output, mode="w|"):
+        """
+        output is a filename or a file object, mode is the one of tarfile.open and the
+        stream modes ("w|", "w|gz", "w|bz2") work with non seekable outputs
+        """
+        if isinstance(output, basestring):
+            tar_file = tarfile.open(name=output, mode=mode)
+        else:
+            tar_file = tarfile.open(fileobj=output, mode=mode)
+        try:
+            for cffile, stream in self.iter_members(filenames):
+                name = self._get_name(cffile)
+                tar_info = tarfile.TarInfo(name=name.encode("utf-8") if isinstance(name, unicode) else name)
+                tar_info.size = cffile.cbFile
+                tar_info.mode = self._get_mode(cffile)
+                # The date and time of a CFFILE are local
+                tar_info.mtime = int(time.mktime(self._get_date_time(cffile) + (0, 0, -1)))
+                tar_file.addfile(tar_info, stream)
+        finally:
+            tar_file.close()
+
+    def _write_zip_member(self, zip_file, zip_info, stream):
+        """
+        The same as ZipFile.write but with the data from stream, zipfile of python 2
+        can only write a member from memory or from a file on disk
+        """
+        # This is ZipFile.write of python 2.7 with the reads of the file replaced, it relies
+        # on the private _writecheck, _didModify, _allowZip64 and on the fp, filelist and
+        # NameToInfo bookkeeping of that version: the local header is written first and
+        # again with the CRC and the sizes once the data is in
+        zip_info.flag_bits = 0x00
+        zip_info.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(zip_info)
+        zip_file._didModify = True
+        zip_info.CRC = crc = 0
+        zip_info.compress_size = compress_size = 0
+        zip64 = zip_file._allowZip64 and zip_info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zip_file.fp.write(zip_info.FileHeader(zip64))
+
+        if zip_info.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            compressor = None
+        file_size = 0
+        chunk = stream.read(0x10000)
+        while chunk:
+            file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc) & 0xffffffff
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                compress_size += len(chunk)
+            zip_file.fp.write(chunk)
+            chunk = stream.read(0x10000)
+        if compressor is not None:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            zip_file.fp.write(chunk)
+            zip_info.compress_size = compress_size
+        else:
+            zip_info.compress_size = file_size
+        zip_info.CRC = crc
+        zip_info.file_size = file_size
+
+        # The header goes again with the CRC and the sizes
+        position = zip_file.fp.tell()
+        zip_file.fp.seek(zip_info.header_offset, 0)
+        zip_file.fp.write(zip_info.FileHeader(zip64))
+        zip_file.fp.seek(position, 0)
+        zip_file.filelist.append(zip_info)
+        zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def to_zip(self, filenames, output, compression=zipfile.ZIP_DEFLATED):
+        """
+        output is a filename or a seekable file object
+        """
+        with zipfile.ZipFile(output, "w", compression, allowZip64=True) as zip_file:
+            for cffile, stream in self.iter_members(filenames):
+                zip_info = zipfile.ZipInfo(filename=self._get_name(cffile), date_time=self._get_date_time(cffile))
+                zip_info.compress_type = compression
+                zip_info.file_size = cffile.cbFile
+                zip_info.external_attr = (0100000 | self._get_mode(cffile)) << 16 | (cffile.attribs & 0x27)
+                self._write_zip_member(zip_file, zip_info, stream)
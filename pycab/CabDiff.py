@@ -0,0 +1,228 @@
+__author__ = 'n3k'
+
+"""
+Differences between two cabinets or two sets of cabinets without extracting them.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+from pycab.CabReader import CabReader
+from pycab.CabWriter import CABException
+from pycab.CabStructs import CFFOLDER
+from pycab.CabCompression import get_decoder
+
+
+class CabDiff(object):
+    """
+    Usage:
+        result = CabDiff().diff(["old_0.cab", "old_1.cab"], ["new_0.cab", "new_1.cab"])
+    The CFFILE tables are compared first. The contents of the files present in both
+    sides with the same size are compared by the CFDATA that hold them: when both
+    files are laid out on the same block ranges and the compressed bytes of the blocks
+    are equal, nothing is decompressed. A compressed block decodes with the history of
+    the previous blocks of its folder, so those have to be equal too. Only the files
+    whose blocks differ are decoded and hashed.
+    """
+
+    METADATA = ("cbFile", "date", "time", "attribs")
+
+    def __init__(self, contents=True, trust_checksums=False):
+        """
+        contents=False only compares the CFFILE tables
+        Two CFDATA with different csum are different without reading them, otherwise the
+        md5 of their compressed bytes is compared. The csum is a XOR of DWORDs that misses
+        reordered data, trust_checksums=True takes an equal non zero csum as equal anyway.
+        """
+        self.contents = contents
+        self.trust_checksums = trust_checksums
+        self.hashed_blocks = 0
+        self.decoded_blocks = 0
+
+        self._handles = {}
+        self._block_hashes = {}
+        # id(folder blocks) -> (index of the next block, decoder) of the folders being decoded
+        self._decoders = {}
+        # (id(folder blocks), id(folder blocks)) -> (blocks compared, blocks equal from the start)
+        self._common_blocks = {}
+
+    def _get_members(self, filenames):
+        """
+        Returns {name: (CFFILE, blocks)} of the files of the set, where blocks is the list
+        of (pieces, cbUncomp) of CabReader.get_folder_blocks for the folder holding the file.
+        A folder continued in the next cabinet has the blocks of both cabinets.
+        """
+        if isinstance(filenames, basestring):
+            filenames = [filenames]
+        members = OrderedDict()
+        readers = [CabReader(filename, load_data=False) for filename in filenames]
+        for blocks, cffile_list in CabReader.get_set_folders(readers):
+            folder_blocks = CabReader.get_folder_blocks(blocks)
+            for cffile in cffile_list:
+                name = cffile.szName[:-1]
+                if name not in members:
+                    members[name] = (cffile, folder_blocks)
+        return members
+
+    def _get_slices(self, cffile, blocks):
+        """
+        Returns the list of (index of the block, pieces, start, end) holding the data of the file
+        """
+        result = []
+        file_start = cffile.uoffFolderStart
+        file_end = file_start + cffile.cbFile
+        data_start = 0
+        for index, (pieces, cbUncomp) in enumerate(blocks):
+            data_end = data_start + cbUncomp
+            if data_end > file_start and data_start < file_end:
+                result.append((index, pieces, max(file_start, data_start) - data_start,
+                               min(file_end, data_end) - data_start))
+            if data_end >= file_end:
+                break
+            data_start = data_end
+        return result
+
+    def _get_handle(self, reader):
+        if reader.filename not in self._handles:
+            self._handles[reader.filename] = open(reader.filename, "rb")
+        return self._handles[reader.filename]
+
+    def _get_payload(self, pieces):
+        """
+        The compressed bytes of a block, joined when it is split between two cabinets
+        """
+        parts = []
+        for reader, cfdata in pieces:
+            handle = self._get_handle(reader)
+            handle.seek(cfdata.get_data_offset())
+            parts.append(handle.read(cfdata.cbData))
+        return "".join(parts)
+
+    def _get_block_hash(self, pieces):
+        """
+        md5 of the compressed bytes of a block, every block is read once per diff
+        """
+        key = (pieces[0][0].filename, pieces[0][1].offset)
+        if key not in self._block_hashes:
+            self._block_hashes[key] = hashlib.md5(self._get_payload(pieces)).digest()
+            self.hashed_blocks += 1
+        return self._block_hashes[key]
+
+    def _same_block(self, slice_a, slice_b):
+        index_a, pieces_a, start_a, end_a = slice_a
+        index_b, pieces_b, start_b, end_b = slice_b
+        if (start_a, end_a) != (start_b, end_b):
+            return False
+        return self._same_payload(pieces_a, pieces_b)
+
+    def _same_payload(self, pieces_a, pieces_b):
+        if [cfdata.cbData for reader, cfdata in pieces_a] != [cfdata.cbData for reader, cfdata in pieces_b]:
+            return False
+        cfdata_a = pieces_a[-1][1]
+        cfdata_b = pieces_b[-1][1]
+        if (cfdata_a.cbUncomp, cfdata_a.cffolder.typeCompress) != (cfdata_b.cbUncomp, cfdata_b.cffolder.typeCompress):
+            return False
+        if len(pieces_a) == 1 and cfdata_a.csum != 0 and cfdata_b.csum != 0 and cfdata_a.abReserve == cfdata_b.abReserve:
+            if cfdata_a.csum != cfdata_b.csum:
+                return False
+            if self.trust_checksums:
+                return True
+        return self._get_block_hash(pieces_a) == self._get_block_hash(pieces_b)
+
+    def _get_common_blocks(self, blocks_a, blocks_b, count):
+        """
+        How many of the first count blocks of the two folders are equal from the start,
+        what was compared for a previous file of the folders is not read again
+        """
+        key = (id(blocks_a), id(blocks_b))
+        compared, common = self._common_blocks.get(key, (0, 0))
+        while compared < count and common == compared and compared < min(len(blocks_a), len(blocks_b)):
+            if (blocks_a[compared][1] == blocks_b[compared][1] and
+                    self._same_payload(blocks_a[compared][0], blocks_b[compared][0])):
+                common += 1
+            compared += 1
+        self._common_blocks[key] = (compared, common)
+        return common
+
+    def _decode_block(self, blocks, index):
+        """
+        Returns the uncompressed data of the block index of the folder. The history of a
+        MSZIP folder can span the cabinets of a set, so its blocks are decoded in order
+        and going back to a previous block decodes the folder from the start again.
+        """
+        pieces = blocks[index][0]
+        typeCompress = pieces[0][1].cffolder.typeCompress
+        self.decoded_blocks += 1
+        if typeCompress & CFFOLDER.tcompMASK_TYPE == CFFOLDER.tcompTYPE_NONE:
+            return self._get_payload(pieces)
+        next_index, decoder = self._decoders.get(id(blocks), (0, None))
+        if decoder is None or index < next_index:
+            decoder = get_decoder(typeCompress)
+            if decoder is None:
+                raise CABException("Compression type %04x is not supported" % typeCompress)
+            next_index = 0
+        for i in range(next_index, index):
+            decoder.decode(self._get_payload(blocks[i][0]))
+            self.decoded_blocks += 1
+        data = decoder.decode(self._get_payload(pieces))
+        self._decoders[id(blocks)] = (index + 1, decoder)
+        return data
+
+    def _get_contents_hash(self, blocks, slices):
+        md5 = hashlib.md5()
+        for index, pieces, start, end in slices:
+            md5.update(self._decode_block(blocks, index)[start:end])
+        return md5.digest()
+
+    def _same_contents(self, member_a, member_b):
+        slices_a = self._get_slices(*member_a)
+        slices_b = self._get_slices(*member_b)
+        if len(slices_a) == len(slices_b) and \
+                all([self._same_block(slice_a, slice_b) for slice_a, slice_b in zip(slices_a, slices_b)]):
+            typeCompress = slices_a[0][1][0][1].cffolder.typeCompress if slices_a else CFFOLDER.tcompTYPE_NONE
+            if typeCompress & CFFOLDER.tcompMASK_TYPE == CFFOLDER.tcompTYPE_NONE:
+                return True
+            # The blocks before the file are its history
+            first = slices_a[0][0]
+            if slices_b[0][0] == first and self._get_common_blocks(member_a[1], member_b[1], first) == first:
+                return True
+        return self._get_contents_hash(member_a[1], slices_a) == self._get_contents_hash(member_b[1], slices_b)
+
+    def diff(self, old, new):
+        """
+        old and new are the filename of a cabinet or the list of filenames of a set
+        :return: {"added": [names], "removed": [names], "metadata": {name: [fields]},
+                  "contents": [names whose data differ]}
+        """
+        self.hashed_blocks = 0
+        self.decoded_blocks = 0
+        old_members = self._get_members(old)
+        new_members = self._get_members(new)
+
+        result = {
+            "added": [name for name in new_members if name not in old_members],
+            "removed": [name for name in old_members if name not in new_members],
+            "metadata": {},
+            "contents": []
+        }
+        try:
+            for name, old_member in old_members.items():
+                if name not in new_members:
+                    continue
+                new_member = new_members[name]
+                fields = [field for field in self.METADATA
+                          if getattr(old_member[0], field) != getattr(new_member[0], field)]
+                if fields:
+                    result["metadata"][name] = fields
+                if not self.contents:
+                    continue
+                if old_member[0].cbFile != new_member[0].cbFile or not self._same_contents(old_member, new_member):
+                    result["contents"].append(name)
+        finally:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = {}
+            self._block_hashes = {}
+            self._decoders = {}
+            self._common_blocks = {}
+        return result
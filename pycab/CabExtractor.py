@@ -3,11 +3,121 @@ __author__ = 'n3k'
 from abc import ABCMeta, abstractmethod
 import os
 import hashlib
+import fnmatch
+from multiprocessing import Pool
 
 from Utils import Utils
 from CabReader import CabReader
 from CabWriter import CABException, CABFolderUnit
-from pycab.CabStructs import CFHEADER, CFFILE, CFDATA
+from pycab.CabStructs import CFHEADER, CFFOLDER
+from pycab.CabCompression import get_decoder
+
+
+def _extract_folder(args):
+    """
+    Decodes one folder, whose CFDATA can be in several cabinets of a set, and writes
+    the data of its files at their place in the output files, which already exist
+    with their final size. Only the offsets of the CFDATA travel to the worker and
+    nothing comes back. The CFDATA of a folder without compression that no file
+    needs are not read.
+    :return: the number of CFDATA read
+    """
+    typeCompress, blocks, targets = args
+    if not blocks or not targets:
+        return 0
+    decoder = get_decoder(typeCompress)
+    if decoder is None:
+        raise CABException("Compression type %04x is not supported" % typeCompress)
+    stored = typeCompress & CFFOLDER.tcompMASK_TYPE == CFFOLDER.tcompTYPE_NONE
+
+    handles = {}
+    outputs = {}
+    read_blocks = 0
+    try:
+        # blocks are (pieces, cbUncomp) like the ones of CabReader.get_folder_blocks, with
+        # (filename, offset of the payload, cbData) pieces. targets are (uoffFolderStart,
+        # cbFile, path) sorted by uoffFolderStart, the ones before first are already complete
+        first = 0
+        position = 0
+        for pieces, cbUncomp in blocks:
+            if stored:
+                end = position + cbUncomp
+                index = first
+                while index < len(targets) and targets[index][0] < end and \
+                        targets[index][0] + targets[index][1] <= position:
+                    index += 1
+                if index == len(targets) or targets[index][0] >= end:
+                    position = end
+                    continue
+
+            parts = []
+            for filename, offset, cbData in pieces:
+                if filename not in handles:
+                    handles[filename] = open(filename, "rb")
+                handles[filename].seek(offset)
+                parts.append(handles[filename].read(cbData))
+                read_blocks += 1
+            data = decoder.decode("".join(parts))
+            end = position + len(data)
+
+            index = first
+            while index < len(targets) and targets[index][0] < end:
+                start, size, path = targets[index]
+                index += 1
+                if start + size <= position:
+                    continue
+                if path not in outputs:
+                    outputs[path] = open(path, "r+b")
+                outputs[path].seek(max(start, position) - start)
+                outputs[path].write(data[max(start, position) - position:min(start + size, end) - position])
+            while first < len(targets) and targets[first][0] + targets[first][1] <= end:
+                output = outputs.pop(targets[first][2], None)
+                if output is not None:
+                    output.close()
+                first += 1
+            position = end
+            if first == len(targets):
+                break
+    finally:
+        for handle in handles.values() + outputs.values():
+            handle.close()
+    return read_blocks
+
+
+class MemberFilter(object):
+    """
+    Usage:
+        MemberFilter(include=["*.inf", "*.cat", "*.sys"], exclude=[re.compile(r"^old\\\\")])
+        MemberFilter(predicate=lambda cffile: cffile.cbFile < 0x100000)
+    A file is wanted when it matches any include (or there are none), no exclude and
+    the predicate. The patterns are globs, matched without case against the whole
+    name with its \\ separators, or compiled regular expressions.
+    """
+
+    def __init__(self, include=None, exclude=None, predicate=None):
+        self.include = self._get_patterns(include)
+        self.exclude = self._get_patterns(exclude)
+        self.predicate = predicate
+
+    def _get_patterns(self, patterns):
+        if patterns is None:
+            return []
+        if isinstance(patterns, basestring) or hasattr(patterns, "search"):
+            return [patterns]
+        return list(patterns)
+
+    def _match_pattern(self, pattern, name):
+        if hasattr(pattern, "search"):
+            return pattern.search(name) is not None
+        return fnmatch.fnmatchcase(name.lower(), pattern.lower())
+
+    def match(self, cffile):
+        name = cffile.szName[:-1] if cffile.szName.endswith("\x00") else cffile.szName
+        if self.include and not any([self._match_pattern(pattern, name) for pattern in self.include]):
+            return False
+        if any([self._match_pattern(pattern, name) for pattern in self.exclude]):
+            return False
+        return self.predicate is None or bool(self.predicate(cffile))
 
 
 class Extraction(object):
@@ -51,7 +161,7 @@ class SimpleExtraction(Extraction):
             while file_data_len < cffile.cbFile:
                 current_cfdata = cab.cfdata_list[curr_index_data]
                 file_data_len += current_cfdata.cbUncomp
-                file_data += current_cfdata.ab
+                file_data += cab.decode_cfdata(current_cfdata)
                 curr_index_data += 1
             folder_unit.filedata_list.append(file_data)
 
@@ -65,8 +175,14 @@ class SetExtraction(Extraction):
     def __init__(self, extractor):
         super(SetExtraction, self).__init__(extractor)
         self.cab_list = []
-        self.curr_index_data = 0
-        self.file_data_len = 0
+        # The blocks of the folder being read, see CabReader.get_folder_blocks
+        self.folder_blocks = []
+        self.decoder = None
+        # The cursor: the index of the last decoded block of the folder, where it starts
+        # in the folder and its uncompressed data
+        self.curr_index_data = -1
+        self.curr_offset_in_data = 0
+        self.curr_data = ""
         self.current_folder_unit = None
 
     def _get_next_cab_in_set(self, current_cab):
@@ -85,36 +201,53 @@ class SetExtraction(Extraction):
             self.cab_list.append(cab)
             cab = self._get_next_cab_in_set(cab)
 
-    def _check_scattered_file(self, cffile):
-        result = cffile.iFolder & CFFILE.ifoldCONTINUED_FROM_PREV == CFFILE.ifoldCONTINUED_FROM_PREV
-        result |= cffile.iFolder & CFFILE.ifoldCONTINUED_TO_NEXT == CFFILE.ifoldCONTINUED_TO_NEXT
-        return result
-
-    def _read_data_primitive(self, current_cab, cffile):
-        file_data = ""
-        file_data_len = self.file_data_len
-        while file_data_len < cffile.cbFile and self.curr_index_data < len(current_cab.cfdata_list):
-            current_cfdata = current_cab.cfdata_list[self.curr_index_data]
-            file_data_len += current_cfdata.cbUncomp
-            file_data += current_cfdata.ab
-            self.curr_index_data += 1
-        self.file_data_len = file_data_len
-        if self.file_data_len > cffile.cbFile:
-            # The CAB compressor of windows does a nasty thing...
-            # It allows to share a CFDATA between TWO CFFILES
-            # We need to adjust the data if this is the case
-            difference = self.file_data_len - cffile.cbFile
-            real_file_data = file_data[0:(self.file_data_len-difference)]
-            # We will create an anonymous CFDATA and add it to the list ..
-            # This way the remaining bytes that belongs to the next CFFILE will be read transparently
-            new_cfdata = CFDATA()
-            new_cfdata.ab = file_data[(self.file_data_len-difference):self.file_data_len]
-            new_cfdata.cbUncomp = len(new_cfdata.ab)
-            new_cfdata.cbData = len(new_cfdata.ab)
-            current_cab.cfdata_list.insert(self.curr_index_data, new_cfdata)
-            return real_file_data
-        return file_data
-
+    def _start_folder(self, blocks):
+        self.folder_blocks = CabReader.get_folder_blocks(blocks)
+        self.decoder = None
+        self.curr_index_data = -1
+        self.curr_offset_in_data = 0
+        self.curr_data = ""
+
+    def _decode_next_block(self):
+        pieces, cbUncomp = self.folder_blocks[self.curr_index_data + 1]
+        if self.decoder is None:
+            typeCompress = pieces[0][1].cffolder.typeCompress
+            self.decoder = get_decoder(typeCompress)
+            if self.decoder is None:
+                raise CABException("Compression type %04x is not supported" % typeCompress)
+        data = self.decoder.decode("".join([cfdata.ab for reader, cfdata in pieces]))
+        self.curr_index_data += 1
+        self.curr_offset_in_data += len(self.curr_data)
+        self.curr_data = data
+
+    def _read_data_primitive(self, cffile):
+        """
+        Reads the data of cffile from uoffFolderStart on. The cursor only moves forward
+        and keeps the last decoded block, so the CFFILEs that share a CFDATA (the CAB
+        compressor of windows does that) decode it once when they are read in the order
+        of their uoffFolderStart.
+        """
+        start = cffile.uoffFolderStart
+        end = start + cffile.cbFile
+        if start < self.curr_offset_in_data:
+            # It starts in a block already left behind, the folder is decoded again
+            self.decoder = None
+            self.curr_index_data = -1
+            self.curr_offset_in_data = 0
+            self.curr_data = ""
+
+        parts = []
+        position = start
+        while position < end:
+            if position >= self.curr_offset_in_data + len(self.curr_data):
+                if self.curr_index_data + 1 >= len(self.folder_blocks):
+                    raise CABException("The CFDATA of the folder end before the data of %s" % cffile.szName[:-1])
+                self._decode_next_block()
+                continue
+            chunk = self.curr_data[position - self.curr_offset_in_data:end - self.curr_offset_in_data]
+            parts.append(chunk)
+            position += len(chunk)
+        return "".join(parts)
 
     def extract(self, cab):
         """
@@ -124,39 +257,21 @@ class SetExtraction(Extraction):
         self._read_set(cab)
 
         result = []
-        scattered_folders = []
-        self.file_data_len = 0
         self.current_folder_unit = CABFolderUnit(name=self._get_folder_name())
 
+        # The files of every folder, which can span several cabs, are read in the order of
+        # their data, then listed in the order of the CFFILE tables
+        file_data = {}
+        for blocks, cffile_list in CabReader.get_set_folders(self.cab_list):
+            self._start_folder(blocks)
+            for cffile in sorted(cffile_list, key=lambda x: x.uoffFolderStart):
+                file_data[id(cffile)] = self._read_data_primitive(cffile)
+
         for current_cab in self.cab_list:
-            self.curr_index_data = 0
-
-            for file_index, cffile in enumerate(current_cab.cffile_list):
-                if self._check_scattered_file(cffile):
-                    # Work on scattered file
-                    if cffile.iFolder & CFFILE.ifoldCONTINUED_FROM_PREV == CFFILE.ifoldCONTINUED_FROM_PREV:
-                        # We know we should already have a scattered folder_unit
-                        # This is so because only the first CFFILE can be scattered from a PREV
-                        file_data = self._read_data_primitive(current_cab, cffile)
-                        # Append data to the last filedata
-                        self.current_folder_unit.filedata_list[-1] += file_data
-
-                    if cffile.iFolder & CFFILE.ifoldCONTINUED_TO_NEXT == CFFILE.ifoldCONTINUED_TO_NEXT:
-                        # We know we must mark the current folder_unit as a scattered one
-                        # scattered_folders.append(self.current_folder_unit)
-                        if self.curr_index_data < len(current_cab.cfdata_list):
-                            # Here we're facing a new scattered CAB
-                            self.current_folder_unit.filename_list.append(cffile.szName)
-                            file_data = self._read_data_primitive(current_cab, cffile)
-                            self.current_folder_unit.filedata_list.append(file_data)
-                else:
-                    # This are cffiles that end in the same .cab file
+            for cffile in current_cab.cffile_list:
+                if id(cffile) in file_data:
                     self.current_folder_unit.filename_list.append(cffile.szName)
-                    file_data = self._read_data_primitive(current_cab, cffile)
-                    self.current_folder_unit.filedata_list.append(file_data)
-
-                if self.file_data_len >= cffile.cbFile:
-                    self.file_data_len = 0
+                    self.current_folder_unit.filedata_list.append(file_data[id(cffile)])
 
         result.append(self.current_folder_unit)
         return result
@@ -168,8 +283,13 @@ class CabExtractor(object):
     and save it to an output directory
     """
 
-    def __init__(self, force_extraction=False):
+    def __init__(self, force_extraction=False, workers=1):
+        """
+        workers is the number of processes of extract_to_directory
+        """
         self.force_extraction = force_extraction
+        self.workers = workers
+        self.read_blocks = 0
         self.output_directory = r"./Testing/TestsFiles/extraction/"
         self.cab_dirname = ""
         self.folder_unit_list = []
@@ -201,6 +321,86 @@ class CabExtractor(object):
         return self.folder_unit_list
 
 
+    def _get_set_filenames(self, filename):
+        """
+        Returns the filenames of the cabinet and of the ones that follow it in its set
+        """
+        cab = CabReader.probe(filename)
+        if not self.__check_cab_is_first_in_set(cab):
+            raise CABException("The cab file is not the first in the set")
+        filenames = [filename]
+        while self.__check_more_cabs_remain(cab):
+            filenames.append(os.path.join(self.cab_dirname, cab.cfheader.szCabinetNext[:-1]))
+            if not os.path.isfile(filenames[-1]):
+                raise CABException("The cab file %s of the set is missing" % filenames[-1])
+            cab = CabReader.probe(filenames[-1])
+        return filenames
+
+    def _get_output_path(self, output_directory, cffile):
+        path = os.path.normpath(os.path.join(output_directory, *cffile.szName[:-1].split("\\")))
+        if not path.startswith(os.path.normpath(output_directory) + os.sep):
+            raise CABException("The file %s would be written out of the output directory" % cffile.szName[:-1])
+        return path
+
+    def extract_to_directory(self, filename, output_directory=None, include=None, exclude=None, predicate=None):
+        """
+        Writes the files of the cabinet, or of the set it starts, in output_directory keeping
+        their paths. The output files are created with their size first, then every folder is
+        decoded by a worker process that writes the data straight into them.
+        include, exclude and predicate select the files like a MemberFilter. They are checked
+        against the CFFILE tables, so the CFDATA of the folders without wanted files are never
+        read, not even their headers.
+        read_blocks counts the CFDATA that were read.
+        :return: the paths written, in the order of the folders
+        """
+        member_filter = MemberFilter(include=include, exclude=exclude, predicate=predicate)
+        self.cab_dirname = os.path.dirname(filename) if os.path.dirname(filename) != "" else "."
+        self.read_blocks = 0
+        output_directory = output_directory or self.output_directory
+        readers = [CabReader.probe(name, tables=True) for name in self._get_set_filenames(filename)]
+
+        tasks = []
+        paths = []
+        seen = set()
+        for parts, cffile_list in CabReader.get_set_folder_parts(readers):
+            targets = []
+            for cffile in cffile_list:
+                if not member_filter.match(cffile):
+                    continue
+                path = self._get_output_path(output_directory, cffile)
+                # The first file with a name wins, like when extracting one by one
+                if path in seen:
+                    continue
+                seen.add(path)
+                paths.append(path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "wb") as f:
+                    f.truncate(cffile.cbFile)
+                if cffile.cbFile:
+                    targets.append((cffile.uoffFolderStart, cffile.cbFile, path))
+            # The empty files are already complete, a folder without other files isn't read
+            if not targets:
+                continue
+            blocks = [(reader, cfdata) for reader, cffolder in parts
+                      for cfdata in reader.read_folder_cfdata(cffolder)]
+            if blocks:
+                folder_blocks = [([(reader.filename, cfdata.get_data_offset(), cfdata.cbData)
+                                   for reader, cfdata in pieces], cbUncomp)
+                                 for pieces, cbUncomp in CabReader.get_folder_blocks(blocks)]
+                tasks.append((blocks[0][1].cffolder.typeCompress, folder_blocks, sorted(targets)))
+
+        if self.workers > 1 and len(tasks) > 1:
+            pool = Pool(min(self.workers, len(tasks)))
+            try:
+                self.read_blocks = sum(pool.map(_extract_folder, tasks))
+            finally:
+                pool.terminate()
+        else:
+            for task in tasks:
+                self.read_blocks += _extract_folder(task)
+        return paths
+
     def _make_sure_path_exists(self):
         if os.path.isdir(self.output_directory):
             return
@@ -0,0 +1,294 @@
+__author__ = 'n3k'
+
+"""
+Persistent index of the parsed tables of a cabinet.
+
+Opening the same cabinet over and over means parsing its CFHEADER, CFFOLDER and CFFILE
+tables and walking every CFDATA each time. A CabIndex keeps a compact binary copy of
+those tables (plus the offsets of the CFDATA blocks) next to the cabinet, or inside a
+cache directory, so following opens can restore them with one read. The CFFILE and
+CFDATA entries are only built when they are used, so opening a cabinet of many files
+costs about the same as opening a small one.
+"""
+
+import os
+import io
+import bisect
+import struct
+import hashlib
+import tempfile
+
+from pycab.CabStructs import CFHEADER, CFFOLDER, CFFILE, CFDATA
+
+
+class LazyTable(object):
+    """
+    Read-only sequence over the entries of a table restored from a CabIndex. Every entry
+    is built the first time it is used and then kept, a slice is a view over the same
+    entries. fields(position) returns the raw fields of an entry without building it.
+    """
+
+    def __init__(self, build, positions, fields=None, entries=None):
+        self._build = build
+        self._positions = positions
+        self._fields = fields
+        # position -> entry of the table, shared by its views
+        self._entries = {} if entries is None else entries
+
+    def _get(self, position):
+        entry = self._entries.get(position)
+        if entry is None:
+            entry = self._entries[position] = self._build(position)
+        return entry
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return LazyTable(self._build, self._positions[key], fields=self._fields, entries=self._entries)
+        return self._get(self._positions[key])
+
+    def __iter__(self):
+        for position in self._positions:
+            yield self._get(position)
+
+    def get_fields(self, index):
+        return self._fields(self._positions[index])
+
+    def get_built(self):
+        """
+        Returns the entries of the view that were already built, in table order
+        """
+        return [self._entries[position] for position in self._positions if position in self._entries]
+
+
+class CabIndex(object):
+    """
+    Index layout:
+        magic, version
+        key: cabinet size, cabinet mtime, md5 of the CFHEADER bytes, size of the CFHEADER, path
+        CFFOLDER table: coffCabStart, cCFData, typeCompress, abReserve
+        szName of every CFFILE: size, names
+        CFFILE table: cbFile, uoffFolderStart, iFolder, date, time, attribs, offset and len of szName
+        CFDATA table: offset, csum, cbData, cbUncomp, abReserve
+    Every CFFILE and CFDATA entry has the same size, so any of them is found without
+    reading the previous ones. The CFHEADER itself is not stored, it is read (and hashed)
+    from the cabinet every time to make sure the index still describes it.
+    """
+
+    MAGIC = "PCIX"
+    VERSION = 2
+
+    _preamble = struct.Struct("<4sB")
+    _key = struct.Struct("<Qd16sIH")
+    _folder = struct.Struct("<IHH")
+    _names = struct.Struct("<I")
+    _file = struct.Struct("<IIHHHHIH")
+    _data = struct.Struct("<IIHH")
+
+    def __init__(self, cache_dir=None, suffix=".pcix"):
+        """
+        If cache_dir is None the index is stored as a sidecar file next to the cabinet
+        """
+        self.cache_dir = cache_dir
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+
+    def get_index_filename(self, filename):
+        path = os.path.abspath(filename)
+        if self.cache_dir is None:
+            return path + self.suffix
+        return os.path.join(self.cache_dir, hashlib.md5(path).hexdigest() + self.suffix)
+
+    def load(self, reader):
+        """
+        Fills the tables of the reader from the index
+        :return: True if the index was up to date, False otherwise
+        """
+        try:
+            loaded = self._load(reader)
+        except Exception:
+            # A missing or broken index is just a miss
+            loaded = False
+        if loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return loaded
+
+    def _load(self, reader):
+        path = os.path.abspath(reader.filename)
+        with open(self.get_index_filename(reader.filename), "rb") as f:
+            data = f.read()
+
+        magic, version = self._preamble.unpack_from(data, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            return False
+        offset = self._preamble.size
+
+        size, mtime, header_hash, header_size, path_len = self._key.unpack_from(data, offset)
+        offset += self._key.size
+        if data[offset:offset+path_len] != path:
+            return False
+        offset += path_len
+
+        st = os.stat(path)
+        if st.st_size != size or st.st_mtime != mtime:
+            return False
+        with open(path, "rb") as f:
+            header_data = f.read(header_size)
+        if hashlib.md5(header_data).digest() != header_hash:
+            return False
+
+        cfheader = reader.read_cfheader(handle=io.BytesIO(header_data))
+        reserve = cfheader.flags & CFHEADER.cfhdrRESERVE_PRESENT
+
+        cffolder_list = []
+        folder_reserve = cfheader.cbCFFolder if reserve else 0
+        for i in range(cfheader.cFolders):
+            coffCabStart, cCFData, typeCompress = self._folder.unpack_from(data, offset)
+            offset += self._folder.size
+            cffolder_list.append(CFFOLDER.create_from_parameters(parameters={
+                "coffCabStart": coffCabStart,
+                "cCFData": cCFData,
+                "typeCompress": typeCompress,
+                "abReserve": data[offset:offset+folder_reserve]
+            }))
+            offset += folder_reserve
+
+        names_size = self._names.unpack_from(data, offset)[0]
+        offset += self._names.size
+        names = data[offset:offset+names_size]
+        offset += names_size
+        files_offset = offset
+        offset += cfheader.cFiles * self._file.size
+
+        data_reserve = cfheader.cbCFData if reserve else 0
+        data_size = self._data.size + data_reserve
+        data_offset = offset
+        # Index of the first CFDATA of every folder, plus the count of CFDATA at the end
+        folder_starts = [0]
+        for cffolder in cffolder_list:
+            folder_starts.append(folder_starts[-1] + cffolder.cCFData)
+        if offset + folder_starts[-1] * data_size != len(data):
+            return False
+
+        def get_file_fields(position):
+            return self._file.unpack_from(data, files_offset + position * self._file.size)
+
+        def build_file(position):
+            cbFile, uoffFolderStart, iFolder, date, time, attribs, name_offset, name_len = get_file_fields(position)
+            cffile = CFFILE.create_from_parameters(parameters={
+                "cbFile": cbFile,
+                "uoffFolderStart": uoffFolderStart,
+                "iFolder": iFolder,
+                "date": date,
+                "time": time,
+                "attribs": attribs,
+                "szName": names[name_offset:name_offset+name_len]
+            })
+            if cffolder_list:
+                cffile.cffolder = cffolder_list[reader.get_folder_index(cffile)]
+            return cffile
+
+        def get_data_fields(position):
+            return self._data.unpack_from(data, data_offset + position * data_size)
+
+        def build_data(position):
+            cfdata_offset, csum, cbData, cbUncomp = get_data_fields(position)
+            reserve_offset = data_offset + position * data_size + self._data.size
+            cfdata = CFDATA.create_from_parameters(parameters={
+                "offset": cfdata_offset,
+                "csum": csum,
+                "cbData": cbData,
+                "cbUncomp": cbUncomp,
+                "abReserve": data[reserve_offset:reserve_offset+data_reserve],
+                "ab": None
+            })
+            cfdata.cffolder = cffolder_list[bisect.bisect_right(folder_starts, position) - 1]
+            # The payload will be read the first time it is accessed
+            cfdata.loader = reader._load_data
+            return cfdata
+
+        reader.cfheader = cfheader
+        reader.cffolder_list = cffolder_list
+        reader.cffile_list = LazyTable(build_file, range(cfheader.cFiles), fields=get_file_fields)
+        reader.cfdata_list = LazyTable(build_data, range(folder_starts[-1]), fields=get_data_fields)
+
+        # What CabReader._link_tables does, with the iFolder of the entries instead of
+        # the entries themselves
+        folder_files = [[] for cffolder in cffolder_list]
+        continued = False
+        for position in range(cfheader.cFiles):
+            iFolder = get_file_fields(position)[2]
+            if iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV, CFFILE.ifoldCONTINUED_PREV_AND_NEXT):
+                continued = True
+            if iFolder == CFFILE.ifoldCONTINUED_FROM_PREV:
+                iFolder = 0
+            elif iFolder in (CFFILE.ifoldCONTINUED_TO_NEXT, CFFILE.ifoldCONTINUED_PREV_AND_NEXT):
+                iFolder = len(cffolder_list) - 1
+            if iFolder < len(cffolder_list):
+                folder_files[iFolder].append(position)
+        for folder_id, cffolder in enumerate(cffolder_list):
+            cffolder.folder_id = folder_id
+            cffolder.cfdata_list = reader.cfdata_list[folder_starts[folder_id]:folder_starts[folder_id+1]]
+            cffolder.cffile_list = LazyTable(build_file, folder_files[folder_id], fields=get_file_fields,
+                                             entries=reader.cffile_list._entries)
+        reader._first_folder_continued = continued
+        reader._names = names
+        return True
+
+    def store(self, reader):
+        """
+        Writes the index of the tables of the reader, errors are ignored as the index
+        is only a cache
+        """
+        try:
+            self._store(reader)
+        except (IOError, OSError):
+            pass
+
+    def _store(self, reader):
+        path = os.path.abspath(reader.filename)
+        cfheader = reader.cfheader
+        header_size = cfheader.get_packed_size()
+        with open(path, "rb") as f:
+            header_data = f.read(header_size)
+        st = os.stat(path)
+
+        chunks = [
+            self._preamble.pack(self.MAGIC, self.VERSION),
+            self._key.pack(st.st_size, st.st_mtime, hashlib.md5(header_data).digest(), header_size, len(path)),
+            path
+        ]
+        for cffolder in reader.cffolder_list:
+            chunks.append(self._folder.pack(cffolder.coffCabStart, cffolder.cCFData, cffolder.typeCompress))
+            chunks.append(cffolder.abReserve)
+        names = "".join([cffile.szName for cffile in reader.cffile_list])
+        chunks.append(self._names.pack(len(names)))
+        chunks.append(names)
+        name_offset = 0
+        for cffile in reader.cffile_list:
+            chunks.append(self._file.pack(cffile.cbFile, cffile.uoffFolderStart, cffile.iFolder,
+                                          cffile.date, cffile.time, cffile.attribs, name_offset, len(cffile.szName)))
+            name_offset += len(cffile.szName)
+        for cfdata in reader.cfdata_list:
+            chunks.append(self._data.pack(cfdata.offset, cfdata.csum, cfdata.cbData, cfdata.cbUncomp))
+            chunks.append(cfdata.abReserve)
+
+        index_filename = self.get_index_filename(reader.filename)
+        # A temporary file of its own, so concurrent writers of the same index never
+        # rename each other's half written file
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(index_filename),
+                                            prefix=os.path.basename(index_filename), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write("".join(chunks))
+            if os.name == "nt" and os.path.exists(index_filename):
+                os.remove(index_filename)
+            os.rename(tmp_filename, index_filename)
+        except:
+            os.remove(tmp_filename)
+            raise
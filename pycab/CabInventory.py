@@ -0,0 +1,99 @@
+__author__ = 'n3k'
+
+"""
+Bulk inventory of directories full of cabinets. Only the CFHEADER (and optionally the
+CFFOLDER/CFFILE tables) of every cabinet is read, in a pool of threads.
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from pycab.CabReader import CabReader
+from pycab.CabStructs import CFHEADER
+
+
+class CabInventory(object):
+    """
+    Usage:
+        for record in CabInventory(workers=16).scan("/srv/cabs"):
+            ...
+    Every record is a dictionary with the filename and either the summary of the
+    cabinet or an "error" key if it could not be probed.
+    """
+
+    def __init__(self, workers=8, tables=False, extensions=(".cab",), chunksize=16):
+        """
+        tables=True also reads the CFFOLDER/CFFILE tables to report the members
+        extensions=None probes every file, not only the ones ending with one of them
+        """
+        self.workers = workers
+        self.tables = tables
+        self.extensions = tuple(_.lower() for _ in extensions) if extensions is not None else None
+        self.chunksize = chunksize
+
+    def _wanted(self, filename):
+        return self.extensions is None or filename.lower().endswith(self.extensions)
+
+    def iter_files(self, path):
+        """
+        Yields the path of every wanted file under path
+        """
+        if scandir is None:
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    if self._wanted(filename):
+                        yield os.path.join(dirpath, filename)
+            return
+
+        pending = [path]
+        while pending:
+            for entry in scandir(pending.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file() and self._wanted(entry.name):
+                    yield entry.path
+
+    def probe(self, filename):
+        """
+        Returns the record of one cabinet
+        """
+        record = {"filename": filename}
+        try:
+            cab = CabReader.probe(filename, tables=self.tables)
+        except Exception as e:
+            record["error"] = str(e)
+            return record
+
+        cfheader = cab.cfheader
+        record["setID"] = cfheader.setID
+        record["iCabinet"] = cfheader.iCabinet
+        record["cbCabinet"] = cfheader.cbCabinet
+        record["cFolders"] = cfheader.cFolders
+        record["cFiles"] = cfheader.cFiles
+        record["flags"] = cfheader.flags
+        record["szCabinetPrev"] = cfheader.szCabinetPrev[:-1] if cfheader.flags & CFHEADER.cfhdrPREV_CABINET else ""
+        record["szCabinetNext"] = cfheader.szCabinetNext[:-1] if cfheader.flags & CFHEADER.cfhdrNEXT_CABINET else ""
+        if self.tables:
+            record["members"] = [(cffile.szName[:-1], cffile.cbFile) for cffile in cab.cffile_list]
+            record["uncompressed_size"] = sum([cffile.cbFile for cffile in cab.cffile_list])
+        return record
+
+    def scan(self, path):
+        """
+        Yields the records of the cabinets under path as soon as they are probed,
+        in no particular order
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            for record in pool.imap_unordered(self.probe, self.iter_files(path), self.chunksize):
+                yield record
+        finally:
+            pool.terminate()
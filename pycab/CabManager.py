@@ -1,13 +1,53 @@
 import os
+import cPickle
+from collections import deque
+from multiprocessing import Pool, TimeoutError, cpu_count
 
 from CabReader import CabReader
 from pycab.CabWriter import CABSet
+from pycab.CabStructs import CFFOLDER
+
+
+def _build_cab_set(spec):
+    """
+    Creates and writes the set of one spec of CABManager.create_cabs
+    :return: (filenames, error)
+    """
+    try:
+        manager = CABManager()
+        manager.create_cab(**spec)
+        return [os.path.join(spec["output_dir"], cab.cab_filename) for cab in manager.cab_set], None
+    except Exception as e:
+        return [], str(e) or e.__class__.__name__
+
+
+def _build_pickled_cab_set(data):
+    """
+    The same as _build_cab_set with the spec pickled by the parent
+    """
+    return _build_cab_set(cPickle.loads(data))
+
+
+def _get_result(result, async_result, timeout):
+    """
+    Puts into result what the worker returned, or why it never did
+    """
+    try:
+        result["filenames"], result["error"] = async_result.get(timeout)
+    except TimeoutError:
+        result["error"] = "The worker didn't answer in %s seconds" % timeout
+    except Exception as e:
+        result["error"] = "The worker failed: %s" % (str(e) or e.__class__.__name__)
 
 
 class CABManager(object):
 
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        cache is an optional CabCache shared by read_cab and read_member
+        """
         self.cab_set = None
+        self.cache = cache
 
         self.debug_file = "debug.txt"
 
@@ -15,7 +55,23 @@ class CABManager(object):
                   cfheader_reserve=0,
                   cffolder_reserve=0,
                   cfdata_reserve=0,
-                  cab_name="out_[x].cab"):
+                  cab_name="out_[x].cab",
+                  output_dir=None,
+                  cfdata_size=0x8000,
+                  folder_size=0,
+                  compression=CFFOLDER.tcompTYPE_NONE,
+                  workers=1):
+        """
+        If output_dir is given, every cab is written to it as soon as it is complete
+        instead of keeping the whole set in memory until flush_cabset_to_disk
+        cfdata_size is the max uncompressed bytes per CFDATA (up to 0x8000)
+        folder_size starts a new CFFOLDER before a file that would make the current one hold
+        more than that many uncompressed bytes, 0 means never. Files are not split, so a file
+        bigger than folder_size gets a CFFOLDER of its own that holds more than that
+        compression is the typeCompress of the folders (NONE or MSZIP) unless their
+        CABFolderUnit says otherwise, cab_size still counts uncompressed bytes
+        workers > 1 compresses the CFDATA in a pool of threads
+        """
 
         params = {
             "output_name": cab_name,
@@ -23,7 +79,12 @@ class CABManager(object):
             "max_data_per_cab": cab_size,
             "cfheader_reserve": cfheader_reserve,
             "cffolder_reserve": cffolder_reserve,
-            "cfdata_reserve": cfdata_reserve
+            "cfdata_reserve": cfdata_reserve,
+            "output_dir": output_dir,
+            "cfdata_size": cfdata_size,
+            "max_data_per_folder": folder_size,
+            "compression": compression,
+            "workers": workers
             }
 
         self.cab_set = CABSet(parameters=params)
@@ -31,6 +92,60 @@ class CABManager(object):
 
 
 
+    def create_cabs(self, specs, workers=None, max_pending=None, timeout=None):
+        """
+        Usage:
+            results = CABManager().create_cabs([{"cab_folders": [folder1], "cab_name": "a_[x].cab",
+                                                 "output_dir": "/out/a"}, ...], workers=8)
+        Creates many independent sets at the same time, one per spec in a pool of processes.
+        A spec is a dict with the arguments of create_cab and output_dir is required, every
+        cab is written by its worker and only the filenames come back. specs can be a
+        generator, at most max_pending specs (2 * workers by default) are waiting in the pool.
+        A spec with the cab_name and output_dir of a previous one fails without being built.
+        timeout is how many seconds to wait for the result of a spec, a worker that dies
+        never answers. Without it that wait has no end
+        :return: a {"cab_name": ..., "filenames": [...], "error": None or message} per spec,
+                 in the order of specs
+        """
+        workers = workers or cpu_count()
+        max_pending = max_pending or 2 * workers
+        results = []
+        pending = deque()
+        # (output_dir, cab_name) of the specs seen
+        targets = set()
+        pool = Pool(workers) if workers > 1 else None
+        try:
+            for spec in specs:
+                result = {"cab_name": spec.get("cab_name", "out_[x].cab"), "filenames": [], "error": None}
+                results.append(result)
+                if not spec.get("output_dir"):
+                    result["error"] = "output_dir is required"
+                    continue
+                target = (os.path.normcase(os.path.abspath(spec["output_dir"])), result["cab_name"])
+                if target in targets:
+                    result["error"] = "Another spec writes %s into %s" % (result["cab_name"], spec["output_dir"])
+                    continue
+                targets.add(target)
+                if pool is None:
+                    result["filenames"], result["error"] = _build_cab_set(spec)
+                    continue
+                try:
+                    data = cPickle.dumps(spec, cPickle.HIGHEST_PROTOCOL)
+                except Exception as e:
+                    result["error"] = "The spec can't be sent to a worker: %s" % e
+                    continue
+                pending.append((result, pool.apply_async(_build_pickled_cab_set, (data,))))
+                while len(pending) >= max_pending:
+                    result, async_result = pending.popleft()
+                    _get_result(result, async_result, timeout)
+            while pending:
+                result, async_result = pending.popleft()
+                _get_result(result, async_result, timeout)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return results
+
     def flush_cabset_to_disk(self, output_dir=os.getcwd(), debug=False):
         if debug:
             with open(os.path.join(output_dir, self.debug_file), "wt") as f:
@@ -39,9 +154,16 @@ class CABManager(object):
 
         #Write the .CABs
         for index, cab in enumerate(self.cab_set):
-            with open(os.path.join(output_dir, cab.cab_filename), "wb") as f:
-                f.write(repr(cab))
+            if not cab.data_released:
+                cab.flush_to_disk(output_dir)
 
-    def read_cab(self, cab_filename):
-        data = CabReader(filename=cab_filename)
+    def read_cab(self, cab_filename, index_cache=None):
+        if self.cache is not None:
+            return self.cache.get_reader(cab_filename)
+        data = CabReader(filename=cab_filename, index_cache=index_cache)
         return data
+
+    def read_member(self, cab_filename, member_name):
+        if self.cache is not None:
+            return self.cache.read_member(cab_filename, member_name)
+        return CabReader(filename=cab_filename).read_member(member_name)
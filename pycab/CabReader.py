@@ -1,8 +1,21 @@
 __author__ = 'n3k'
 
+import io
+import os
+import mmap
+import bisect
 import struct
+import threading
 
 from pycab.CabStructs import CABFileFormat, CFHEADER, CFFOLDER, CFFILE, CFDATA
+from pycab.CabWriter import CABException
+from pycab.CabCompression import MSZIPDecoder
+from pycab.CabIndex import LazyTable
+
+
+# Every how many CFDATA of a MSZIP folder the decoder window is kept, so seeking
+# backwards decodes from the nearest saved window instead of the folder start
+MSZIP_CHECKPOINT = 32
 
 
 class CabReader(CABFileFormat):
@@ -10,15 +23,59 @@ class CabReader(CABFileFormat):
     This class is able to read VALID .cab files
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, index_cache=None, load_data=True, offset=0, positional_io=False):
+        """
+        index_cache is an optional CabIndex; when it holds an up to date index of
+        the cabinet the tables are restored from it instead of parsing the file
+        load_data=False only reads the CFDATA headers, the payloads are read on demand
+        offset is where the cabinet starts inside the file (for embedded cabinets,
+        those are never indexed)
+        positional_io=True (with load_data=False) reads every payload at its offset with
+        os.pread, or from a mmap of the file, so many threads can decode members of the
+        cabinet at the same time without sharing a file position. Call close() when done.
+        """
         self.filename = filename
+        self.index_cache = index_cache if offset == 0 else None
+        self.load_data = load_data
+        self.offset = offset
+        self.positional_io = positional_io
 
         self.cfheader = None
         self.cffolder_list = []
         self.cffile_list = []
         self.cfdata_list = []
+        self._init_decoding()
 
-        self._read_cab()
+        if self.index_cache is None or not self.index_cache.load(self):
+            self._read_cab()
+            if self.index_cache is not None:
+                self.index_cache.store(self)
+        self._link_tables()
+
+    @classmethod
+    def probe(cls, filename, tables=False, offset=0):
+        """
+        Returns a CabReader with only the CFHEADER read, plus the CFFOLDER and CFFILE
+        tables if tables=True. No CFDATA is read at all.
+        """
+        reader = cls.__new__(cls)
+        reader.filename = filename
+        reader.index_cache = None
+        reader.load_data = False
+        reader.offset = offset
+        reader.positional_io = False
+        reader.cffolder_list = []
+        reader.cffile_list = []
+        reader.cfdata_list = []
+        reader._init_decoding()
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            reader.cfheader = reader.read_cfheader(handle=f)
+            if tables:
+                reader.cffolder_list = reader.read_folders(handle=f)
+                reader.cffile_list = reader.read_files(handle=f)
+        reader._link_tables()
+        return reader
 
     ##### METHODS FOR MANAGING CABs #####
     def get_cfheader(self):
@@ -37,6 +94,271 @@ class CabReader(CABFileFormat):
         with open(filename, "wb") as f:
             f.write(self.dump_without_check())
 
+    def get_cffile(self, name):
+        """
+        Returns the first CFFILE called name (with or without the ending null byte)
+        """
+        if isinstance(self.cffile_list, LazyTable):
+            # The names of a CabIndex are searched, only the CFFILE found is built
+            szName = name if name.endswith("\x00") else name + "\x00"
+            if self._names.startswith(szName):
+                index = 0
+            else:
+                index = self._names.find("\x00" + szName) + 1
+                if index == 0:
+                    return None
+            return self.cffile_list[self._names.count("\x00", 0, index)]
+        for cffile in self.cffile_list:
+            if cffile.szName == name or cffile.szName[:-1] == name:
+                return cffile
+        return None
+
+    def get_folder_index(self, cffile):
+        """
+        Returns the index of the CFFOLDER holding the data of the CFFILE
+        """
+        if cffile.iFolder == CFFILE.ifoldCONTINUED_FROM_PREV:
+            return 0
+        if cffile.iFolder in (CFFILE.ifoldCONTINUED_TO_NEXT, CFFILE.ifoldCONTINUED_PREV_AND_NEXT):
+            return len(self.cffolder_list) - 1
+        return cffile.iFolder
+
+    def _read_at(self, offset, size):
+        """
+        Reads size bytes at offset of the file without a shared position: with os.pread
+        where there is one, otherwise slicing a read-only mmap of the file
+        """
+        if hasattr(os, "pread"):
+            if self._fd is None:
+                with self._io_lock:
+                    if self._fd is None:
+                        self._fd = os.open(self.filename, os.O_RDONLY)
+            parts = []
+            while size > 0:
+                data = os.pread(self._fd, size, offset)
+                if not data:
+                    break
+                parts.append(data)
+                offset += len(data)
+                size -= len(data)
+            return "".join(parts)
+
+        if self._mmap is None:
+            with self._io_lock:
+                if self._mmap is None:
+                    with open(self.filename, "rb") as f:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset:offset + size]
+
+    def close(self):
+        """
+        Releases the descriptor or the mmap of positional_io
+        """
+        with self._io_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+
+    def _get_ab(self, cfdata, handle=None):
+        if cfdata.loader is not None and handle is not None:
+            handle.seek(cfdata.get_data_offset())
+            return handle.read(cfdata.cbData)
+        if cfdata.loader is not None and self.positional_io:
+            return self._read_at(cfdata.get_data_offset(), cfdata.cbData)
+        return cfdata.ab
+
+    def decode_cfdata(self, cfdata, handle=None):
+        """
+        Returns the uncompressed bytes of the CFDATA
+        If the payload was not loaded yet and a handle is given, the payload is read
+        from it without keeping it in the CFDATA
+        """
+        ab = self._get_ab(cfdata, handle=handle)
+
+        compression = cfdata.cffolder.typeCompress & CFFOLDER.tcompMASK_TYPE
+        if compression == CFFOLDER.tcompTYPE_NONE:
+            return ab
+        if compression == CFFOLDER.tcompTYPE_MSZIP:
+            return self._decode_mszip(cfdata, ab, handle=handle)
+        raise CABException("Compression type %04x is not supported" % compression)
+
+    def _init_decoding(self):
+        # folder_id -> (offset of the next CFDATA, MSZIPDecoder) of the last decoded CFDATA
+        self._decoders = {}
+        self._decoders_lock = threading.Lock()
+        # folder_id -> Lock, the folders are decoded in parallel but each one in order
+        self._folder_locks = {}
+        # folder_id -> (uncompressed starts, offsets) of its CFDATA, see get_block_index
+        self._block_indexes = {}
+        # (folder_id, index of the CFDATA) -> window of the MSZIPDecoder before decoding it
+        self._mszip_windows = {}
+        # Descriptor or mmap of positional_io, see _read_at
+        self._fd = None
+        self._mmap = None
+        self._io_lock = threading.Lock()
+
+    def get_block_index(self, cffolder):
+        """
+        Returns (starts, offsets) of the CFDATA of the folder, where starts has the
+        uncompressed offset of each CFDATA inside the folder plus the folder size at the
+        end, and offsets has the offset of each CFDATA in the file
+        """
+        if cffolder.folder_id not in self._block_indexes:
+            if isinstance(cffolder.cfdata_list, LazyTable):
+                # (offset, csum, cbData, cbUncomp) without building the CFDATA
+                fields = [cffolder.cfdata_list.get_fields(i) for i in range(len(cffolder.cfdata_list))]
+            else:
+                fields = [(cfdata.offset, cfdata.csum, cfdata.cbData, cfdata.cbUncomp)
+                          for cfdata in cffolder.cfdata_list]
+            starts = [0]
+            for cfdata_fields in fields:
+                starts.append(starts[-1] + cfdata_fields[3])
+            offsets = [cfdata_fields[0] for cfdata_fields in fields]
+            self._block_indexes[cffolder.folder_id] = (starts, offsets)
+        return self._block_indexes[cffolder.folder_id]
+
+    def _get_block_position(self, cfdata):
+        """
+        Returns the index of the CFDATA inside its folder, None if it is not in the tables
+        """
+        offsets = self.get_block_index(cfdata.cffolder)[1]
+        index = bisect.bisect_left(offsets, cfdata.offset)
+        if index < len(offsets) and offsets[index] == cfdata.offset:
+            return index
+        return None
+
+    def _save_window(self, cffolder, index, decoder):
+        if index and index % MSZIP_CHECKPOINT == 0 and (cffolder.folder_id, index) not in self._mszip_windows:
+            self._mszip_windows[(cffolder.folder_id, index)] = decoder.window
+
+    def _decode_mszip(self, cfdata, ab, handle=None):
+        """
+        A MSZIP block needs the history of the previous blocks of its folder. Decoding
+        the blocks in order is cheap, any other CFDATA decodes its folder from the
+        nearest saved window (or the folder start) on.
+        """
+        cffolder = cfdata.cffolder
+        index = self._get_block_position(cfdata)
+        with self._decoders_lock:
+            folder_lock = self._folder_locks.setdefault(cffolder.folder_id, threading.Lock())
+        with folder_lock:
+            next_offset, decoder = self._decoders.get(cffolder.folder_id, (None, None))
+            if next_offset != cfdata.offset:
+                decoder = MSZIPDecoder()
+                if index is not None:
+                    start = index - index % MSZIP_CHECKPOINT
+                    while start and (cffolder.folder_id, start) not in self._mszip_windows:
+                        start -= MSZIP_CHECKPOINT
+                    decoder.window = self._mszip_windows.get((cffolder.folder_id, start), "")
+                    for i in range(start, index):
+                        self._save_window(cffolder, i, decoder)
+                        decoder.decode(self._get_ab(cffolder.cfdata_list[i], handle=handle))
+            if index is not None:
+                self._save_window(cffolder, index, decoder)
+            try:
+                data = decoder.decode(ab)
+            except Exception as e:
+                self._decoders.pop(cffolder.folder_id, None)
+                raise CABException("The MSZIP data at %08x can't be decoded: %s" % (cfdata.offset, e))
+            self._decoders[cffolder.folder_id] = (cfdata.get_data_offset() + cfdata.cbData, decoder)
+        return data
+
+    def is_member_local(self, cffile):
+        """
+        True when the data of the CFFILE can be located in this cabinet alone. The files
+        of a folder continued from a previous cabinet count uoffFolderStart from the start
+        of the folder there, so they need the whole set.
+        """
+        if cffile.iFolder >= len(self.cffolder_list):
+            return False
+        return not (self._first_folder_continued and self.get_folder_index(cffile) == 0)
+
+    def get_member_slices(self, cffile):
+        """
+        Yields (cfdata, start, end) for every CFDATA holding part of the CFFILE, where
+        start:end is the part of the uncompressed CFDATA that belongs to the file.
+        Only files whose data is entirely in this cabinet can be located this way.
+        """
+        if not self.is_member_local(cffile):
+            raise CABException("The data of %s is not entirely in this cabinet" % cffile.szName[:-1])
+
+        file_start = cffile.uoffFolderStart
+        file_end = file_start + cffile.cbFile
+        starts = self.get_block_index(cffile.cffolder)[0]
+        # The first CFDATA ending after the start of the file
+        index = max(bisect.bisect_right(starts, file_start) - 1, 0)
+        for cfdata in cffile.cffolder.cfdata_list[index:]:
+            data_start = starts[index]
+            data_end = starts[index + 1]
+            if data_end > file_start and data_start < file_end:
+                yield cfdata, max(file_start, data_start) - data_start, min(file_end, data_end) - data_start
+            if data_end >= file_end:
+                break
+            index += 1
+        if starts[-1] < file_end:
+            raise CABException("The CFDATA of the folder end before the data of %s" % cffile.szName[:-1])
+
+    @staticmethod
+    def get_set_folders(readers):
+        """
+        Returns a (blocks, cffile_list) for every folder of the set of readers, where blocks
+        is the list of (reader, CFDATA) of the folder, including those of the next cabinets
+        when it is continued, and cffile_list has the first instance of each of its files
+        """
+        return [([(reader, cfdata) for reader, cffolder in parts for cfdata in cffolder.cfdata_list], cffile_list)
+                for parts, cffile_list in CabReader.get_set_folder_parts(readers)]
+
+    @staticmethod
+    def get_set_folder_parts(readers):
+        """
+        Like get_set_folders, but with the list of (reader, CFFOLDER) holding each folder of
+        the set instead of its CFDATA, so it only needs the CFFOLDER and CFFILE tables
+        """
+        result = []
+        # id(parts) -> cffile_list of the folder
+        cffile_lists = {}
+        prev_parts = None
+        for reader in readers:
+            continued = any([cffile.iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV, CFFILE.ifoldCONTINUED_PREV_AND_NEXT)
+                             for cffile in reader.cffile_list])
+            folders = []
+            for i, cffolder in enumerate(reader.cffolder_list):
+                if i == 0 and continued and prev_parts is not None:
+                    prev_parts.append((reader, cffolder))
+                    folders.append(prev_parts)
+                else:
+                    folders.append([(reader, cffolder)])
+                    cffile_lists[id(folders[-1])] = []
+                    result.append((folders[-1], cffile_lists[id(folders[-1])]))
+            for cffile in reader.cffile_list:
+                # The first instance of a file continued from a previous cabinet is already in
+                if cffile.iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV, CFFILE.ifoldCONTINUED_PREV_AND_NEXT):
+                    continue
+                cffile_lists[id(folders[reader.get_folder_index(cffile)])].append(cffile)
+            prev_parts = folders[-1] if folders else None
+        return result
+
+    @staticmethod
+    def get_folder_blocks(blocks):
+        """
+        Returns (pieces, cbUncomp) for every block of data of a folder, from its list of
+        (reader, CFDATA) of get_set_folders. A CFDATA split between two cabinets has
+        cbUncomp 0 in the first one and its payload goes in front of the one of the next
+        cabinet, pieces is the list of the (reader, CFDATA) whose payloads make the block.
+        """
+        result = []
+        pieces = []
+        for i, (reader, cfdata) in enumerate(blocks):
+            pieces.append((reader, cfdata))
+            if cfdata.cbUncomp == 0 and i + 1 < len(blocks) and blocks[i+1][0] is not reader:
+                continue
+            result.append((pieces, cfdata.cbUncomp))
+            pieces = []
+        return result
+
 
     #####################################
 
@@ -142,10 +464,27 @@ class CabReader(CABFileFormat):
         return result
 
     def read_data(self, handle):
+        return self._read_cfdata_headers(handle, sum([cffolder.cCFData for cffolder in self.cffolder_list]))
+
+    def read_folder_cfdata(self, cffolder):
+        """
+        Reads the CFDATA headers of a single CFFOLDER of a reader made with probe(tables=True)
+        and links them with it, the payloads are read on demand
+        :return: the cfdata_list of the CFFOLDER
+        """
+        if not cffolder.cfdata_list and cffolder.cCFData:
+            with open(self.filename, "rb") as f:
+                f.seek(self.offset + cffolder.coffCabStart)
+                cffolder.cfdata_list = self._read_cfdata_headers(f, cffolder.cCFData)
+            for cfdata in cffolder.cfdata_list:
+                cfdata.cffolder = cffolder
+        return cffolder.cfdata_list
+
+    def _read_cfdata_headers(self, handle, data_count):
         result = []
-        data_count = sum([cffolder.cCFData for cffolder in self.cffolder_list])
         for i in range(data_count):
             parameters = {}
+            parameters["offset"] = handle.tell()
             parameters["csum"] = self._read_dword(handle)
             parameters["cbData"] = self._read_word(handle)
             parameters["cbUncomp"] = self._read_word(handle)
@@ -153,15 +492,97 @@ class CabReader(CABFileFormat):
                 parameters["abReserve"] = handle.read(self.cfheader.cbCFData)
             else:
                 parameters["abReserve"] = ""
-            parameters["ab"] = handle.read(parameters["cbData"])
-            result.append(CFDATA.create_from_parameters(parameters=parameters))
+            if self.load_data:
+                parameters["ab"] = handle.read(parameters["cbData"])
+                result.append(CFDATA.create_from_parameters(parameters=parameters))
+            else:
+                handle.seek(parameters["cbData"], 1)
+                parameters["ab"] = None
+                cfdata = CFDATA.create_from_parameters(parameters=parameters)
+                cfdata.loader = self._load_data
+                result.append(cfdata)
         return result
 
+    def _load_data(self, cfdata):
+        """
+        Loader for the CFDATA restored from an index, the payloads of every
+        pending CFDATA are read in a single pass the first time one is needed.
+        The CFDATA of a LazyTable that were not built yet are left for later.
+        """
+        if isinstance(self.cfdata_list, LazyTable):
+            cfdata_list = self.cfdata_list.get_built()
+        else:
+            cfdata_list = self.cfdata_list
+        with open(self.filename, "rb") as f:
+            for _cfdata in cfdata_list:
+                if _cfdata.loader is not None:
+                    f.seek(_cfdata.get_data_offset())
+                    _cfdata.loader = None
+                    _cfdata.ab = f.read(_cfdata.cbData)
+
+    def read_member(self, name):
+        """
+        Returns the data of the file called name
+        """
+        cffile = self.get_cffile(name)
+        if cffile is None:
+            raise CABException("File %s not found in %s" % (name, self.filename))
+        return "".join([self.decode_cfdata(cfdata)[start:end] for cfdata, start, end in self.get_member_slices(cffile)])
+
+    def open_member(self, name):
+        """
+        Returns a seekable CabMemberFile over the data of the file called name
+        """
+        cffile = self.get_cffile(name)
+        if cffile is None:
+            raise CABException("File %s not found in %s" % (name, self.filename))
+        return CabMemberFile(self, cffile)
+
+    def iter_members(self):
+        """
+        Yields (CFFILE, CabMemberStream) in folder order. Every stream shares the
+        handle of the iteration, so it must be consumed before asking for the next
+        member. The files that are not entirely in this cabinet (see is_member_local)
+        are skipped. With load_data=False only one CFDATA at a time is kept in memory.
+        """
+        with open(self.filename, "rb") as handle:
+            for cffolder in self.cffolder_list:
+                for cffile in sorted(cffolder.cffile_list, key=lambda x: x.uoffFolderStart):
+                    if not self.is_member_local(cffile):
+                        continue
+                    yield cffile, CabMemberStream(self, cffile, handle=handle)
+
+    def _link_tables(self):
+        """
+        Links every CFDATA and CFFILE with the CFFOLDER it belongs to
+        """
+        if isinstance(self.cffile_list, LazyTable):
+            # Restored by a CabIndex, the entries are linked when they are built
+            return
+        # The first folder goes on from the previous cabinet, see is_member_local
+        self._first_folder_continued = any([cffile.iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV,
+                                                               CFFILE.ifoldCONTINUED_PREV_AND_NEXT)
+                                            for cffile in self.cffile_list])
+        index = 0
+        for folder_id, cffolder in enumerate(self.cffolder_list):
+            cffolder.folder_id = folder_id
+            cffolder.cfdata_list = self.cfdata_list[index:index+cffolder.cCFData]
+            for cfdata in cffolder.cfdata_list:
+                cfdata.cffolder = cffolder
+            index += cffolder.cCFData
+
+        for cffile in self.cffile_list:
+            if not self.cffolder_list:
+                break
+            cffile.cffolder = self.cffolder_list[self.get_folder_index(cffile)]
+            cffile.cffolder.cffile_list.append(cffile)
+
     def _read_cab(self):
         """
         This method will try to read the CABs data to fill the structures
         """
         with open(self.filename, "rb") as f:
+            f.seek(self.offset)
             self.cfheader = self.read_cfheader(handle=f)
             self.cffolder_list = self.read_folders(handle=f)
             self.cffile_list = self.read_files(handle=f)
@@ -197,3 +618,148 @@ class CabReader(CABFileFormat):
             data += repr(i)
         return data
 
+
+
+class CabMemberStream(object):
+    """
+    Read-only file-like object over the data of a CFFILE, it decodes one CFDATA at a time
+    """
+
+    def __init__(self, reader, cffile, handle=None):
+        self.reader = reader
+        self.cffile = cffile
+        self.name = cffile.szName[:-1] if cffile.szName.endswith("\x00") else cffile.szName
+        self.size = cffile.cbFile
+        self.position = 0
+
+        self._handle = handle
+        self._slices = reader.get_member_slices(cffile)
+        self._buffer = ""
+
+    def _fill(self):
+        """
+        Decodes the next CFDATA of the file into the buffer
+        :return: False when there is nothing else to read
+        """
+        try:
+            cfdata, start, end = next(self._slices)
+        except StopIteration:
+            return False
+        self._buffer += self.reader.decode_cfdata(cfdata, handle=self._handle)[start:end]
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer]
+            self._buffer = ""
+            while self._fill():
+                parts.append(self._buffer)
+                self._buffer = ""
+            data = "".join(parts)
+        else:
+            while len(self._buffer) < size and self._fill():
+                pass
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self._buffer = ""
+        self._slices = iter([])
+
+
+class CabMemberFile(io.RawIOBase):
+    """
+    Usage:
+        with cab.open_member("setup.exe") as f:
+            f.seek(0x3c)
+            ...
+    Read-only and seekable raw file over the data of a CFFILE. A seek only moves the
+    position, the CFDATA holding it is found in the block index of the folder when
+    reading and the last decoded CFDATA is kept. Wrap it in io.BufferedReader for
+    many small reads.
+    """
+
+    def __init__(self, reader, cffile):
+        io.RawIOBase.__init__(self)
+        if not reader.is_member_local(cffile):
+            raise CABException("The data of %s is not entirely in this cabinet" % cffile.szName[:-1])
+        self.reader = reader
+        self.cffile = cffile
+        self.name = cffile.szName[:-1] if cffile.szName.endswith("\x00") else cffile.szName
+        self.size = cffile.cbFile
+        self.position = 0
+
+        self._starts = reader.get_block_index(cffile.cffolder)[0]
+        cfdata_list = cffile.cffolder.cfdata_list
+        # The payloads that were not loaded are read from a handle of its own
+        if cfdata_list and cfdata_list[0].loader is not None and not reader.positional_io:
+            self._handle = open(reader.filename, "rb")
+        else:
+            self._handle = None
+        # (index of the CFDATA, uncompressed data) of the last decoded CFDATA
+        self._block = (None, "")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _get_block(self, index):
+        if self._block[0] != index:
+            cfdata = self.cffile.cffolder.cfdata_list[index]
+            self._block = (index, self.reader.decode_cfdata(cfdata, handle=self._handle))
+        return self._block[1]
+
+    def readinto(self, b):
+        """
+        Fills b from the CFDATA of the position on, up to the end of the file
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        size = min(len(b), max(self.size - self.position, 0))
+        done = 0
+        while done < size:
+            folder_position = self.cffile.uoffFolderStart + self.position
+            index = bisect.bisect_right(self._starts, folder_position) - 1
+            if index >= len(self._starts) - 1:
+                raise CABException("The CFDATA of the folder end before the data of %s" % self.name)
+            start = folder_position - self._starts[index]
+            data = self._get_block(index)[start:start + size - done]
+            if not data:
+                raise CABException("The CFDATA at %08x is shorter than its cbUncomp" %
+                                   self.cffile.cffolder.cfdata_list[index].offset)
+            b[done:done + len(data)] = data
+            done += len(data)
+            self.position += len(data)
+        return done
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence (%r)" % whence)
+        if position < 0:
+            raise IOError("Negative seek position %d" % position)
+        self.position = position
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        self._block = (None, "")
+        io.RawIOBase.close(self)
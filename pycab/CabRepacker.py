@@ -0,0 +1,269 @@
+__author__ = 'n3k'
+
+"""
+Merge of cabinets and re-split of a cabinet into a set by copying the CFDATA verbatim,
+only the CFHEADER, CFFOLDER and CFFILE tables are written again.
+"""
+
+import os
+
+from pycab.CabReader import CabReader
+from pycab.CabWriter import CABException, CABFile
+from pycab.CabStructs import CFHEADER, CFFOLDER, CFFILE
+
+
+def copy_range(src, dst, offset, length):
+    """
+    Copies length bytes of the file src from offset to the current position of dst,
+    in the kernel with os.copy_file_range when it is available
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is not None:
+        dst.flush()
+        position = dst.tell()
+        try:
+            while length > 0:
+                copied = copy_file_range(src.fileno(), dst.fileno(), length, offset, position)
+                if copied == 0:
+                    break
+                offset += copied
+                position += copied
+                length -= copied
+        except OSError:
+            # Not supported between these files, what is left goes through user space
+            pass
+        dst.seek(position)
+
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(length, 0x100000))
+        if not chunk:
+            raise CABException("Unexpected end of %s" % src.name)
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+class FolderPart(object):
+    """
+    The CFDATA of a source folder that go in one of the new cabinets
+    """
+
+    def __init__(self, reader, cffolder, start=0):
+        self.reader = reader
+        self.cffolder = cffolder
+        # Uncompressed offsets of the part inside the source folder
+        self.start = start
+        self.end = start
+        # What is subtracted from the uoffFolderStart of its files
+        self.base = 0
+        self.cfdata_list = []
+        self.cffile_list = []
+
+    def add_data(self, cfdata):
+        self.cfdata_list.append(cfdata)
+        self.end += cfdata.cbUncomp
+
+    def get_data_size(self):
+        return sum([8 + len(cfdata.abReserve) + cfdata.cbData for cfdata in self.cfdata_list])
+
+
+class CabRepacker(object):
+    """
+    Usage:
+        CabRepacker().merge(["a.cab", "b.cab"], "merged.cab")
+        CabRepacker().split("big.cab", "part_[x].cab", "/output/dir", max_data_per_cab=1474*1024)
+    Nothing is decompressed. A folder without compression can be split between two
+    cabinets at any CFDATA, a compressed folder always goes whole into one cabinet.
+    """
+
+    def _check_standalone(self, reader):
+        if reader.cfheader.flags & (CFHEADER.cfhdrPREV_CABINET | CFHEADER.cfhdrNEXT_CABINET):
+            raise CABException("%s belongs to a set" % reader.filename)
+
+    def _get_cfheader(self, reader, iCabinet=0):
+        return CFHEADER.create_from_parameters(parameters={
+            "flags": reader.cfheader.flags & CFHEADER.cfhdrRESERVE_PRESENT,
+            "reserved1": 0,
+            "cbCabinet": 0,
+            "reserved2": 0,
+            "coffFiles": 0,
+            "reserved3": 0,
+            "versionMinor": 0x03,
+            "versionMajor": 0x01,
+            "cFolders": 0,
+            "cFiles": 0,
+            "setID": reader.cfheader.setID,
+            "iCabinet": iCabinet,
+            "cbCFHeader": reader.cfheader.cbCFHeader,
+            "cbCFFolder": reader.cfheader.cbCFFolder,
+            "cbCFData": reader.cfheader.cbCFData,
+            "abReserve": reader.cfheader.abReserve,
+            "szCabinetPrev": "",
+            "szDiskPrev": "",
+            "szCabinetNext": "",
+            "szDiskNext": ""
+        })
+
+    def _get_cffile(self, cffile, part, iFolder):
+        """
+        The CFFILE of the new cabinet, continued from/to the others if it isn't entirely in the part
+        """
+        if cffile.uoffFolderStart < part.start and cffile.uoffFolderStart + cffile.cbFile > part.end:
+            iFolder = CFFILE.ifoldCONTINUED_PREV_AND_NEXT
+        elif cffile.uoffFolderStart < part.start:
+            iFolder = CFFILE.ifoldCONTINUED_FROM_PREV
+        elif cffile.uoffFolderStart + cffile.cbFile > part.end:
+            iFolder = CFFILE.ifoldCONTINUED_TO_NEXT
+        return CFFILE.create_from_parameters(parameters={
+            "cbFile": cffile.cbFile,
+            "uoffFolderStart": cffile.uoffFolderStart - part.base,
+            "iFolder": iFolder,
+            "date": cffile.date,
+            "time": cffile.time,
+            "attribs": cffile.attribs,
+            "szName": cffile.szName
+        })
+
+    def _write_cab(self, filename, cfheader, parts):
+        """
+        Writes a cabinet with the CFDATA of parts
+        """
+        cffolder_list = []
+        cffile_list = []
+        for folder_index, part in enumerate(parts):
+            cffolder_list.append(CFFOLDER.create_from_parameters(parameters={
+                "coffCabStart": 0,
+                "cCFData": len(part.cfdata_list),
+                "typeCompress": part.cffolder.typeCompress,
+                "abReserve": part.cffolder.abReserve
+            }))
+            cffile_list.extend([self._get_cffile(cffile, part, folder_index) for cffile in part.cffile_list])
+        if len(cffolder_list) > 0xFFFF or len(cffile_list) > 0xFFFF:
+            raise CABException("%s would have more than 65535 folders or files" % filename)
+
+        cfheader.cFolders = len(cffolder_list)
+        cfheader.cFiles = len(cffile_list)
+        cfheader.coffFiles = len(repr(cfheader)) + sum([len(cffolder) for cffolder in cffolder_list])
+        data_start = cfheader.coffFiles + sum([len(cffile) for cffile in cffile_list])
+        for cffolder, part in zip(cffolder_list, parts):
+            cffolder.coffCabStart = data_start
+            data_start += part.get_data_size()
+        if data_start > 0xFFFFFFFF:
+            raise CABException("%s would be bigger than 4GB" % filename)
+        cfheader.cbCabinet = data_start
+
+        handles = {}
+        try:
+            with open(filename, "wb") as f:
+                f.write(repr(cfheader))
+                f.write("".join([repr(cffolder) for cffolder in cffolder_list]))
+                f.write("".join([repr(cffile) for cffile in cffile_list]))
+                for part in parts:
+                    if not part.cfdata_list:
+                        continue
+                    if part.reader.filename not in handles:
+                        handles[part.reader.filename] = open(part.reader.filename, "rb")
+                    copy_range(handles[part.reader.filename], f, part.cfdata_list[0].offset, part.get_data_size())
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+    def _get_whole_part(self, reader, cffolder):
+        part = FolderPart(reader, cffolder)
+        for cfdata in cffolder.cfdata_list:
+            part.add_data(cfdata)
+        part.cffile_list = sorted(cffolder.cffile_list, key=lambda x: x.uoffFolderStart)
+        return part
+
+    def merge(self, filenames, output_filename):
+        """
+        Writes one cabinet with every folder and file of the cabinets of filenames
+        """
+        readers = [CabReader(filename, load_data=False) for filename in filenames]
+        for reader in readers:
+            self._check_standalone(reader)
+            if (reader.cfheader.cbCFFolder, reader.cfheader.cbCFData) != \
+                    (readers[0].cfheader.cbCFFolder, readers[0].cfheader.cbCFData):
+                raise CABException("The reserved areas of %s and %s differ" % (reader.filename, readers[0].filename))
+
+        parts = [self._get_whole_part(reader, cffolder) for reader in readers for cffolder in reader.cffolder_list]
+        self._write_cab(output_filename, self._get_cfheader(readers[0]), parts)
+
+    def _split_parts(self, reader, max_data_per_cab):
+        """
+        Returns the list of FolderPart of every new cabinet, max_data_per_cab counts
+        uncompressed bytes like the CABSet does
+        """
+        cabs = [[]]
+        size = 0
+        for cffolder in reader.cffolder_list:
+            if cffolder.typeCompress & CFFOLDER.tcompMASK_TYPE != CFFOLDER.tcompTYPE_NONE:
+                part = self._get_whole_part(reader, cffolder)
+                if size and size + part.end > max_data_per_cab:
+                    cabs.append([])
+                    size = 0
+                cabs[-1].append(part)
+                size += part.end
+                continue
+
+            parts = []
+            for cfdata in cffolder.cfdata_list:
+                if size and size + cfdata.cbUncomp > max_data_per_cab:
+                    cabs.append([])
+                    size = 0
+                if not cabs[-1] or cabs[-1][-1] not in parts:
+                    parts.append(FolderPart(reader, cffolder, start=parts[-1].end if parts else 0))
+                    cabs[-1].append(parts[-1])
+                parts[-1].add_data(cfdata)
+                size += cfdata.cbUncomp
+
+            for cffile in sorted(cffolder.cffile_list, key=lambda x: x.uoffFolderStart):
+                for part in parts:
+                    start, end = cffile.uoffFolderStart, cffile.uoffFolderStart + cffile.cbFile
+                    if (start < part.end and end > part.start) or \
+                            (cffile.cbFile == 0 and (part.start <= start < part.end or part is parts[-1])):
+                        part.cffile_list.append(cffile)
+                        if cffile.cbFile == 0:
+                            break
+
+            # When no file crosses the start of a part it is a new folder and not the
+            # continuation of the previous one, its offsets start from 0. A continuation
+            # counts them from the start of the folder in the cabinet where it began
+            for index, part in enumerate(parts):
+                if not any([cffile.uoffFolderStart < part.start for cffile in part.cffile_list]):
+                    part.base = part.start
+                elif index:
+                    part.base = parts[index - 1].base
+        return cabs
+
+    def split(self, filename, cab_name, output_dir, max_data_per_cab=1474*1024):
+        """
+        Writes the cabinet as a set, cab_name has [x] where the index goes like in the CABSet
+        :return: the filenames of the new set
+        """
+        reader = CabReader(filename, load_data=False)
+        self._check_standalone(reader)
+        cabs = self._split_parts(reader, max_data_per_cab)
+        names = [cab_name.replace("[x]", str(index)) for index in range(len(cabs))]
+
+        # The first cabinet of each file, for the szCabinetPrev of the ones it continues into
+        first_cab = {}
+        for index, parts in enumerate(cabs):
+            for part in parts:
+                for cffile in part.cffile_list:
+                    first_cab.setdefault(id(cffile), index)
+
+        for index, parts in enumerate(cabs):
+            cfheader = self._get_cfheader(reader, iCabinet=index)
+            if index > 0:
+                cfheader.flags |= CFHEADER.cfhdrPREV_CABINET
+                continued = [cffile for cffile in parts[0].cffile_list if cffile.uoffFolderStart < parts[0].start]
+                prev_index = first_cab[id(continued[0])] if continued else index - 1
+                cfheader.szCabinetPrev = CABFile.get_null_ended_string(names[prev_index])
+                cfheader.szDiskPrev = CABFile.get_null_ended_string("previous")
+            if index < len(cabs) - 1:
+                cfheader.flags |= CFHEADER.cfhdrNEXT_CABINET
+                cfheader.szCabinetNext = CABFile.get_null_ended_string(names[index + 1])
+                cfheader.szDiskNext = CABFile.get_null_ended_string("continued")
+            self._write_cab(os.path.join(output_dir, names[index]), cfheader, parts)
+        return [os.path.join(output_dir, name) for name in names]
@@ -0,0 +1,156 @@
+__author__ = 'n3k'
+
+"""
+This code reads cabinets from non-seekable streams (pipes, sockets, HTTP bodies...)
+in a single forward pass.
+"""
+
+import io
+import collections
+
+from pycab.CabReader import CabReader
+from pycab.CabWriter import CABException
+from pycab.CabStructs import CFHEADER, CFDATA
+
+
+class ForwardReader(object):
+    """
+    It wraps a file-like object or an iterable of byte chunks and exposes read(size)
+    and tell() without ever seeking backwards
+    """
+
+    def __init__(self, source, chunk_size=0x10000):
+        if hasattr(source, "read"):
+            self._chunks = iter(lambda: source.read(chunk_size), "")
+        else:
+            self._chunks = iter(source)
+        self._buffer = ""
+        self.position = 0
+
+    def read(self, size):
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while available < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            available += len(chunk)
+        data = "".join(parts)
+        self._buffer = data[size:]
+        data = data[:size]
+        self.position += len(data)
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            skipped = len(self.read(min(size, 0x10000)))
+            if skipped == 0:
+                break
+            size -= skipped
+
+    def tell(self):
+        return self.position
+
+
+class CabStreamReader(CabReader):
+    """
+    Usage:
+        cab = CabStreamReader(request.body_chunks())
+        for cffile, data in cab.iter_member_data():
+            ...
+    The tables are parsed when the instance is created, the CFDATA are consumed by
+    iter_member_data(), which emits every file as soon as its last byte arrives. Only the
+    CFDATA that hold part of a file not emitted yet are kept.
+    """
+
+    def __init__(self, source, chunk_size=0x10000):
+        self.filename = getattr(source, "name", "<stream>")
+        self.index_cache = None
+        self.load_data = False
+        self.offset = 0
+        self.positional_io = False
+        self._init_decoding()
+        self.handle = ForwardReader(source, chunk_size=chunk_size)
+
+        self.cfheader = self.read_cfheader(handle=self.handle)
+        self.cffolder_list = self.read_folders(handle=self.handle)
+        self.cffile_list = self.read_files(handle=self.handle)
+        self.cfdata_list = []
+        self._link_tables()
+
+    def _read_cfdata(self, cffolder):
+        parameters = {}
+        parameters["offset"] = self.handle.tell()
+        parameters["csum"] = self._read_dword(self.handle)
+        parameters["cbData"] = self._read_word(self.handle)
+        parameters["cbUncomp"] = self._read_word(self.handle)
+        if self.cfheader.flags & CFHEADER.cfhdrRESERVE_PRESENT:
+            parameters["abReserve"] = self.handle.read(self.cfheader.cbCFData)
+        else:
+            parameters["abReserve"] = ""
+        parameters["ab"] = self.handle.read(parameters["cbData"])
+        if len(parameters["ab"]) != parameters["cbData"]:
+            raise CABException("Unexpected end of stream")
+        cfdata = CFDATA.create_from_parameters(parameters=parameters)
+        cfdata.cffolder = cffolder
+        return cfdata
+
+    def _join_blocks(self, blocks, start, end):
+        """
+        Returns the start:end range of the folder from the (start, data) blocks
+        """
+        parts = []
+        for block_start, data in blocks:
+            block_end = block_start + len(data)
+            if block_end <= start:
+                continue
+            if block_start >= end:
+                break
+            parts.append(data[max(start - block_start, 0):end - block_start])
+        return "".join(parts)
+
+    def iter_member_data(self):
+        """
+        Yields (CFFILE, data) as soon as each file is complete. The files that are
+        not entirely in this cabinet (see CabReader.is_member_local) are skipped.
+        """
+        for cffolder in sorted(self.cffolder_list, key=lambda x: x.coffCabStart):
+            if cffolder.coffCabStart < self.handle.tell():
+                raise CABException("The CFDATA of the folders overlap, the stream can't be read forward")
+            self.handle.skip(cffolder.coffCabStart - self.handle.tell())
+
+            pending = collections.deque(sorted([cffile for cffile in cffolder.cffile_list
+                                                if self.is_member_local(cffile)],
+                                               key=lambda x: x.uoffFolderStart))
+            # (start, data) of the uncompressed CFDATA that a pending file still needs
+            blocks = collections.deque()
+            buffer_end = 0
+            for i in range(cffolder.cCFData):
+                data = self.decode_cfdata(self._read_cfdata(cffolder))
+                blocks.append((buffer_end, data))
+                buffer_end += len(data)
+
+                while pending and pending[0].uoffFolderStart + pending[0].cbFile <= buffer_end:
+                    cffile = pending.popleft()
+                    yield cffile, self._join_blocks(blocks, cffile.uoffFolderStart,
+                                                    cffile.uoffFolderStart + cffile.cbFile)
+
+                # Drop what no pending file needs anymore
+                keep_from = pending[0].uoffFolderStart if pending else buffer_end
+                while blocks and blocks[0][0] + len(blocks[0][1]) <= keep_from:
+                    blocks.popleft()
+
+            if pending:
+                raise CABException("The CFDATA of the folder end before %s" % pending[0].szName[:-1])
+
+    def iter_members(self):
+        """
+        Yields (CFFILE, stream) like CabReader.iter_members, the stream is over the
+        data of iter_member_data
+        """
+        for cffile, data in self.iter_member_data():
+            stream = io.BytesIO(data)
+            stream.name = cffile.szName[:-1] if cffile.szName.endswith("\x00") else cffile.szName
+            yield cffile, stream
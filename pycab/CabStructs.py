@@ -144,6 +144,10 @@ class CFHEADER(object):
     setID = WORDValue()
     iCabinet = WORDValue()
 
+    # Precompiled layouts of the fixed part and of the reserve sizes
+    STRUCT = struct.Struct("<4sIIIIIBBHHHHH")
+    RESERVE_STRUCT = struct.Struct("<HBB")
+
     # From this point, the fields are optional
     cbCFHeader = WORDValue()
     cbCFFolder = BYTEValue()
@@ -265,37 +269,48 @@ class CFHEADER(object):
         cffolder.cfheader.cFolders += 1
         self.cffolder_list.append(cffolder)
 
-    def __repr__(self):
-        data = ""
-        data += self.signature
-        data += struct.pack("<I", self.reserved1)
-        data += struct.pack("<I", self.cbCabinet)
-        data += struct.pack("<I", self.reserved2)
-        data += struct.pack("<I", self.coffFiles)
-        data += struct.pack("<I", self.reserved3)
-        data += struct.pack("<B", self.versionMinor)
-        data += struct.pack("<B", self.versionMajor)
-        data += struct.pack("<H", self.cFolders)
-        data += struct.pack("<H", self.cFiles)
-        data += struct.pack("<H", self.flags)
-        data += struct.pack("<H", self.setID)
-        data += struct.pack("<H", self.iCabinet)
-
-        if self.flags & self.cfhdrRESERVE_PRESENT:
-            data += struct.pack("<H", self.cbCFHeader)
-            data += struct.pack("<B", self.cbCFFolder)
-            data += struct.pack("<B", self.cbCFData)
-            data += self.abReserve
-
-        if self.flags & self.cfhdrPREV_CABINET:
-            data += self.szCabinetPrev
-            data += self.szDiskPrev
+    def get_packed_size(self):
+        """
+        Size of the CFHEADER as it is written, the optional fields depend on the flags
+        """
+        flags = self.flags
+        size = self.STRUCT.size
+        if flags & self.cfhdrRESERVE_PRESENT:
+            size += self.RESERVE_STRUCT.size + len(self.abReserve)
+        if flags & self.cfhdrPREV_CABINET:
+            size += len(self.szCabinetPrev) + len(self.szDiskPrev)
+        if flags & self.cfhdrNEXT_CABINET:
+            size += len(self.szCabinetNext) + len(self.szDiskNext)
+        return size
 
-        if self.flags & self.cfhdrNEXT_CABINET:
-            data += self.szCabinetNext
-            data += self.szDiskNext
+    def pack_into(self, buffer, offset):
+        """
+        Writes the CFHEADER into the bytearray buffer at offset
+        :return: the offset after it
+        """
+        flags = self.flags
+        self.STRUCT.pack_into(buffer, offset, self.signature, self.reserved1, self.cbCabinet, self.reserved2,
+                              self.coffFiles, self.reserved3, self.versionMinor, self.versionMajor, self.cFolders,
+                              self.cFiles, flags, self.setID, self.iCabinet)
+        offset += self.STRUCT.size
+        fields = []
+        if flags & self.cfhdrRESERVE_PRESENT:
+            self.RESERVE_STRUCT.pack_into(buffer, offset, self.cbCFHeader, self.cbCFFolder, self.cbCFData)
+            offset += self.RESERVE_STRUCT.size
+            fields.append(self.abReserve)
+        if flags & self.cfhdrPREV_CABINET:
+            fields.extend([self.szCabinetPrev, self.szDiskPrev])
+        if flags & self.cfhdrNEXT_CABINET:
+            fields.extend([self.szCabinetNext, self.szDiskNext])
+        for field in fields:
+            buffer[offset:offset + len(field)] = field
+            offset += len(field)
+        return offset
 
-        return data
+    def __repr__(self):
+        buffer = bytearray(self.get_packed_size())
+        self.pack_into(buffer, 0)
+        return str(buffer)
 
     def __str__(self):
         data = "\nCFHEADER\n"
@@ -426,6 +441,8 @@ class CFFOLDER(object):
     tcompTYPE_QUANTUM       = 0x0002    # Quantum
     tcompTYPE_LZX           = 0x0003    # LZX
 
+    STRUCT = struct.Struct("<IHH")
+
     # Absolute file offset of first CFDATA block for THIS folder
     coffCabStart = DWORDValue()
     cCFData = WORDValue()
@@ -496,13 +513,19 @@ class CFFOLDER(object):
         #print "len of cffolder: %d" % result
         return result
 
+    def pack_into(self, buffer, offset):
+        """
+        Writes the CFFOLDER into the bytearray buffer at offset
+        :return: the offset after it
+        """
+        self.STRUCT.pack_into(buffer, offset, self.coffCabStart, self.cCFData, self.typeCompress)
+        offset += self.STRUCT.size
+        abReserve = self.abReserve
+        buffer[offset:offset + len(abReserve)] = abReserve
+        return offset + len(abReserve)
+
     def __repr__(self):
-        data = ""
-        data += struct.pack("<I", self.coffCabStart)
-        data += struct.pack("<H", self.cCFData)
-        data += struct.pack("<H", self.typeCompress)
-        data += self.abReserve
-        return data
+        return self.STRUCT.pack(self.coffCabStart, self.cCFData, self.typeCompress) + self.abReserve
 
     def __str__(self):
         data = "\nCFFOLDER\n"
@@ -550,6 +573,8 @@ class CFFILE(object):
     _A_EXEC         = 0x40  # run after extraction
     _A_NAME_IS_UTF  = 0x80  # szName[] contains UTF
 
+    STRUCT = struct.Struct("<IIHHHH")
+
     cbFile = DWORDValue()
     uoffFolderStart = DWORDValue()
     iFolder = WORDValue()
@@ -614,21 +639,33 @@ class CFFILE(object):
             CFFILE.ifoldCONTINUED_PREV_AND_NEXT
         ]
 
+    def get_date_time(self):
+        """
+        Returns (year, month, day, hour, minute, second) of the date and time fields
+        """
+        return ((self.date >> 9) + 1980, (self.date >> 5) & 0x0F, self.date & 0x1F,
+                self.time >> 11, (self.time >> 5) & 0x3F, (self.time & 0x1F) * 2)
+
     def __len__(self):
         result = 4 + 4 + 2 + 2 + 2 + 2 + len(self.szName)
         #print "len of cffile: %d" % result
         return result
 
+    def pack_into(self, buffer, offset):
+        """
+        Writes the CFFILE into the bytearray buffer at offset
+        :return: the offset after it
+        """
+        self.STRUCT.pack_into(buffer, offset, self.cbFile, self.uoffFolderStart, self.iFolder, self.date,
+                              self.time, self.attribs)
+        offset += self.STRUCT.size
+        szName = self.szName
+        buffer[offset:offset + len(szName)] = szName
+        return offset + len(szName)
+
     def __repr__(self):
-        data = ""
-        data += struct.pack("<I", self.cbFile)
-        data += struct.pack("<I", self.uoffFolderStart)
-        data += struct.pack("<H", self.iFolder)
-        data += struct.pack("<H", self.date)
-        data += struct.pack("<H", self.time)
-        data += struct.pack("<H", self.attribs)
-        data += self.szName
-        return data
+        return self.STRUCT.pack(self.cbFile, self.uoffFolderStart, self.iFolder, self.date, self.time,
+                                self.attribs) + self.szName
 
     def __str__(self):
         data = "\nCFFILE\n"
@@ -654,6 +691,8 @@ class CFDATA(object):
     };
     """
 
+    STRUCT = struct.Struct("<IHH")
+
     csum = DWORDValue()
     cbData = WORDValue()
     cbUncomp = WORDValue()
@@ -667,13 +706,35 @@ class CFDATA(object):
 
     @property
     def ab(self):
+        if self.loader is not None:
+            # The payload was not read yet, ask the reader for it
+            self.loader(self)
         return self._ab
     @ab.setter
     def ab(self, value):
         self._ab = value
 
+    # This is extra metadata for helping in the reading of cab files
+    # it isn´t used in the specification
+    @property
+    def offset(self):
+        """Absolute file offset of this CFDATA entry"""
+        return self._offset
+    @offset.setter
+    def offset(self, value):
+        self._offset = value
+
+    def get_data_offset(self):
+        """
+        Absolute file offset of the payload (ab) of this CFDATA entry
+        """
+        return self.offset + self.STRUCT.size + len(self.abReserve)
+
     def __init__(self, cffolder=None, data=""):
         self.cffolder = cffolder
+        # A callable that fills the payload on demand, see CabReader
+        self.loader = None
+        self.offset = 0
 
         self.csum = 0x00000000
 
@@ -706,6 +767,7 @@ class CFDATA(object):
         instance.cbUncomp = parameters["cbUncomp"]
         instance.abReserve = parameters["abReserve"]
         instance.ab = parameters["ab"]
+        instance.offset = parameters.get("offset", 0)
         return instance
 
     def __len__(self):
@@ -713,14 +775,14 @@ class CFDATA(object):
         #print "len of cfdata %d\n" % result
         return result
 
+    def get_header(self):
+        """
+        The CFDATA without its payload
+        """
+        return self.STRUCT.pack(self.csum, self.cbData, self.cbUncomp) + self.abReserve
+
     def __repr__(self):
-        data = ""
-        data += struct.pack("<I", self.csum)
-        data += struct.pack("<H", self.cbData)
-        data += struct.pack("<H", self.cbUncomp)
-        data += self.abReserve
-        data += self.ab
-        return data
+        return self.get_header() + self.ab
 
     def __str__(self):
         data = "\nCFDATA\n"
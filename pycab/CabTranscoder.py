@@ -0,0 +1,200 @@
+__author__ = 'n3k'
+
+"""
+Recompression of cabinets (for example from NONE to MSZIP) straight from the CFDATA of
+the source into the new cabinets, without extracting the files.
+"""
+
+import Queue
+import threading
+
+from pycab.CabReader import CabReader
+from pycab.CabManager import CABManager
+from pycab.CabWriter import CABFolderUnit, CABException
+from pycab.CabStructs import CFFOLDER
+from pycab.CabCompression import get_decoder
+
+
+class FolderDecoder(threading.Thread):
+    """
+    Decodes the CFDATA of one folder in a thread, the uncompressed blocks wait in a
+    bounded queue until they are read
+    """
+
+    def __init__(self, blocks, buffer_blocks):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.blocks = blocks
+        self.queue = Queue.Queue(maxsize=buffer_blocks)
+        self.stopped = threading.Event()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(self):
+        handles = {}
+        try:
+            decoder = None
+            for pieces, cbUncomp in CabReader.get_folder_blocks(self.blocks):
+                parts = []
+                for reader, cfdata in pieces:
+                    if reader.filename not in handles:
+                        handles[reader.filename] = open(reader.filename, "rb")
+                    handle = handles[reader.filename]
+                    handle.seek(cfdata.get_data_offset())
+                    parts.append(handle.read(cfdata.cbData))
+
+                if decoder is None:
+                    decoder = get_decoder(cfdata.cffolder.typeCompress)
+                    if decoder is None:
+                        raise CABException("Compression type %04x is not supported" % cfdata.cffolder.typeCompress)
+                if not self._put(decoder.decode("".join(parts))):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FolderStream(object):
+    """
+    Forward only reader over the uncompressed data of a folder
+    """
+
+    def __init__(self, folder_decoder):
+        self.folder_decoder = folder_decoder
+        self.position = 0
+        self._buffer = ""
+        self._finished = False
+
+    def _fill(self):
+        if self._finished:
+            return False
+        item = self.folder_decoder.queue.get()
+        if item is None:
+            self._finished = True
+            return False
+        if isinstance(item, Exception):
+            self._finished = True
+            raise item
+        self._buffer += item
+        return True
+
+    def read(self, size):
+        while len(self._buffer) < size and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.position += len(data)
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            skipped = len(self.read(min(size, 0x10000)))
+            if skipped == 0:
+                break
+            size -= skipped
+
+
+class FolderReader(object):
+    """
+    The streams of the folders of a set (see CabReader.get_set_folders). When the
+    stream of a folder is requested the next workers - 1 folders start decoding too.
+    """
+
+    def __init__(self, folders, workers=1, buffer_blocks=32):
+        self.folders = folders
+        self.workers = workers
+        self.buffer_blocks = buffer_blocks
+        self._decoders = {}
+        self._streams = {}
+
+    def get_stream(self, folder_index):
+        for index in range(folder_index, min(folder_index + max(self.workers, 1), len(self.folders))):
+            if index not in self._decoders:
+                self._decoders[index] = FolderDecoder(self.folders[index][0], self.buffer_blocks)
+                self._decoders[index].start()
+                self._streams[index] = FolderStream(self._decoders[index])
+        return self._streams[folder_index]
+
+    def stop(self):
+        for folder_decoder in self._decoders.values():
+            folder_decoder.stop()
+
+
+class MemberSource(object):
+    """
+    The data of a file, read from the stream of its folder. The files of a folder
+    must be read in the order of their uoffFolderStart.
+    """
+
+    def __init__(self, folder_reader, folder_index, cffile):
+        self.folder_reader = folder_reader
+        self.folder_index = folder_index
+        self.cffile = cffile
+        self.started = False
+
+    def read(self, size):
+        stream = self.folder_reader.get_stream(self.folder_index)
+        if not self.started:
+            if stream.position > self.cffile.uoffFolderStart:
+                raise CABException("%s overlaps the previous file of its folder" % self.cffile.szName[:-1])
+            stream.skip(self.cffile.uoffFolderStart - stream.position)
+            self.started = True
+        return stream.read(min(size, self.cffile.uoffFolderStart + self.cffile.cbFile - stream.position))
+
+
+class CabTranscoder(object):
+    """
+    Usage:
+        CabTranscoder(compression=CFFOLDER.tcompTYPE_MSZIP, workers=4).transcode(
+            ["in_0.cab", "in_1.cab"], "out_[x].cab", "/output/dir")
+    Every folder of the source becomes a folder of the new set and its files keep their
+    names, dates and attributes. The folders are decoded by threads, up to workers folders
+    ahead of the one being written, each holding at most buffer_blocks uncompressed CFDATA.
+    The new cabinets are written as soon as they are complete.
+    """
+
+    def __init__(self, compression=CFFOLDER.tcompTYPE_MSZIP, workers=2, buffer_blocks=32):
+        self.compression = compression
+        self.workers = workers
+        self.buffer_blocks = buffer_blocks
+
+    def transcode(self, filenames, cab_name, output_dir, cab_size=1474*1024, cfdata_size=0x8000):
+        """
+        filenames is the cabinet or the list of cabinets of the set to transcode
+        :return: the list of CABFile of the new set, already written in output_dir
+        """
+        if isinstance(filenames, basestring):
+            filenames = [filenames]
+        readers = [CabReader(filename, load_data=False) for filename in filenames]
+        folder_reader = FolderReader(CabReader.get_set_folders(readers), workers=self.workers,
+                                     buffer_blocks=self.buffer_blocks)
+
+        cab_folders = []
+        for folder_index, (blocks, cffile_list) in enumerate(folder_reader.folders):
+            folder_unit = CABFolderUnit(name="folder_%d" % folder_index)
+            folder_unit.compression = self.compression
+            for cffile in sorted(cffile_list, key=lambda x: x.uoffFolderStart):
+                folder_unit.add_source(cffile.szName[:-1], MemberSource(folder_reader, folder_index, cffile),
+                                       size=cffile.cbFile, date=cffile.date, time=cffile.time,
+                                       attribs=cffile.attribs)
+            cab_folders.append(folder_unit)
+
+        manager = CABManager()
+        try:
+            manager.create_cab(cab_folders=cab_folders, cab_size=cab_size, cab_name=cab_name,
+                               output_dir=output_dir, cfdata_size=cfdata_size, workers=self.workers)
+        finally:
+            folder_reader.stop()
+        return manager.cab_set.cab_files
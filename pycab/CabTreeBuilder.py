@@ -0,0 +1,138 @@
+__author__ = 'n3k'
+
+"""
+Input of the writer from a directory tree. The tree is walked once and the size, date,
+time and attributes of every file come from that walk, the writer doesn't stat or size
+the files again.
+"""
+
+import os
+import stat
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from pycab.CabWriter import CABFolderUnit, CABPathSource, CABException
+from pycab.CabStructs import CFFILE
+
+
+def get_dos_date_time(mtime):
+    """
+    Returns the (date, time) fields of a CFFILE for the timestamp mtime, in local time
+    like the ones written by the CFFILE constructor
+    """
+    date_time = time.localtime(mtime)
+    if date_time.tm_year < 1980:
+        return (1 << 5) + 1, 0
+    year = min(date_time.tm_year, 1980 + 0x7F)
+    return ((year - 1980) << 9) + (date_time.tm_mon << 5) + date_time.tm_mday, \
+           (date_time.tm_hour << 11) + (date_time.tm_min << 5) + min(date_time.tm_sec, 59) // 2
+
+
+class CabTreeBuilder(object):
+    """
+    Usage:
+        folder_unit = CabTreeBuilder("/src/driver").build(name="driver")
+        CABManager().create_cab(cab_folders=[folder_unit], cab_name="driver_[x].cab", output_dir="/out")
+    Every regular file under root goes into the folder with its path relative to root as
+    szName, with "\\" separators. Symbolic links and special files are skipped. The files
+    of a directory go before its subdirectories and both are sorted by name, so the same
+    tree always gives the same cabinet.
+    A directory or entry that can't be read stops the walk with a CABException, or with
+    skip_errors=True it is left out and its (path, message) goes into errors.
+    """
+
+    def __init__(self, root, hidden=True, skip_errors=False):
+        """
+        hidden=False leaves out the files and directories whose name starts with a dot
+        """
+        if not os.path.isdir(root):
+            raise CABException("%s is not a directory" % root)
+        self.root = root
+        self.hidden = hidden
+        self.skip_errors = skip_errors
+        self.errors = []
+
+    def _wanted(self, name):
+        return self.hidden or not name.startswith(".")
+
+    def _on_error(self, path, error):
+        if not self.skip_errors:
+            raise CABException("Can't read %s: %s" % (path, error))
+        self.errors.append((path, str(error)))
+
+    def _list_directory(self, path):
+        """
+        Returns the sorted (name, path, stat) of the entries of the directory, the stat
+        doesn't follow symbolic links
+        """
+        entries = []
+        try:
+            if scandir is None:
+                listing = [(name, os.path.join(path, name)) for name in os.listdir(path) if self._wanted(name)]
+            else:
+                listing = [(entry.name, entry) for entry in scandir(path) if self._wanted(entry.name)]
+        except OSError as e:
+            self._on_error(path, e)
+            return entries
+        for name, entry in listing:
+            try:
+                if scandir is None:
+                    entries.append((name, entry, os.lstat(entry)))
+                else:
+                    entries.append((name, entry.path, entry.stat(follow_symlinks=False)))
+            except OSError as e:
+                self._on_error(entry if scandir is None else entry.path, e)
+        return sorted(entries, key=lambda x: x[0])
+
+    def _get_name(self, relative_parts):
+        name = "\\".join(relative_parts)
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return name
+
+    def _get_attribs(self, name, st):
+        attribs = CFFILE._A_ARCH
+        if not st.st_mode & stat.S_IWUSR:
+            attribs |= CFFILE._A_RDONLY
+        if name.startswith("."):
+            attribs |= CFFILE._A_HIDDEN
+        return attribs
+
+    def iter_sources(self):
+        """
+        Yields the CABPathSource of every file of the tree
+        """
+        pending = [(self.root, ())]
+        while pending:
+            path, relative_parts = pending.pop()
+            directories = []
+            for name, entry_path, st in self._list_directory(path):
+                if stat.S_ISDIR(st.st_mode):
+                    directories.append((entry_path, relative_parts + (name,)))
+                elif stat.S_ISREG(st.st_mode):
+                    szName = self._get_name(relative_parts + (name,))
+                    attribs = self._get_attribs(name, st)
+                    try:
+                        szName.decode("ascii")
+                    except UnicodeDecodeError:
+                        attribs |= CFFILE._A_NAME_IS_UTF
+                    date, dos_time = get_dos_date_time(st.st_mtime)
+                    yield CABPathSource(name=szName, path=entry_path, size=st.st_size,
+                                        date=date, time=dos_time, attribs=attribs)
+            pending.extend(reversed(directories))
+
+    def build(self, name="folder", compression=None):
+        """
+        Returns a CABFolderUnit with every file of the tree, compression is the one
+        of the folder (None takes the one of the CABManager)
+        """
+        folder_unit = CABFolderUnit(name=name, filename_list=list(self.iter_sources()))
+        folder_unit.compression = compression
+        return folder_unit
@@ -0,0 +1,285 @@
+__author__ = 'n3k'
+
+"""
+Structural validation (fsck) of cabinets and cabinet sets without extracting them.
+"""
+
+import os
+import struct
+from multiprocessing import Pool
+
+from pycab.CabReader import CabReader
+from pycab.CabStructs import CFHEADER, CFFILE, CFDATA
+from pycab.Utils import Utils
+from pycab.CabCompression import get_decoder
+
+
+def get_cfdata_checksum(cfdata, ab):
+    """
+    Returns the csum that a CFDATA with the payload ab must have
+    """
+    csum = Utils.cab_checksum(ab)
+    return Utils.cab_checksum(struct.pack("<HH", cfdata.cbData, cfdata.cbUncomp) + cfdata.abReserve, csum)
+
+
+def _check_folder(args):
+    """
+    Deep check of one folder: the csum of every CFDATA and the decompression of its blocks.
+    filename and folder say where the folder starts. blocks is the list of (pieces, cbUncomp)
+    of CabReader.get_folder_blocks with (filename, where, offset of the payload, csum, cbData,
+    cbUncomp, abReserve) pieces. decode=False only checks the csum, for a folder whose
+    history is in a previous cabinet.
+    :return: the list of problems found
+    """
+    filename, folder, typeCompress, blocks, decode = args
+    problems = []
+    handles = {}
+    decoder = None
+    if decode:
+        decoder = get_decoder(typeCompress)
+        if decoder is None:
+            problems.append((filename, "%s: compression type %04x is not supported" % (folder, typeCompress)))
+    try:
+        for i, (pieces, cbUncomp) in enumerate(blocks):
+            parts = []
+            for piece_filename, piece_where, offset, csum, cbData, piece_cbUncomp, abReserve in pieces:
+                if piece_filename not in handles:
+                    handles[piece_filename] = open(piece_filename, "rb")
+                handles[piece_filename].seek(offset)
+                ab = handles[piece_filename].read(cbData)
+                if len(ab) != cbData:
+                    problems.append((piece_filename, "%s: the data is truncated" % piece_where))
+                    return problems
+                cfdata = CFDATA.create_from_parameters(parameters={
+                    "csum": csum,
+                    "cbData": cbData,
+                    "cbUncomp": piece_cbUncomp,
+                    "abReserve": abReserve,
+                    "ab": ab
+                })
+                if csum != 0 and csum != get_cfdata_checksum(cfdata, ab):
+                    problems.append((piece_filename, "%s: csum %08x doesn't match the data (%08x)" %
+                                     (piece_where, csum, get_cfdata_checksum(cfdata, ab))))
+                parts.append(ab)
+            # The problems of the whole block are reported where it starts
+            block_filename, block_where = pieces[0][:2]
+            # The last CFDATA of a folder continued in a next cabinet that isn't checked
+            # with it has cbUncomp 0 and only the first part of the data
+            if decoder is None or (cbUncomp == 0 and i == len(blocks) - 1):
+                continue
+            try:
+                data = decoder.decode("".join(parts))
+            except Exception as e:
+                problems.append((block_filename, "%s: %s" % (block_where, e)))
+                continue
+            if len(data) != cbUncomp:
+                problems.append((block_filename, "%s: it decodes to %d bytes instead of cbUncomp %d" %
+                                 (block_where, len(data), cbUncomp)))
+    except Exception as e:
+        problems.append((filename, "%s: %s" % (folder, e)))
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return problems
+
+
+class CabValidator(object):
+    """
+    Usage:
+        problems = CabValidator().check("file.cab")
+        problems = CabValidator(deep=True, workers=4).check_set(["a.cab", "b.cab"])
+    Every problem is a tuple (filename, message) and all of them are reported, not only
+    the first one. The default checks only read the CFHEADER, the tables and the CFDATA
+    headers. deep=True also verifies the csum and the decompression of every CFDATA,
+    one CFFOLDER per task in a pool of processes.
+    """
+
+    def __init__(self, deep=False, workers=1):
+        self.deep = deep
+        self.workers = workers
+
+    def _check_metadata(self, filename, offset=0):
+        """
+        Returns the reader (None if the tables can't be parsed) and the problems found
+        """
+        problems = []
+        try:
+            reader = CabReader(filename, load_data=False, offset=offset)
+        except Exception as e:
+            # The CFDATA headers may be what is broken, try with the tables alone
+            try:
+                reader = CabReader.probe(filename, tables=True, offset=offset)
+            except Exception:
+                return None, [(filename, "It can't be parsed: %s" % (str(e) or e.__class__.__name__))]
+            problems.append("The CFDATA headers can't be read: %s" % (str(e) or e.__class__.__name__))
+
+        cfheader = reader.cfheader
+        file_size = os.path.getsize(filename) - offset
+        if cfheader.versionMajor != 0x01 or cfheader.versionMinor != 0x03:
+            problems.append("Unknown version %d.%d" % (cfheader.versionMajor, cfheader.versionMinor))
+        if cfheader.flags & ~(CFHEADER.cfhdrPREV_CABINET | CFHEADER.cfhdrNEXT_CABINET |
+                              CFHEADER.cfhdrRESERVE_PRESENT):
+            problems.append("Unknown flags %04x" % cfheader.flags)
+        if cfheader.cbCabinet > file_size:
+            problems.append("cbCabinet %d is bigger than the file (%d bytes)" % (cfheader.cbCabinet, file_size))
+        elif offset == 0 and cfheader.cbCabinet < file_size:
+            problems.append("There are %d bytes after cbCabinet" % (file_size - cfheader.cbCabinet))
+
+        files_start = cfheader.get_packed_size() + sum([len(cffolder) for cffolder in reader.cffolder_list])
+        if cfheader.coffFiles != files_start:
+            problems.append("coffFiles %08x should be %08x" % (cfheader.coffFiles, files_start))
+        data_start = files_start + sum([len(cffile) for cffile in reader.cffile_list])
+
+        # The CFDATA of each folder go right after the ones of the previous folder
+        folder_sizes = []
+        for folder_index, cffolder in enumerate(reader.cffolder_list):
+            where = "CFFOLDER %d" % folder_index
+            if cffolder.coffCabStart != data_start:
+                problems.append("%s: coffCabStart %08x should be %08x" % (where, cffolder.coffCabStart, data_start))
+            if cffolder.cCFData == 0:
+                problems.append("%s: it has no CFDATA" % where)
+            data_start = cffolder.coffCabStart
+            for cfdata in cffolder.cfdata_list:
+                data_start += 8 + len(cfdata.abReserve) + cfdata.cbData
+                if cfdata.cbUncomp > 0x8000:
+                    problems.append("%s: a CFDATA has cbUncomp %04x" % (where, cfdata.cbUncomp))
+            folder_sizes.append(sum([cfdata.cbUncomp for cfdata in cffolder.cfdata_list]))
+        if reader.cfdata_list and data_start != cfheader.cbCabinet:
+            problems.append("The CFDATA end at %08x but cbCabinet is %08x" % (data_start, cfheader.cbCabinet))
+        if len(reader.cfdata_list) != sum([cffolder.cCFData for cffolder in reader.cffolder_list]):
+            problems.append("The sum of cCFData doesn't match the number of CFDATA")
+
+        if cfheader.cFiles == 0:
+            problems.append("It has no CFFILE")
+        # The uoffFolderStart of a folder continued from a previous cabinet count from
+        # the start of the folder in the first cabinet
+        continued = any([cffile.iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV, CFFILE.ifoldCONTINUED_PREV_AND_NEXT)
+                         for cffile in reader.cffile_list])
+        for cffile in reader.cffile_list:
+            where = "CFFILE %s" % cffile.szName[:-1]
+            if cffile.iFolder < cfheader.cFolders and not (continued and cffile.iFolder == 0):
+                end = cffile.uoffFolderStart + cffile.cbFile
+                if reader.cfdata_list and end > folder_sizes[cffile.iFolder]:
+                    problems.append("%s: it ends at %d but its folder has %d bytes" %
+                                    (where, end, folder_sizes[cffile.iFolder]))
+            elif cffile.iFolder not in CFFILE.get_iFolder_options():
+                problems.append("%s: iFolder %d doesn't exist" % (where, cffile.iFolder))
+            if cffile.iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV, CFFILE.ifoldCONTINUED_PREV_AND_NEXT) and \
+                    not cfheader.flags & CFHEADER.cfhdrPREV_CABINET:
+                problems.append("%s: it is continued from a previous cabinet but there is none" % where)
+            if cffile.iFolder in (CFFILE.ifoldCONTINUED_TO_NEXT, CFFILE.ifoldCONTINUED_PREV_AND_NEXT) and \
+                    not cfheader.flags & CFHEADER.cfhdrNEXT_CABINET:
+                problems.append("%s: it is continued in a next cabinet but there is none" % where)
+            if len(cffile.szName) < 2:
+                problems.append("CFFILE with an empty name")
+
+        return reader, [(filename, problem) for problem in problems]
+
+    def _check_links(self, readers):
+        """
+        Checks that the cabinets of readers form a set, in that order
+        """
+        problems = []
+        for i, reader in enumerate(readers):
+            cfheader = reader.cfheader
+            if cfheader.setID != readers[0].cfheader.setID:
+                problems.append((reader.filename, "setID %04x differs from the first cabinet" % cfheader.setID))
+            if cfheader.iCabinet != readers[0].cfheader.iCabinet + i:
+                problems.append((reader.filename, "iCabinet %d is out of sequence" % cfheader.iCabinet))
+
+            has_prev = bool(cfheader.flags & CFHEADER.cfhdrPREV_CABINET)
+            if has_prev != (i > 0):
+                problems.append((reader.filename, "The previous cabinet flag is %s" % ("set" if has_prev else "missing")))
+            # szCabinetPrev names the cabinet where the first file of this one starts,
+            # which isn't the immediately previous one when that file spans several cabinets
+            elif has_prev and cfheader.szCabinetPrev[:-1] not in \
+                    [os.path.basename(prev.filename) for prev in readers[:i]]:
+                problems.append((reader.filename, "szCabinetPrev is %s" % cfheader.szCabinetPrev[:-1]))
+
+            has_next = bool(cfheader.flags & CFHEADER.cfhdrNEXT_CABINET)
+            if has_next != (i < len(readers) - 1):
+                problems.append((reader.filename, "The next cabinet flag is %s" % ("set" if has_next else "missing")))
+            elif has_next and cfheader.szCabinetNext[:-1] != os.path.basename(readers[i+1].filename):
+                problems.append((reader.filename, "szCabinetNext is %s" % cfheader.szCabinetNext[:-1]))
+        return problems
+
+    def _get_folder_task(self, blocks, decode=True):
+        """
+        Returns the task of _check_folder for the (reader, CFDATA) blocks of a folder
+        """
+        folder_blocks = []
+        # (filename, folder_id) -> index of the next CFDATA of that folder
+        positions = {}
+        for pieces, cbUncomp in CabReader.get_folder_blocks(blocks):
+            task_pieces = []
+            for reader, cfdata in pieces:
+                key = (reader.filename, cfdata.cffolder.folder_id)
+                index = positions.get(key, 0)
+                positions[key] = index + 1
+                task_pieces.append((reader.filename, "CFFOLDER %d CFDATA %d" % (key[1], index),
+                                    cfdata.get_data_offset(), cfdata.csum, cfdata.cbData, cfdata.cbUncomp,
+                                    cfdata.abReserve))
+            folder_blocks.append((task_pieces, cbUncomp))
+        reader, cfdata = blocks[0]
+        return reader.filename, "CFFOLDER %d" % cfdata.cffolder.folder_id, cfdata.cffolder.typeCompress, \
+            folder_blocks, decode
+
+    def _get_cab_tasks(self, reader):
+        """
+        Returns the tasks of the folders of one cabinet checked on its own. The decoding of
+        a folder continued from a previous cabinet needs the history of that cabinet, only
+        the csum of its CFDATA are checked.
+        """
+        continued = reader.cfheader.flags & CFHEADER.cfhdrPREV_CABINET and \
+            any([cffile.iFolder in (CFFILE.ifoldCONTINUED_FROM_PREV, CFFILE.ifoldCONTINUED_PREV_AND_NEXT)
+                 for cffile in reader.cffile_list])
+        return [self._get_folder_task([(reader, cfdata) for cfdata in cffolder.cfdata_list],
+                                      decode=not (continued and i == 0))
+                for i, cffolder in enumerate(reader.cffolder_list) if cffolder.cfdata_list]
+
+    def _check_deep(self, tasks):
+        problems = []
+        if self.workers > 1 and len(tasks) > 1:
+            pool = Pool(self.workers)
+            try:
+                for result in pool.imap(_check_folder, tasks):
+                    problems.extend(result)
+            finally:
+                pool.terminate()
+        else:
+            for task in tasks:
+                problems.extend(_check_folder(task))
+        return problems
+
+    def check(self, filename, offset=0):
+        """
+        :return: the list of (filename, message) problems of the cabinet, empty if it is valid
+        """
+        reader, problems = self._check_metadata(filename, offset=offset)
+        if self.deep and reader is not None:
+            problems.extend(self._check_deep(self._get_cab_tasks(reader)))
+        return problems
+
+    def check_set(self, filenames):
+        """
+        Checks every cabinet of the set and the links between them. The deep checks decode
+        the folders continued between cabinets as a whole, see CabReader.get_set_folders.
+        :return: the list of (filename, message) problems, empty if the set is valid
+        """
+        readers = []
+        problems = []
+        for filename in filenames:
+            reader, cab_problems = self._check_metadata(filename)
+            problems.extend(cab_problems)
+            if reader is not None:
+                readers.append(reader)
+        if len(readers) == len(filenames):
+            problems.extend(self._check_links(readers))
+        if self.deep:
+            if len(readers) == len(filenames):
+                tasks = [self._get_folder_task(blocks) for blocks, cffile_list in CabReader.get_set_folders(readers)
+                         if blocks]
+            else:
+                tasks = [task for reader in readers for task in self._get_cab_tasks(reader)]
+            problems.extend(self._check_deep(tasks))
+        return problems
@@ -5,27 +5,82 @@ This code attemps to create valid .CAB SET files.
 """
 
 import os
-from itertools import groupby
+from multiprocessing.pool import ThreadPool
 
 from Utils import Utils
 from pycab.CabStructs import CABFileFormat, CFHEADER, CFFOLDER, CFFILE, CFDATA
+from pycab.CabCompression import get_encoder
 
 
 class CABException(Exception):
     pass
 
+class CABFileSource(object):
+    """
+    A file to put in a cab whose data is not on disk.
+    source can be a str, a bytearray, a memoryview, a readable file object or an iterable of str chunks;
+    size is required for the iterables and optional for the rest
+    date, time and attribs are the values for the CFFILE, None keeps the defaults
+    """
+
+    def __init__(self, name, source, size=None, date=None, time=None, attribs=None):
+        self.name = name
+        self.source = source
+        self.date = date
+        self.time = time
+        self.attribs = attribs
+
+        if size is None:
+            if isinstance(source, (str, bytearray, memoryview)):
+                size = len(source)
+            elif hasattr(source, "read") and hasattr(source, "seek"):
+                position = source.tell()
+                source.seek(0, 2)
+                size = source.tell() - position
+                source.seek(position, 0)
+            else:
+                raise CABException("The size of %s must be declared" % name)
+        self.size = size
+
+
+class CABPathSource(CABFileSource):
+    """
+    A file on disk whose size, date, time and attributes are already known (see CabTreeBuilder),
+    so it is not sized again. name is its szName, the file is opened when its data is written.
+    """
+
+    def __init__(self, name, path, size, date=None, time=None, attribs=None):
+        super(CABPathSource, self).__init__(name=name, source=None, size=size, date=date, time=time, attribs=attribs)
+        self.path = path
+
+
 class CABFolderUnit(object):
 
-    def __init__(self, name="", filename_list=[]):
-        self.filename_list = filename_list
+    def __init__(self, name="", filename_list=None):
+        # Every element is either a path on disk or a CABFileSource
+        self.filename_list = filename_list if filename_list is not None else []
         self.name = name
         self.compression = None
         # There is a one to one relation between elements in filedata_list and elements in filename_list
         self.filedata_list = []
 
+    def add_source(self, name, source, size=None, date=None, time=None, attribs=None):
+        """
+        Adds a file whose data comes from memory, a file object or a generator
+        """
+        self.filename_list.append(CABFileSource(name=name, source=source, size=size,
+                                                date=date, time=time, attribs=attribs))
+
+    @classmethod
+    def get_member_name(cls, entry):
+        if isinstance(entry, CABFileSource):
+            return entry.name
+        return os.path.basename(entry)
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return set(os.path.basename(_) for _ in self.filename_list) & set(os.path.basename(_) for _ in other.filename_list) == set(os.path.basename(_) for _ in self.filename_list)
+            names = set(self.get_member_name(_) for _ in self.filename_list)
+            return names & set(self.get_member_name(_) for _ in other.filename_list) == names
         else:
             return False
 
@@ -34,6 +89,16 @@ class CABFolderUnit(object):
 
 class CABFile(CABFileFormat):
 
+    # Limits of the WORD and DWORD fields of the specification
+    MAX_FILES = 0xFFFF
+    MAX_FOLDERS = 0xFFFF
+    MAX_CFDATA = 0xFFFF
+    MAX_CABINET = 0xFFFFFFFF
+    # Max uncompressed bytes of a CFFOLDER
+    MAX_FOLDER_DATA = 0x7FFF8000
+    # Size of a CFFILE with the longest name allowed
+    MAX_CFFILE_SIZE = 16 + 256
+
     @property
     def slack(self):
         return self.max_data - self.size
@@ -45,6 +110,26 @@ class CABFile(CABFileFormat):
         self.cabset = parameters.get("cabset", None)
         self.size = 0
 
+        # Max uncompressed bytes per CFDATA, 0x8000 is the max allowed by the specification
+        self.cfdata_size = parameters.get("cfdata_size", 0x8000)
+        if not 0 < self.cfdata_size <= 0x8000:
+            raise CABException("The CFDATA size must be between 1 and 0x8000 bytes")
+        # A new CFFOLDER is started when a file would make the current one hold
+        # more uncompressed bytes than this, 0 means no limit
+        self.max_data_per_folder = parameters.get("max_data_per_folder", 0)
+        # folder_id -> uncompressed bytes of the CFFOLDER
+        self._folder_data_size = {}
+        # Bytes of the CFFOLDER and CFFILE entries and of the CFDATA of every CFFOLDER,
+        # kept up to date as they are added so the offsets don't walk every entry
+        self._tables_size = 0
+        self._cffolders_size = 0
+        self._folder_data_bytes = {}
+        self._data_size = 0
+        # True once the cab was written to disk and its CFDATA released
+        self.data_released = False
+        # True once another file would overflow cFiles, cFolders or cbCabinet
+        self.full = False
+
         index_in_set = parameters.get("index_in_set", 0)
         cfdata_reserve = parameters.get("cfdata_reserve", 0)
         cfheader_reserve = parameters.get("cfheader_reserve", 0)
@@ -88,14 +173,58 @@ class CABFile(CABFileFormat):
 
     #####################################
 
-    def _create_cffolder(self, folder_name):
+    def _get_cfdata_bound(self, size, compression=CFFOLDER.tcompTYPE_NONE):
+        """
+        Upper bound of the bytes of the CFDATA holding size uncompressed bytes
+        """
+        chunks = max((size + self.cfdata_size - 1) // self.cfdata_size, 1)
+        result = size + chunks * (8 + self.cfheader.cbCFData)
+        if compression & CFFOLDER.tcompMASK_TYPE != CFFOLDER.tcompTYPE_NONE:
+            # What deflate adds to data it can't compress
+            result += (size >> 12) + chunks * 16
+        return result
+
+    def get_free_space(self, compression=CFFOLDER.tcompTYPE_NONE):
+        """
+        Returns how many uncompressed bytes the next add_file can take, that is the slack
+        but also what keeps cCFData and cbCabinet inside their limits
+        """
+        if self.full:
+            return 0
+        # Room for the CFFILE and a new CFFOLDER
+        room = self.MAX_CABINET - (self.cfheader.cbCabinet or len(self.cfheader)) - \
+               self.MAX_CFFILE_SIZE - (8 + self.cfheader.cbCFFolder)
+        chunks = room // self._get_cfdata_bound(self.cfdata_size, compression)
+        return max(min(self.slack, chunks * self.cfdata_size, self.MAX_CFDATA * self.cfdata_size,
+                       self.MAX_FOLDER_DATA), 0)
+
+    def _create_cffolder(self, folder_name, compression=CFFOLDER.tcompTYPE_NONE):
         new_cffolder = CFFOLDER(self.cfheader, folder_id=self.folder_id)
         new_cffolder.name = folder_name
+        new_cffolder.typeCompress = compression
         self.folder_id += 1
         self.cfheader.add_folder(cffolder=new_cffolder)
         return new_cffolder
 
+    def _append_cffolder(self, cffolder):
+        self.cffolder_list.append(cffolder)
+        self._tables_size += len(cffolder)
+        self._cffolders_size += len(cffolder)
+
     def update_fields(self):
+        """
+        Recomputes every size and offset from the tables, for when they were changed
+        by hand. add_file keeps them up to date on its own
+        """
+        self._cffolders_size = sum(len(cffolder) for cffolder in self.cffolder_list)
+        self._tables_size = self._cffolders_size + sum(len(cffile) for cffile in self.cffile_list)
+        # The CFDATA of a written cab are gone, their sizes are what is left
+        if not self.data_released:
+            self._folder_data_bytes = {}
+            for cfdata in self.cfdata_list:
+                folder_id = cfdata.cffolder.folder_id
+                self._folder_data_bytes[folder_id] = self._folder_data_bytes.get(folder_id, 0) + len(cfdata)
+            self._data_size = sum(self._folder_data_bytes.values())
         # Update uoffFolderStart in CFFILE
         self._update_uoffFolderStart()
         #coffCabStart in CFFOLDER
@@ -109,48 +238,94 @@ class CABFile(CABFileFormat):
         # In wich the first file occupies more than one cab... When this happens, when the second
         # cffile gets added, it cannot share the scattered CFFOLDER because it doesn't work..
         # We need to create an anonymous CFFOLDER here and return it
+        # It takes the name of the folder, so the next files go into it and not into one
+        # anonymous CFFOLDER each
         last_cffile = cffolder.cffile_list[-1]
         if last_cffile.iFolder & CFFILE.ifoldCONTINUED_FROM_PREV == CFFILE.ifoldCONTINUED_FROM_PREV:
-            anonymous_folder = self._create_cffolder(Utils.get_random_name(10))
-            self.cffolder_list.append(anonymous_folder)
+            anonymous_folder = self._create_cffolder(cffolder.name, compression=cffolder.typeCompress)
+            self._append_cffolder(anonymous_folder)
             return anonymous_folder
         return cffolder
 
-    def add_file(self, folder_name, filename, total_len, data):
-
+    def add_file(self, folder_name, filename, total_len, data, compression=CFFOLDER.tcompTYPE_NONE, file_source=None):
+        """
+        compression is the typeCompress of the CFFOLDER if a new one has to be created
+        file_source is the CABFileSource of the data, if any, for the CFFILE fields it sets
+        A CABException with full set means that the file has to go into a new cab, because
+        of max_data or because cFiles, cFolders or cbCabinet would overflow
+        """
         if self.size == self.max_data:
+            self.full = True
+            raise CABException("This cab is full")
+
+        encode = get_encoder(compression)
+        if encode is None:
+            raise CABException("Compression type %04x is not supported" % compression)
+
+        chunk_count = max((len(data) + self.cfdata_size - 1) // self.cfdata_size, 1)
+        if chunk_count > self.MAX_CFDATA:
+            raise CABException("The data needs more than %d CFDATA" % self.MAX_CFDATA)
+        # A file may need an anonymous CFFOLDER and then a new one
+        if len(self.cffile_list) >= self.MAX_FILES or len(self.cffolder_list) + 2 > self.MAX_FOLDERS or \
+                (self.cfheader.cbCabinet or len(self.cfheader)) + 16 + len(filename) + 2 * (8 + self.cfheader.cbCFFolder) + \
+                self._get_cfdata_bound(len(data), compression) > self.MAX_CABINET:
+            self.full = True
             raise CABException("This cab is full")
 
         if (self.size + len(data)) <= self.max_data:
 
             try:
-                cffolder = next(_ for _ in self.cffolder_list if _.name == folder_name)
+                # The last CFFOLDER with that name, the previous ones may be full
+                cffolder = next(_ for _ in reversed(self.cffolder_list) if _.name == folder_name)
                 # We need to check if the cffolder has a cffile scattered that continues from a PREV
                 # If this is the case, we need to provide a new cffolder anyways.. this is how it works
                 cffolder = self._check_for_scattered_prev_cffile(cffolder)
+                folder_data_size = self._folder_data_size.get(cffolder.folder_id, 0)
+                if (self.max_data_per_folder and folder_data_size and
+                        folder_data_size + len(data) > self.max_data_per_folder) or \
+                        cffolder.cCFData + chunk_count > self.MAX_CFDATA or \
+                        folder_data_size + len(data) > self.MAX_FOLDER_DATA:
+                    cffolder = self._create_cffolder(folder_name, compression=compression)
+                    self._append_cffolder(cffolder)
             except StopIteration:
-                cffolder = self._create_cffolder(folder_name)
-                self.cffolder_list.append(cffolder)
+                cffolder = self._create_cffolder(folder_name, compression=compression)
+                self._append_cffolder(cffolder)
 
             cffile = CFFILE(cffolder=cffolder, total_len=total_len, filename=filename)
+            # Only a file continued from the previous cab is bigger than its data in the
+            # CFFOLDER and no other file goes after it
+            cffile.uoffFolderStart = self._folder_data_size.get(cffolder.folder_id, 0)
+            if file_source is not None:
+                for field in ("date", "time", "attribs"):
+                    if getattr(file_source, field) is not None:
+                        setattr(cffile, field, getattr(file_source, field))
             self.cffile_list.append(cffile)
+            self._tables_size += len(cffile)
 
-            # Max data per CFDATA is 0x8000 -> This is an empirical result
-            if len(data) > 0x8000:
-                data_chunks = [data[i:i+0x8000] for i in range(0, len(data), 0x8000)]
-                for data_chunk in data_chunks:
-                    cfdata = CFDATA(cffolder=cffolder, data=data_chunk)
-                    self.cfdata_list.append(cfdata)
-                    cffolder.add_data(cfdata)
+            data_chunks = [data[i:i+self.cfdata_size] for i in range(0, len(data), self.cfdata_size)] or [data]
+            encode = get_encoder(cffolder.typeCompress)
+            pool = self.cabset.pool if self.cabset is not None else None
+            if pool is not None and len(data_chunks) > 1 and cffolder.typeCompress != CFFOLDER.tcompTYPE_NONE:
+                encoded_chunks = pool.map(encode, data_chunks)
             else:
-                cfdata = CFDATA(cffolder=cffolder, data=data)
+                encoded_chunks = [encode(data_chunk) for data_chunk in data_chunks]
+            for data_chunk, ab in zip(data_chunks, encoded_chunks):
+                cfdata = CFDATA(cffolder=cffolder, data=data_chunk)
+                cfdata.ab = ab
+                cfdata.cbData = len(ab)
                 self.cfdata_list.append(cfdata)
                 # Update cCFData
                 cffolder.add_data(cfdata)
+                self._folder_data_bytes[cffolder.folder_id] = \
+                    self._folder_data_bytes.get(cffolder.folder_id, 0) + len(cfdata)
+                self._data_size += len(cfdata)
+            self._folder_data_size[cffolder.folder_id] = self._folder_data_size.get(cffolder.folder_id, 0) + len(data)
 
             cffolder.add_file(cffile)
 
-            self.update_fields()
+            # coffCabStart is set when the tables are packed, every new entry moves it
+            self._update_cbCabinet()
+            self._update_coffFiles()
             self.size += len(data)
 
         else:
@@ -158,20 +333,18 @@ class CABFile(CABFileFormat):
 
     def _update_uoffFolderStart(self):
         """Updates the Uncompressed byte offset of the start of every file's data"""
-        for key, group in groupby(self.cffile_list, lambda x: x.cffolder.folder_id):
-            offset = 0
-            for cffile in group:
-                cffile.uoffFolderStart = offset
-                offset += cffile.cbFile
+        offsets = {}
+        for cffile in self.cffile_list:
+            folder_id = cffile.cffolder.folder_id
+            cffile.uoffFolderStart = offsets.get(folder_id, 0)
+            offsets[folder_id] = cffile.uoffFolderStart + cffile.cbFile
 
     def _update_coffCabStart(self):
         """Update the Absolute file offset of first CFDATA block for every CFFolder"""
-        data_start = len(self.cfheader) + sum([len(cffolder) for cffolder in self.cffolder_list]) + \
-                    sum([len(cffile) for cffile in self.cffile_list])
-        self.cffolder_list[0].coffCabStart = data_start
-        for index, cffolder in enumerate(self.cffolder_list[1:]):
-            data_start = data_start + sum([len(cfdata) for cfdata in self.cffolder_list[index].cfdata_list])
+        data_start = len(self.cfheader) + self._tables_size
+        for cffolder in self.cffolder_list:
             cffolder.coffCabStart = data_start
+            data_start += self._folder_data_bytes.get(cffolder.folder_id, 0)
 
         # current = 0
         # for index, cfdata in enumerate(self.cfdata_list):
@@ -200,22 +373,27 @@ class CABFile(CABFileFormat):
         """
         Absolute file offset of first CFFILE entry.
         """
-        value = len(self.cfheader)
-        for i in self.cffolder_list:
-            value += len(i)
-        self.cfheader.coffFiles = value
+        self.cfheader.coffFiles = len(self.cfheader) + self._cffolders_size
+
+    def get_tables(self):
+        """
+        Returns a bytearray with the CFHEADER, CFFOLDER and CFFILE tables, allocated
+        once with the final size and filled in place
+        """
+        self._update_coffCabStart()
+        buffer = bytearray(self.cfheader.get_packed_size() + self._tables_size)
+        offset = self.cfheader.pack_into(buffer, 0)
+        for cffolder in self.cffolder_list:
+            offset = cffolder.pack_into(buffer, offset)
+        for cffile in self.cffile_list:
+            offset = cffile.pack_into(buffer, offset)
+        return buffer
 
     def __repr__(self):
-        data = repr(self.cfheader)
-        for i in self.cffolder_list:
-            data += repr(i)
-        for i in self.cffile_list:
-            data += repr(i)
-        for i in self.cfdata_list:
-            data += repr(i)
-        return data
+        return str(self.get_tables()) + "".join([repr(cfdata) for cfdata in self.cfdata_list])
 
     def __str__(self):
+        self._update_coffCabStart()
         data = str(self.cfheader)
         for i in self.cffolder_list:
             data += str(i)
@@ -226,14 +404,23 @@ class CABFile(CABFileFormat):
         return data
 
     def __len__(self):
-        result = len(self.cfheader)
-        for i in self.cffolder_list:
-            result += len(i)
-        for i in self.cffile_list:
-            result += len(i)
-        for i in self.cfdata_list:
-            result += len(i)
-        return result
+        return len(self.cfheader) + self._tables_size + self._data_size
+
+    def flush_to_disk(self, output_dir, release_data=False):
+        """
+        Writes the cab into output_dir
+        release_data=True drops the CFDATA afterwards, only the tables are kept
+        """
+        with open(os.path.join(output_dir, self.cab_filename), "wb") as f:
+            f.write(self.get_tables())
+            for cfdata in self.cfdata_list:
+                f.write(cfdata.get_header())
+                f.write(cfdata.ab)
+        if release_data:
+            self.cfdata_list = []
+            for cffolder in self.cffolder_list:
+                cffolder.cfdata_list = []
+            self.data_released = True
 
     @classmethod
     def get_null_ended_string(cls, sz):
@@ -247,6 +434,17 @@ class ChunkGenerator(object):
         self.total_filesize = Utils.get_file_size(self.handle)
         self.finished = False
 
+    @classmethod
+    def create(cls, entry):
+        """
+        Returns the chunk generator for an element of CABFolderUnit.filename_list
+        """
+        if isinstance(entry, CABPathSource):
+            return PathChunkGenerator(entry)
+        if isinstance(entry, CABFileSource):
+            return SourceChunkGenerator(entry)
+        return cls(filename=entry)
+
     def get_chunk(self, bytes_to_read):
         chunk = self.handle.read(bytes_to_read)
         if self.handle.tell() >= self.total_filesize:
@@ -255,6 +453,88 @@ class ChunkGenerator(object):
         return chunk
 
 
+class SourceChunkGenerator(ChunkGenerator):
+    """
+    The same as ChunkGenerator but for the CABFileSource instances
+    """
+
+    def __init__(self, file_source):
+        self.filename = file_source.name
+        self.total_filesize = file_source.size
+        self.finished = False
+        self.position = 0
+
+        source = file_source.source
+        self._data = None
+        self._read = None
+        self._chunks = None
+        self._pending = ""
+        if isinstance(source, (str, bytearray, memoryview)):
+            self._data = source
+        elif hasattr(source, "read"):
+            self._read = source.read
+        else:
+            self._chunks = iter(source)
+
+    def _read_from_chunks(self, bytes_to_read):
+        parts = [self._pending]
+        available = len(self._pending)
+        while available < bytes_to_read:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            available += len(chunk)
+        data = "".join(parts)
+        self._pending = data[bytes_to_read:]
+        return data[:bytes_to_read]
+
+    def get_chunk(self, bytes_to_read):
+        bytes_to_read = min(bytes_to_read, self.total_filesize - self.position)
+        if self._data is not None:
+            chunk = self._data[self.position:self.position+bytes_to_read]
+            if isinstance(chunk, memoryview):
+                chunk = chunk.tobytes()
+            elif isinstance(chunk, bytearray):
+                chunk = str(chunk)
+        elif self._read is not None:
+            chunk = self._read(bytes_to_read)
+        else:
+            chunk = self._read_from_chunks(bytes_to_read)
+
+        if len(chunk) != bytes_to_read:
+            raise CABException("%s is shorter than its declared size" % self.filename)
+        self.position += len(chunk)
+        if self.position >= self.total_filesize:
+            self.finished = True
+        return chunk
+
+
+class PathChunkGenerator(SourceChunkGenerator):
+    """
+    The chunks of a CABPathSource, with the size it already has instead of seeking to the end
+    """
+
+    def __init__(self, path_source):
+        self.handle = open(path_source.path, "rb")
+        path_source.source = self.handle
+        try:
+            super(PathChunkGenerator, self).__init__(path_source)
+        finally:
+            path_source.source = None
+
+    def get_chunk(self, bytes_to_read):
+        try:
+            chunk = super(PathChunkGenerator, self).get_chunk(bytes_to_read)
+        except CABException:
+            self.handle.close()
+            raise
+        if self.finished:
+            self.handle.close()
+        return chunk
+
+
 class CABSet(object):
 
     def __init__(self, parameters={}):
@@ -271,6 +551,15 @@ class CABSet(object):
         self.cab_folders = parameters.get("cab_folders", [])
 
         self.max_data_per_cab = parameters.get("max_data_per_cab", 1024)
+        self.cfdata_size = parameters.get("cfdata_size", 0x8000)
+        self.max_data_per_folder = parameters.get("max_data_per_folder", 0)
+        # typeCompress of the folders whose CABFolderUnit has no compression
+        self.compression = parameters.get("compression", CFFOLDER.tcompTYPE_NONE)
+        # With more than one worker the CFDATA of a file are compressed by a pool of threads
+        self.workers = parameters.get("workers", 1)
+        self.pool = None
+        # If output_dir is given every cab is written as soon as the next one is started
+        self.output_dir = parameters.get("output_dir", None)
         self.cfdata_reserve = parameters.get("cfdata_reserve", 0)
         self.cffolder_reserve = parameters.get("cffolder_reserve", 0)
         self.cfheader_reserve = parameters.get("cfheader_reserve", 0)
@@ -284,6 +573,8 @@ class CABSet(object):
             "cab_filename": cab_filename,
             "cabset": self,
             "max_data": self.max_data_per_cab,
+            "cfdata_size": self.cfdata_size,
+            "max_data_per_folder": self.max_data_per_folder,
             "index_in_set": self.index_in_set,
             "cfheader_reserve": self.cfheader_reserve,
             "cffolder_reserv": self.cffolder_reserve,
@@ -300,7 +591,7 @@ class CABSet(object):
 
     def _get_cab_with_free_space(self):
         for cab_file in self.cab_files:
-            if cab_file.size < self.max_data_per_cab:
+            if cab_file.size < self.max_data_per_cab and not cab_file.full:
                 return cab_file
         # if there is no cab with free space, create a new one
         return self._create_new_cabfile()
@@ -328,6 +619,10 @@ class CABSet(object):
         prev_cab = self.cab_files[-2]
         current_cab = self.cab_files[-1]
 
+        # Nothing changes in a cab that was already written
+        if prev_cab.data_released:
+            return
+
         if prev_cab.cfheader.flags & CFHEADER.cfhdrNEXT_CABINET != CFHEADER.cfhdrNEXT_CABINET:
         # We only need to update the szCabinetNext, szDiskNext and Flags once!
 
@@ -347,11 +642,10 @@ class CABSet(object):
                         else:
                             _cffile.iFolder = CFFILE.ifoldCONTINUED_TO_NEXT
 
-        # Update offsets - We need to do this every time
-        # because we've just added some strings into the structure
-        prev_cab.update_fields()
+            # Update offsets because we've just added some strings into the structure
+            prev_cab.update_fields()
 
-    def _update_current_cabfile(self, filename, folder_name):
+    def _update_current_cabfile(self, filename, folder_name, first_cab=None):
 
         # Only execute if there was more than one cab before inserting the current
         if len(self.cab_files) < 2:
@@ -374,14 +668,17 @@ class CABSet(object):
             #  szCabinetPrev would give the name of the cabinet to examine.
 
             # We need to search for the first cabinet that holds part of the file
-            prev_cab = self._find_first_cab_of_file(filename, folder_name)
-            if prev_cab == None:
-                # This is a border case where the last cabfile had the exact space requiered for the last file.
+            # first_cab is where the file was started, its CFFOLDER may be an anonymous one
+            prev_cab = first_cab if first_cab is not None else self._find_first_cab_of_file(filename, folder_name)
+            continued = prev_cab is not None and prev_cab is not cab_file
+            if not continued:
+                # This is a border case where the last cabfile had the exact space requiered for the last file,
+                # or it was at the limits of the specification. The file starts in this cab.
                 prev_cab = self.cab_files[-2]
             cab_file.cfheader.szCabinetPrev = CABFile.get_null_ended_string(prev_cab.cab_filename)
             cab_file.cfheader.szDiskPrev = CABFile.get_null_ended_string("previous")
 
-            folder_list = cab_file.cfheader.cffolder_list
+            folder_list = cab_file.cfheader.cffolder_list if continued else []
             for folder in folder_list:
                 for _cffile in folder.cffile_list:
                     if _cffile.szName == CABFile.get_null_ended_string(filename):
@@ -390,9 +687,8 @@ class CABSet(object):
                         else:
                             _cffile.iFolder = CFFILE.ifoldCONTINUED_FROM_PREV
 
-        # Update offsets - We need to do this every time
-        # because we've just added some strings into the structure
-        cab_file.update_fields()
+            # Update offsets because we've just added some strings into the structure
+            cab_file.update_fields()
 
     def create_set(self):
         """
@@ -400,33 +696,76 @@ class CABSet(object):
         to create the set of cabs
         :return: it returns a list of cab files instances
         """
+        if self.workers > 1:
+            self.pool = ThreadPool(self.workers)
+        try:
+            self._add_folders()
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+        if self.output_dir is not None:
+            self._flush_finished_cabfiles(last=True)
+
+        return self.cab_files
+
+    def _add_folders(self):
         for folder_unit in self.cab_folders:
+            compression = folder_unit.compression if folder_unit.compression is not None else self.compression
             for full_filename in folder_unit.filename_list:
-                chunk_generator = ChunkGenerator(filename=full_filename)
-                filename = os.path.basename(full_filename)
+                chunk_generator = ChunkGenerator.create(full_filename)
+                filename = CABFolderUnit.get_member_name(full_filename)
+                file_source = full_filename if isinstance(full_filename, CABFileSource) else None
+                first_cab = None
                 while not chunk_generator.finished:
 
                     # Look for a CAB in the set with space, if there is not any, create a new one
                     # Then put the file data into the cab structure
                     cab_file = self._get_cab_with_free_space()
-                    size_to_fill = cab_file.slack
+                    size_to_fill = cab_file.get_free_space(compression)
+                    if size_to_fill == 0:
+                        # There is slack but the cab is at the limits of the specification
+                        cab_file.full = True
+                        continue
                     data = chunk_generator.get_chunk(bytes_to_read=size_to_fill)
 
                     try:
                         cab_file.add_file(folder_name=folder_unit.name,
                                       filename=CABFile.get_null_ended_string(filename),
                                       total_len=chunk_generator.total_filesize,
-                                      data=data)
+                                      data=data,
+                                      compression=compression,
+                                      file_source=file_source)
                     except CABException:
                         cab_file = self._create_new_cabfile()
                         cab_file.add_file(folder_name=folder_unit.name,
                                       filename=CABFile.get_null_ended_string(filename),
                                       total_len=chunk_generator.total_filesize,
-                                      data=data)
+                                      data=data,
+                                      compression=compression,
+                                      file_source=file_source)
+
+                    if first_cab is None:
+                        first_cab = cab_file
+                    # What is left of the file goes on in the next cab
+                    if not chunk_generator.finished:
+                        cab_file.full = True
 
                     # Check if there is a previous CAB created and update required fields
                     self._update_prev_cabfile(filename=filename)
                     # We need to update some fields on the current cab if it is not the first
-                    self._update_current_cabfile(filename=filename, folder_name=folder_unit.name)
+                    self._update_current_cabfile(filename=filename, folder_name=folder_unit.name, first_cab=first_cab)
+
+                    if self.output_dir is not None:
+                        self._flush_finished_cabfiles()
 
-        return self.cab_files
\ No newline at end of file
+    def _flush_finished_cabfiles(self, last=False):
+        """
+        Every cab but the current one is complete once the first data of the current
+        was added (that is when the previous one gets its NEXT_CABINET fields)
+        """
+        cab_files = self.cab_files if last else self.cab_files[:-1]
+        for cab_file in cab_files:
+            if not cab_file.data_released:
+                cab_file.flush_to_disk(self.output_dir, release_data=True)
\ No newline at end of file
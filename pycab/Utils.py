@@ -4,6 +4,8 @@ import random
 import string
 import hashlib
 import os
+import struct
+import operator
 
 class Utils(object):
 
@@ -36,4 +38,17 @@ class Utils(object):
         for filename in file_list:
             with open(filename, "rb") as f:
                 result[os.path.basename(filename)] = hashlib.md5(f.read()).hexdigest()
-        return result
\ No newline at end of file
+        return result
+
+    @staticmethod
+    def cab_checksum(data, seed=0):
+        """
+        The checksum of the cabinet specification, a xor of the little endian DWORDs
+        of data where the last 1-3 bytes are taken in reverse order
+        """
+        count = len(data) // 4
+        csum = reduce(operator.xor, struct.unpack("<%dI" % count, data[:count*4]), seed)
+        tail = 0
+        for c in data[count*4:]:
+            tail = (tail << 8) | ord(c)
+        return csum ^ tail
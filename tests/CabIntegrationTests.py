@@ -1,7 +1,33 @@
-from pycab.CabExtractor import CabExtractor, Utils
+from pycab.CabExtractor import CabExtractor, SetExtraction, Utils
 from pycab.CabManager import CABManager
-from pycab.CabWriter import CABFolderUnit
+from pycab.CabWriter import CABFolderUnit, CABFile, CABException
+from pycab.CabIndex import CabIndex
+from pycab.CabCache import CabCache
+from pycab.CabReader import CabReader
+from pycab.CabStream import CabStreamReader
+from pycab.CabStructs import CFDATA, CFFOLDER, CFFILE
+from pycab.CabInventory import CabInventory
+from pycab.CabCarver import CabCarver
+from pycab.CabCatalog import CabCatalog
+from pycab.CabValidator import CabValidator, get_cfdata_checksum, _check_folder
+from pycab.CabDiff import CabDiff
+from pycab.CabTranscoder import CabTranscoder
+from pycab.CabRepacker import CabRepacker
+from pycab.CabConverter import CabConverter
+from pycab.CabTreeBuilder import CabTreeBuilder
+from pycab.CabAsync import CabPool, as_completed
+import pycab.CabWriter
 import os
+import re
+import struct
+import zlib
+import io
+import threading
+import hashlib
+import shutil
+import tempfile
+import tarfile
+import zipfile
 import unittest
 
 class IntegrationTestcase(unittest.TestCase):
@@ -93,6 +119,1124 @@ class IntegrationTestcase(unittest.TestCase):
         os.unlink(r"./TestsFiles/my_cab_2.cab")
         os.unlink(r"./TestsFiles/my_cab_3.cab")
 
+    def test_read_cab_with_index_cache(self):
+        """
+        A cabinet opened through a CabIndex must look the same as a freshly parsed one
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        cache_dir = tempfile.mkdtemp()
+        index = CabIndex(cache_dir=cache_dir)
+        parsed_cab = manager.read_cab(r"./TestsFiles/my_cab_0.cab", index_cache=index)
+        cached_cab = manager.read_cab(r"./TestsFiles/my_cab_0.cab", index_cache=index)
+
+        self.assertEquals(1, index.misses)
+        self.assertEquals(1, index.hits)
+        self.assertEquals(repr(parsed_cab), repr(cached_cab))
+        self.assertEquals([index.get_index_filename(r"./TestsFiles/my_cab_0.cab")],
+                          [os.path.join(cache_dir, _) for _ in os.listdir(cache_dir)])
+
+        # A stale index is ignored and written again: other mtime, other size, other CFHEADER
+        os.utime(r"./TestsFiles/my_cab_0.cab", (0, 0))
+        manager.read_cab(r"./TestsFiles/my_cab_0.cab", index_cache=index)
+        self.assertEquals(2, index.misses)
+        with open(r"./TestsFiles/my_cab_0.cab", "ab") as f:
+            f.write("\x00")
+        manager.read_cab(r"./TestsFiles/my_cab_0.cab", index_cache=index)
+        self.assertEquals(3, index.misses)
+        st = os.stat(r"./TestsFiles/my_cab_0.cab")
+        with open(r"./TestsFiles/my_cab_0.cab", "r+b") as f:
+            f.seek(32)
+            f.write("\x12\x34")
+        os.utime(r"./TestsFiles/my_cab_0.cab", (st.st_atime, st.st_mtime))
+        changed_cab = manager.read_cab(r"./TestsFiles/my_cab_0.cab", index_cache=index)
+        self.assertEquals(4, index.misses)
+        self.assertEquals(0x3412, changed_cab.cfheader.setID)
+        self.assertEquals(repr(changed_cab), repr(manager.read_cab(r"./TestsFiles/my_cab_0.cab", index_cache=index)))
+        self.assertEquals(2, index.hits)
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+        # A hit only builds the entries that are used
+        folder1 = CABFolderUnit(name="folder1")
+        for i in range(2000):
+            folder1.add_source("file_%d.txt" % i, "data %d" % i)
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024, cfdata_size=0x100)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+        parsed_cab = CabReader(r"./TestsFiles/my_cab_0.cab", index_cache=index, load_data=False)
+        cached_cab = CabReader(r"./TestsFiles/my_cab_0.cab", index_cache=index, load_data=False)
+        self.assertEquals(3, index.hits)
+        cffile = cached_cab.get_cffile("file_1234.txt")
+        self.assertEquals("file_1234.txt\x00", cffile.szName)
+        self.assertEquals([cffile], cached_cab.cffile_list.get_built())
+        self.assertEquals(None, cached_cab.get_cffile("file_2000.txt"))
+        self.assertEquals("data 1234", cached_cab.read_member("file_1234.txt"))
+        self.assertEquals("data 0", cached_cab.read_member("file_0.txt\x00"))
+        self.assertEquals(2, len(cached_cab.cffile_list.get_built()))
+        self.assertTrue(len(cached_cab.cfdata_list.get_built()) <= 2)
+        self.assertEquals(repr(parsed_cab), repr(cached_cab))
+        # Cleanup
+        shutil.rmtree(cache_dir)
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+    def test_read_member_with_cache(self):
+        """
+        Members read through a CabCache must match the original files, before and after
+        the cabinet gets rewritten
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder2 = CABFolderUnit(name="folder2", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager(cache=CabCache(max_bytes=1024*1024))
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        files_hashes = Utils.get_hashes_of_files(folder1.filename_list + folder2.filename_list)
+        for _ in range(2):
+            data = manager.read_member(r"./TestsFiles/my_cab_0.cab", "super_saiyajin.jpg")
+            self.assertEquals(files_hashes["super_saiyajin.jpg"], hashlib.md5(data).hexdigest())
+        self.assertTrue(manager.cache.hits > 0)
+
+        manager.create_cab(cab_folders=[folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+        os.utime(r"./TestsFiles/my_cab_0.cab", (0, 0))
+        self.assertRaises(CABException, manager.read_member, r"./TestsFiles/my_cab_0.cab", "pe101.jpg")
+        # Cleanup
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+    def test_iter_members(self):
+        """
+        Streaming the members of a cabinet without loading its data
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        cab = CabReader(r"./TestsFiles/my_cab_0.cab", load_data=False)
+        extracted_hashes = {}
+        for cffile, stream in cab.iter_members():
+            md5 = hashlib.md5()
+            chunk = stream.read(0x1000)
+            while chunk:
+                md5.update(chunk)
+                chunk = stream.read(0x1000)
+            extracted_hashes[stream.name] = md5.hexdigest()
+
+        self.assertEquals(Utils.get_hashes_of_files(folder1.filename_list), extracted_hashes)
+        self.assertTrue(all(cfdata.loader is not None for cfdata in cab.cfdata_list))
+        # Cleanup
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+    def test_read_cab_from_stream(self):
+        """
+        Extracting a cabinet that arrives as a stream of small chunks
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder2 = CABFolderUnit(name="folder2", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        with open(r"./TestsFiles/my_cab_0.cab", "rb") as f:
+            chunks = iter(lambda: f.read(1000), "")
+            cab = CabStreamReader(chunks)
+            extracted_hashes = dict((cffile.szName[:-1], hashlib.md5(data).hexdigest())
+                                    for cffile, data in cab.iter_member_data())
+
+        files_hashes = Utils.get_hashes_of_files(folder1.filename_list + folder2.filename_list)
+        self.assertEquals(files_hashes, extracted_hashes)
+
+        # Small files sharing CFDATA, through the same streams as CabReader.iter_members
+        folder1 = CABFolderUnit(name="folder1")
+        for i in range(50):
+            folder1.add_source("file_%d.txt" % i, ("%d" % i) * (i * 97))
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           cfdata_size=0x400)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+        with open(r"./TestsFiles/my_cab_0.cab", "rb") as f:
+            members = [(stream.name, stream.read()) for cffile, stream in CabStreamReader(f).iter_members()]
+        self.assertEquals([(source.name, source.source) for source in folder1.filename_list], members)
+        # Cleanup
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+    def test_write_from_memory_sources(self):
+        """
+        Files coming from a str, a file object and a generator, mixed with files on disk
+        """
+        with open(r"./TestsFiles/pe101.jpg", "rb") as f:
+            pe101 = f.read()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        folder1.add_source("pe101.jpg", pe101)
+        folder1.add_source("manifest.txt", io.BytesIO("manifest " * 1000))
+        folder1.add_source("catalog.txt", ("line %04d\n" % i for i in range(5000)), size=50000)
+
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=(100*1024))
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        extractor = CabExtractor()
+        extractor.extract(r"./TestsFiles/my_cab_0.cab")
+        extracted_hashes = extractor.get_hashes_of_files()
+
+        self.assertEquals(Utils.get_hashes_of_files(folder1.filename_list[:1])["super_saiyajin.jpg"],
+                          extracted_hashes["super_saiyajin.jpg\x00"])
+        self.assertEquals(hashlib.md5(pe101).hexdigest(), extracted_hashes["pe101.jpg\x00"])
+        self.assertEquals(hashlib.md5("manifest " * 1000).hexdigest(), extracted_hashes["manifest.txt\x00"])
+        self.assertEquals(hashlib.md5("".join("line %04d\n" % i for i in range(5000))).hexdigest(),
+                          extracted_hashes["catalog.txt\x00"])
+        # Cleanup
+        for cab_file in manager.cab_set:
+            os.unlink(os.path.join(r"./TestsFiles/", cab_file.cab_filename))
+
+    def test_write_set_streaming(self):
+        """
+        Every cab of the set is written as soon as the next one is started
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder2 = CABFolderUnit(name="folder2", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=(50*1024),
+                           output_dir=r"./TestsFiles/")
+
+        cab_files = list(manager.cab_set)
+        self.assertEquals(4, len(cab_files))
+        self.assertTrue(all(cab_file.data_released and not cab_file.cfdata_list for cab_file in cab_files))
+
+        extractor = CabExtractor()
+        extractor.extract(r"./TestsFiles/my_cab_0.cab")
+        extracted_hash_set = set(extractor.get_hashes_of_files().values())
+        files_hash_set = set(Utils.get_hashes_of_files(folder1.filename_list + folder2.filename_list).values())
+        self.assertEquals(files_hash_set, extracted_hash_set)
+        # Cleanup
+        for cab_file in cab_files:
+            os.unlink(os.path.join(r"./TestsFiles/", cab_file.cab_filename))
+
+    def test_extract_set_with_shared_cfdata(self):
+        """
+        A set whose first cab has a CFDATA shared between two CFFILEs
+        """
+        folder1 = CABFolderUnit(name="folder1")
+        folder1.add_source("a.txt", "a" * 10)
+        folder1.add_source("b.txt", "b" * 10)
+        folder1.add_source("c.txt", "c" * 100)
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=60)
+
+        # Merge the CFDATA of a.txt and b.txt
+        cab_file = manager.cab_set.cab_files[0]
+        cffolder = cab_file.cffolder_list[0]
+        shared_cfdata = CFDATA(cffolder=cffolder, data=cab_file.cfdata_list[0].ab + cab_file.cfdata_list[1].ab)
+        cab_file.cfdata_list[0:2] = [shared_cfdata]
+        cffolder.cfdata_list[0:2] = [shared_cfdata]
+        cffolder.cCFData -= 1
+        cab_file.update_fields()
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        extractor = CabExtractor()
+        extractor.extract(r"./TestsFiles/my_cab_0.cab")
+        folder_unit = extractor.folder_unit_list[0]
+        self.assertEquals(["a.txt\x00", "b.txt\x00", "c.txt\x00"], folder_unit.filename_list)
+        self.assertEquals(["a" * 10, "b" * 10, "c" * 100], folder_unit.filedata_list)
+        # Cleanup
+        for cab_file in manager.cab_set:
+            os.unlink(os.path.join(r"./TestsFiles/", cab_file.cab_filename))
+
+        # Many small files of a MSZIP set sharing every CFDATA, each one is decoded once
+        folder1 = CABFolderUnit(name="folder1")
+        for i in range(300):
+            folder1.add_source("file_%d.txt" % i, ("%03d" % i) * (i % 7 + 1))
+        folder1.compression = CFFOLDER.tcompTYPE_MSZIP
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1500, cfdata_size=0x200)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+        self.assertTrue(len(manager.cab_set.cab_files) > 1)
+
+        extractor = CabExtractor()
+        extractor.cab_dirname = r"./TestsFiles/"
+        set_extraction = SetExtraction(extractor=extractor)
+        decoded_blocks = []
+        decode_next_block = set_extraction._decode_next_block
+        set_extraction._decode_next_block = lambda: decoded_blocks.append(decode_next_block())
+        folder_unit = set_extraction.extract(CabReader(r"./TestsFiles/my_cab_0.cab"))[0]
+        self.assertEquals([source.name + "\x00" for source in folder1.filename_list], folder_unit.filename_list)
+        self.assertEquals([source.source for source in folder1.filename_list], folder_unit.filedata_list)
+        self.assertEquals(sum([len(cab_file.cfdata_list) for cab_file in manager.cab_set]), len(decoded_blocks))
+        # Cleanup
+        for cab_file in manager.cab_set:
+            os.unlink(os.path.join(r"./TestsFiles/", cab_file.cab_filename))
+
+    def test_inventory_of_directory(self):
+        """
+        Probing a directory with a set of cabs and a file that is not a cab
+        """
+        output_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(output_dir, "nested"))
+        with open(os.path.join(output_dir, "nested", "broken.cab"), "wb") as f:
+            f.write("this is not a cab")
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=(100*1024),
+                           output_dir=output_dir)
+
+        records = dict((os.path.basename(record["filename"]), record)
+                       for record in CabInventory(workers=2, tables=True).scan(output_dir))
+
+        self.assertEquals(set(["my_cab_0.cab", "my_cab_1.cab", "broken.cab"]), set(records))
+        self.assertTrue("error" in records["broken.cab"])
+        self.assertEquals(0, records["my_cab_0.cab"]["iCabinet"])
+        self.assertEquals("my_cab_1.cab", records["my_cab_0.cab"]["szCabinetNext"])
+        self.assertEquals(1, records["my_cab_1.cab"]["iCabinet"])
+        self.assertEquals([("pe101.jpg", os.path.getsize(r"./TestsFiles/pe101.jpg"))],
+                          records["my_cab_0.cab"]["members"])
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_carve_embedded_cabs(self):
+        """
+        Finding two cabs embedded in a blob with some fake signatures
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+        with open(r"./TestsFiles/my_cab_0.cab", "rb") as f:
+            cab_data = f.read()
+
+        blob_filename = os.path.join(tempfile.mkdtemp(), "blob.bin")
+        with open(blob_filename, "wb") as f:
+            f.write("\x00MSCF" * 1000 + cab_data + "MSCF\x00\x00\x00\x00" * 10 + cab_data + "\xff" * 100)
+
+        expected = [(5000, len(cab_data)), (5000 + len(cab_data) + 80, len(cab_data))]
+        self.assertEquals(expected, list(CabCarver(blob_filename).find()))
+        self.assertEquals(expected, list(CabCarver(blob_filename, workers=2, region_size=4096).find()))
+
+        for cab in CabCarver(blob_filename).readers():
+            for cffile, stream in cab.iter_members():
+                self.assertEquals(Utils.get_hashes_of_files(folder1.filename_list)["super_saiyajin.jpg"],
+                                  hashlib.md5(stream.read()).hexdigest())
+        # Cleanup
+        shutil.rmtree(os.path.dirname(blob_filename))
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+    def test_catalog_of_directory(self):
+        """
+        Cataloging a directory of cabs and updating it incrementally
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder2 = CABFolderUnit(name="folder2", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           output_dir=output_dir)
+
+        catalog = CabCatalog(os.path.join(output_dir, "catalog.db"), workers=2, hashes=True)
+        self.assertEquals(1, catalog.update(output_dir))
+        self.assertEquals(0, catalog.update(output_dir))
+
+        md5 = Utils.get_hashes_of_files(folder2.filename_list)["super_saiyajin.jpg"]
+        members = catalog.find(md5=md5)
+        self.assertEquals(1, len(members))
+        self.assertEquals("super_saiyajin.jpg", members[0]["name"])
+        self.assertEquals(os.path.join(output_dir, "my_cab_0.cab"), members[0]["cabinet"])
+
+        os.utime(os.path.join(output_dir, "my_cab_0.cab"), (0, 0))
+        self.assertEquals(1, catalog.update(output_dir))
+        self.assertEquals(1, len(catalog.find(name="pe101.jpg")))
+
+        os.unlink(os.path.join(output_dir, "my_cab_0.cab"))
+        self.assertEquals(0, catalog.update(output_dir))
+        self.assertEquals([], catalog.find(name="pe101.jpg"))
+        # Cleanup
+        catalog.close()
+        shutil.rmtree(output_dir)
+
+    def test_write_with_cfdata_size_and_folder_size(self):
+        """
+        Smaller CFDATA and a new CFFOLDER once a folder holds enough data
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        folder1.add_source("a.txt", "a" * 100)
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           cfdata_size=0x1000, folder_size=150000)
+        manager.flush_cabset_to_disk(output_dir=r"./TestsFiles/")
+
+        cab = CabReader(r"./TestsFiles/my_cab_0.cab")
+        self.assertEquals(2, cab.cfheader.cFolders)
+        self.assertEquals([0, 1, 1], [cffile.iFolder for cffile in cab.cffile_list])
+        self.assertTrue(all(cfdata.cbUncomp <= 0x1000 for cfdata in cab.cfdata_list))
+
+        extractor = CabExtractor()
+        extractor.extract(r"./TestsFiles/my_cab_0.cab")
+        extracted_hashes = extractor.get_hashes_of_files()
+        for filename, md5 in Utils.get_hashes_of_files(folder1.filename_list[:2]).items():
+            self.assertEquals(md5, extracted_hashes[filename + "\x00"])
+        # Cleanup
+        os.unlink(r"./TestsFiles/my_cab_0.cab")
+
+    def test_validator(self):
+        """
+        A valid set has no problems, a damaged cabinet reports all of them
+        """
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        output_dir = tempfile.mkdtemp()
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=60000)
+        manager.flush_cabset_to_disk(output_dir=output_dir)
+        filenames = [os.path.join(output_dir, "my_cab_%d.cab" % i) for i in range(3)]
+        self.assertEquals([], CabValidator(deep=True, workers=2).check_set(filenames))
+        self.assertEquals(1, len(CabValidator().check_set(filenames[:2])))
+
+        self.assertEquals(0x64636261 ^ 0x65, Utils.cab_checksum("abcde"))
+        cab = CabReader(filenames[0])
+        with open(filenames[0], "r+b") as f:
+            # cbCabinet, uoffFolderStart of the first CFFILE and csum of the first CFDATA
+            f.seek(8)
+            f.write("\xff\xff\x00\x00")
+            f.seek(cab.cfheader.coffFiles + 4)
+            f.write("\xff\xff\x00\x00")
+            f.seek(cab.cfdata_list[0].offset)
+            f.write("\x01\x02\x03\x04")
+        self.assertEquals(2, len(CabValidator().check(filenames[0])))
+        self.assertEquals(3, len(CabValidator(deep=True).check(filenames[0])))
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_validate_set_with_mszip_history(self):
+        """
+        The MSZIP blocks of a folder continued in the next cabinet use the history of the
+        previous one, the set is decoded as a whole and a cabinet alone has no false errors
+        """
+        output_dir = tempfile.mkdtemp()
+        # Blocks that reference the previous ones, like the ones of the CAB compressor of windows
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        get_encoder = pycab.CabWriter.get_encoder
+        pycab.CabWriter.get_encoder = lambda compression: \
+            lambda data: "CK" + compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        try:
+            folder1 = CABFolderUnit(name="folder1")
+            text = "".join(["line %d of the text\r\n" % (i % 100) for i in range(5000)])
+            folder1.add_source("text.txt", text)
+            folder1.compression = CFFOLDER.tcompTYPE_MSZIP
+            manager = CABManager()
+            manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=30000,
+                               output_dir=output_dir, cfdata_size=0x1000)
+        finally:
+            pycab.CabWriter.get_encoder = get_encoder
+        filenames = [os.path.join(output_dir, cab_file.cab_filename) for cab_file in manager.cab_set]
+        self.assertTrue(len(filenames) > 2)
+        second_cab = CabReader(filenames[1])
+        self.assertRaises(CABException, second_cab.decode_cfdata, second_cab.cfdata_list[0])
+
+        self.assertEquals([], CabValidator(deep=True, workers=2).check_set(filenames))
+        for filename in filenames:
+            self.assertEquals([], CabValidator(deep=True).check(filename))
+        paths = CabExtractor().extract_to_directory(filenames[0], os.path.join(output_dir, "extraction"))
+        with open(paths[0], "rb") as f:
+            self.assertEquals(text, f.read())
+
+        # A problem of the whole folder is reported in the cabinet where it starts
+        readers = [CabReader(filename, load_data=False) for filename in filenames]
+        task = CabValidator()._get_folder_task(CabReader.get_set_folders(readers)[0][0])
+        os.remove(filenames[-1])
+        problems = _check_folder(task)
+        self.assertEquals([filenames[0]], [filename for filename, message in problems])
+        self.assertTrue(problems[0][1].startswith("CFFOLDER 0: "))
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_diff_sets(self):
+        """
+        Only the files whose blocks differ are decompressed
+        """
+        output_dir = tempfile.mkdtemp()
+        with open(r"./TestsFiles/super_saiyajin.jpg", "rb") as f:
+            data = f.read()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        folder2 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder2.add_source("super_saiyajin.jpg", data[:100] + "x" + data[101:])
+        folder2.add_source("new.txt", "new")
+        for prefix, folder in (("old", folder1), ("new", folder2)):
+            manager = CABManager()
+            manager.create_cab(cab_folders=[folder], cab_name=prefix + "_[x].cab", cab_size=60000)
+            manager.flush_cabset_to_disk(output_dir=output_dir)
+        old = [os.path.join(output_dir, "old_%d.cab" % i) for i in range(3)]
+        new = [os.path.join(output_dir, "new_%d.cab" % i) for i in range(3)]
+
+        cab_diff = CabDiff()
+        result = cab_diff.diff(old, new)
+        self.assertEquals(["new.txt"], result["added"])
+        self.assertEquals([], result["removed"])
+        self.assertEquals({}, result["metadata"])
+        self.assertEquals(["super_saiyajin.jpg"], result["contents"])
+        # Only the CFDATA of super_saiyajin.jpg, pe101.jpg spans the 3 cabinets unchanged
+        self.assertEquals(2, cab_diff.decoded_blocks)
+
+        result = cab_diff.diff(old, old)
+        self.assertEquals([], result["added"] + result["removed"] + result["contents"])
+        self.assertEquals(0, cab_diff.decoded_blocks)
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_diff_with_equal_checksums(self):
+        """
+        Reordered DWORDs keep the csum of a CFDATA, an equal csum is not taken as equal data
+        """
+        output_dir = tempfile.mkdtemp()
+        for compression in (CFFOLDER.tcompTYPE_NONE, CFFOLDER.tcompTYPE_MSZIP):
+            for prefix, data in (("old", "AAAABBBB" * 1000), ("new", "BBBBAAAA" * 1000)):
+                folder1 = CABFolderUnit(name="folder1")
+                folder1.add_source("x.txt", data)
+                folder1.compression = compression
+                manager = CABManager()
+                manager.create_cab(cab_folders=[folder1], cab_name=prefix + "_[x].cab", cab_size=1474*1024,
+                                   output_dir=output_dir)
+                # Real checksums instead of the 0 written by the CABSet
+                filename = os.path.join(output_dir, prefix + "_0.cab")
+                with open(filename, "r+b") as f:
+                    for cfdata in CabReader(filename).cfdata_list:
+                        f.seek(cfdata.offset)
+                        f.write(struct.pack("<I", get_cfdata_checksum(cfdata, cfdata.ab)))
+            old = os.path.join(output_dir, "old_0.cab")
+            new = os.path.join(output_dir, "new_0.cab")
+            if compression == CFFOLDER.tcompTYPE_NONE:
+                self.assertEquals(CabReader(old).cfdata_list[0].csum, CabReader(new).cfdata_list[0].csum)
+
+            self.assertEquals(["x.txt"], CabDiff().diff(old, new)["contents"])
+            self.assertEquals([], CabDiff().diff(old, old)["contents"])
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_diff_with_mszip_history(self):
+        """
+        Equal MSZIP blocks after a block that changed decode to other data
+        """
+        output_dir = tempfile.mkdtemp()
+        get_encoder = pycab.CabWriter.get_encoder
+        try:
+            for prefix in ("old", "new"):
+                # b.bin is a copy of a.bin, its block only references the one of a.bin
+                data = "0123456789abcdef" + "".join([hashlib.md5(prefix + str(i)).digest() for i in range(255)])
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+                pycab.CabWriter.get_encoder = lambda compression, compressor=compressor: \
+                    lambda data: "CK" + compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                folder1 = CABFolderUnit(name="folder1")
+                folder1.add_source("a.bin", data)
+                folder1.add_source("b.bin", data)
+                folder1.compression = CFFOLDER.tcompTYPE_MSZIP
+                manager = CABManager()
+                manager.create_cab(cab_folders=[folder1], cab_name=prefix + "_[x].cab", cab_size=1474*1024,
+                                   output_dir=output_dir, cfdata_size=0x1000)
+        finally:
+            pycab.CabWriter.get_encoder = get_encoder
+        old = os.path.join(output_dir, "old_0.cab")
+        new = os.path.join(output_dir, "new_0.cab")
+        self.assertEquals(CabReader(old).cfdata_list[1].ab, CabReader(new).cfdata_list[1].ab)
+        self.assertNotEquals(CabReader(old).read_member("b.bin"), CabReader(new).read_member("b.bin"))
+
+        self.assertEquals(["a.bin", "b.bin"], sorted(CabDiff().diff(old, new)["contents"]))
+        diff = CabDiff()
+        self.assertEquals([], diff.diff(old, old)["contents"])
+        self.assertEquals(0, diff.decoded_blocks)
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_transcode_to_mszip_and_back(self):
+        """
+        A set without compression becomes a MSZIP set and back again
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        folder1.add_source("text.txt", "hello world " * 20000)
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="none_[x].cab", cab_size=60000, output_dir=output_dir)
+        source = [os.path.join(output_dir, cab.cab_filename) for cab in manager.cab_set]
+
+        cab_files = CabTranscoder(compression=CFFOLDER.tcompTYPE_MSZIP, workers=2, buffer_blocks=2).transcode(
+            source, "mszip_[x].cab", output_dir, cab_size=1474*1024)
+        self.assertEquals(1, len(cab_files))
+        mszip = os.path.join(output_dir, cab_files[0].cab_filename)
+        cab = CabReader(mszip)
+        self.assertEquals([CFFOLDER.tcompTYPE_MSZIP] * 2, [cffolder.typeCompress for cffolder in cab.cffolder_list])
+        self.assertTrue(os.path.getsize(mszip) < sum([os.path.getsize(filename) for filename in source]))
+        self.assertEquals([], CabValidator(deep=True).check(mszip))
+        self.assertEquals("hello world " * 20000, cab.read_member("text.txt"))
+        self.assertEquals(CabReader(source[0]).cffile_list[0].date, cab.get_cffile("pe101.jpg").date)
+
+        cab_files = CabTranscoder(compression=CFFOLDER.tcompTYPE_NONE).transcode(
+            mszip, "back_[x].cab", output_dir, cab_size=60000)
+        extractor = CabExtractor()
+        extractor.extract(os.path.join(output_dir, cab_files[0].cab_filename))
+        extracted_hashes = extractor.get_hashes_of_files()
+        for filename, md5 in Utils.get_hashes_of_files(folder1.filename_list[:2]).items():
+            self.assertEquals(md5, extracted_hashes[filename + "\x00"])
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_merge_and_split_by_block_copy(self):
+        """
+        Two cabinets merged in one and split again in a set without decompressing
+        """
+        output_dir = tempfile.mkdtemp()
+        filenames = []
+        for index, (filename, compression) in enumerate(((r"./TestsFiles/pe101.jpg", CFFOLDER.tcompTYPE_NONE),
+                                                         (r"./TestsFiles/super_saiyajin.jpg", CFFOLDER.tcompTYPE_MSZIP))):
+            folder = CABFolderUnit(name="folder1", filename_list=[filename])
+            folder.add_source("text_%d.txt" % index, "text %d " % index * 5000)
+            manager = CABManager()
+            manager.create_cab(cab_folders=[folder], cab_name="single_%d_[x].cab" % index, output_dir=output_dir,
+                               compression=compression)
+            filenames.append(os.path.join(output_dir, "single_%d_0.cab" % index))
+
+        merged = os.path.join(output_dir, "merged.cab")
+        CabRepacker().merge(filenames, merged)
+        self.assertEquals([], CabValidator(deep=True).check(merged))
+        self.assertEquals(4, CabReader(merged).cfheader.cFiles)
+        self.assertEquals({"added": [], "removed": [], "metadata": {}, "contents": []},
+                          CabDiff().diff(filenames, merged))
+
+        parts = CabRepacker().split(merged, "part_[x].cab", output_dir, max_data_per_cab=50000)
+        self.assertEquals(6, len(parts))
+        self.assertEquals([], CabValidator(deep=True).check_set(parts))
+        self.assertEquals({"added": [], "removed": [], "metadata": {}, "contents": []},
+                          CabDiff().diff(merged, parts))
+        extractor = CabExtractor()
+        extractor.extract(parts[0])
+        extracted_hashes = extractor.get_hashes_of_files()
+        for filename, md5 in Utils.get_hashes_of_files([r"./TestsFiles/pe101.jpg",
+                                                        r"./TestsFiles/super_saiyajin.jpg"]).items():
+            self.assertEquals(md5, extracted_hashes[filename + "\x00"])
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_split_continued_folder(self):
+        """
+        The offsets of a folder continued in the next parts count from the part where
+        the folder starts, not from the start of the folder in the original cabinet
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1")
+        for i in range(10):
+            folder1.add_source("f%d.txt" % i, str(i) * (12000 if i == 3 else 3000))
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="single_[x].cab", output_dir=output_dir,
+                           cfdata_size=0x1000)
+        parts = CabRepacker().split(os.path.join(output_dir, "single_0.cab"), "p_[x].cab", output_dir,
+                                    max_data_per_cab=10000)
+        # f3.txt starts a folder in p_1.cab and goes on into p_2.cab
+        self.assertEquals([0, 12000], [CabReader(parts[2]).get_cffile(name).uoffFolderStart
+                                       for name in ("f3.txt", "f4.txt")])
+        self.assertEquals([], CabValidator(deep=True).check_set(parts))
+
+        extract_dir = os.path.join(output_dir, "extraction")
+        paths = CabExtractor().extract_to_directory(parts[0], extract_dir)
+        self.assertEquals(10, len(paths))
+        for i in range(10):
+            with open(os.path.join(extract_dir, "f%d.txt" % i), "rb") as f:
+                self.assertEquals(str(i) * (12000 if i == 3 else 3000), f.read())
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_read_members_of_split_set(self):
+        """
+        The files of a folder continued from a previous cabinet need the whole set,
+        reading them from their cabinet alone fails instead of returning no data
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1")
+        for i in range(10):
+            folder1.add_source("f%d.txt" % i, str(i) * (12000 if i == 3 else 3000))
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="single_[x].cab", output_dir=output_dir,
+                           cfdata_size=0x1000)
+        parts = CabRepacker().split(os.path.join(output_dir, "single_0.cab"), "p_[x].cab", output_dir,
+                                    max_data_per_cab=10000)
+        self.assertTrue(len(parts) > 2)
+
+        # f3.txt goes on from p_1.cab into the folder of f4.txt
+        cab = CabReader(parts[2], load_data=False)
+        cffile = cab.get_cffile("f4.txt")
+        self.assertEquals(0, cffile.iFolder)
+        self.assertEquals(12000, cffile.uoffFolderStart)
+        self.assertFalse(cab.is_member_local(cffile))
+        self.assertRaises(CABException, cab.read_member, "f4.txt")
+        self.assertRaises(CABException, cab.open_member, "f4.txt")
+        self.assertEquals([], [cffile for cffile, stream in cab.iter_members()])
+        with open(parts[2], "rb") as f:
+            self.assertEquals([], [cffile for cffile, data in CabStreamReader(f).iter_member_data()])
+        self.assertEquals("0" * 3000, CabReader(parts[0]).read_member("f0.txt"))
+
+        catalog = CabCatalog(os.path.join(output_dir, "catalog.db"), workers=1, hashes=True)
+        catalog.update(output_dir)
+        md5s = dict([(os.path.basename(row["cabinet"]), row["md5"]) for row in catalog.find(name="f4.txt")])
+        catalog.close()
+        self.assertEquals({"single_0.cab": hashlib.md5("4" * 3000).hexdigest(), "p_2.cab": None}, md5s)
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_convert_set_to_tar_and_zip(self):
+        """
+        The files of a MSZIP set go straight into tar and zip archives
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        folder1.add_source("docs\\readme.txt", "readme " * 1000, attribs=CFFILE._A_RDONLY)
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=60000, output_dir=output_dir,
+                           compression=CFFOLDER.tcompTYPE_MSZIP)
+        filenames = [os.path.join(output_dir, cab.cab_filename) for cab in manager.cab_set]
+        expected = Utils.get_hashes_of_files(folder1.filename_list[:2])
+        expected["docs/readme.txt"] = hashlib.md5("readme " * 1000).hexdigest()
+        date_time = CabReader(filenames[0]).cffile_list[0].get_date_time()
+
+        output = io.BytesIO()
+        CabConverter(workers=2, buffer_blocks=2).to_tar(filenames, output, mode="w|gz")
+        output.seek(0)
+        hashes = {}
+        with tarfile.open(fileobj=output, mode="r|gz") as tar_file:
+            for tar_info in tar_file:
+                hashes[tar_info.name] = hashlib.md5(tar_file.extractfile(tar_info).read()).hexdigest()
+                if tar_info.name == "docs/readme.txt":
+                    self.assertEquals(0444, tar_info.mode)
+        self.assertEquals(expected, hashes)
+
+        output = io.BytesIO()
+        CabConverter().to_zip(filenames, output)
+        with zipfile.ZipFile(output) as zip_file:
+            self.assertEquals(None, zip_file.testzip())
+            self.assertEquals(expected, dict([(zip_info.filename, hashlib.md5(zip_file.read(zip_info)).hexdigest())
+                                              for zip_info in zip_file.infolist()]))
+            self.assertEquals(date_time, zip_file.getinfo("pe101.jpg").date_time)
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_convert_big_and_empty_members_to_zip(self):
+        """
+        A member read in many chunks and an empty member, with and without compression
+        """
+        output_dir = tempfile.mkdtemp()
+        big = "".join([hashlib.md5(str(i)).digest() for i in range(0x3001)])
+        folder1 = CABFolderUnit(name="folder1")
+        folder1.add_source("big.bin", big)
+        folder1.add_source("empty.txt", "")
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024, output_dir=output_dir,
+                           compression=CFFOLDER.tcompTYPE_MSZIP)
+        self.assertTrue(len(big) > 3 * 0x10000)
+
+        for compression in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            output = os.path.join(output_dir, "out.zip")
+            CabConverter().to_zip(os.path.join(output_dir, "my_cab_0.cab"), output, compression=compression)
+            with zipfile.ZipFile(output) as zip_file:
+                self.assertEquals(None, zip_file.testzip())
+                self.assertEquals(["big.bin", "empty.txt"], zip_file.namelist())
+                self.assertEquals(big, zip_file.read("big.bin"))
+                self.assertEquals("", zip_file.read("empty.txt"))
+                for zip_info in zip_file.infolist():
+                    self.assertEquals(compression, zip_info.compress_type)
+                    self.assertEquals(zlib.crc32(zip_file.read(zip_info)) & 0xffffffff, zip_info.CRC)
+                self.assertEquals(len(big), zip_file.getinfo("big.bin").file_size)
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_open_member_seekable(self):
+        """
+        Random access to the members of a MSZIP cabinet, a zip inside it is read in place
+        """
+        output_dir = tempfile.mkdtemp()
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("readme.txt", "readme " * 1000)
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder1.add_source("archive.zip", archive.getvalue())
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           output_dir=output_dir, cfdata_size=0x400, compression=CFFOLDER.tcompTYPE_MSZIP)
+
+        cab = CabReader(os.path.join(output_dir, "my_cab_0.cab"), load_data=False)
+        with open(r"./TestsFiles/pe101.jpg", "rb") as f:
+            expected = f.read()
+        with cab.open_member("pe101.jpg") as member:
+            self.assertTrue(member.seekable())
+            self.assertEquals(len(expected), member.seek(0, io.SEEK_END))
+            for position in (100000, 5, 0x400 * 40 - 3, 140000, 0x400 * 33):
+                member.seek(position)
+                self.assertEquals(expected[position:position+0x500], member.read(0x500))
+                self.assertEquals(position + len(expected[position:position+0x500]), member.tell())
+            member.seek(-10, io.SEEK_END)
+            self.assertEquals(expected[-10:], member.read())
+            member.seek(0)
+            self.assertEquals(expected, io.BufferedReader(member).read())
+
+        with zipfile.ZipFile(cab.open_member("archive.zip")) as zip_file:
+            self.assertEquals("readme " * 1000, zip_file.read("readme.txt"))
+        self.assertRaises(CABException, cab.open_member, "missing.txt")
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_concurrent_reads_with_positional_io(self):
+        """
+        Many threads read the members of the same cabinet without handles of their own
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        folder2 = CABFolderUnit(name="folder2")
+        folder2.add_source("a.txt", "a" * 100000)
+        folder2.compression = CFFOLDER.tcompTYPE_MSZIP
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           output_dir=output_dir, cfdata_size=0x1000)
+        expected = dict([(os.path.basename(filename), md5) for filename, md5 in
+                         Utils.get_hashes_of_files(folder1.filename_list).items()])
+        expected["a.txt"] = hashlib.md5("a" * 100000).hexdigest()
+
+        cab = CabReader(os.path.join(output_dir, "my_cab_0.cab"), load_data=False, positional_io=True)
+        results = []
+
+        def read(name):
+            with cab.open_member(name) as member:
+                results.append((name, hashlib.md5(member.read()).hexdigest()))
+            results.append((name, hashlib.md5(cab.read_member(name)).hexdigest()))
+
+        threads = [threading.Thread(target=read, args=(name,)) for name in sorted(expected) * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(threads) * 2, len(results))
+        for name, md5 in results:
+            self.assertEquals(expected[name], md5)
+        self.assertTrue(all([cfdata.loader is not None for cfdata in cab.cfdata_list]))
+        # Cleanup
+        cab.close()
+        shutil.rmtree(output_dir)
+
+    def test_read_with_cab_pool(self):
+        """
+        The reads of a CabPool return futures at once and are decoded in its threads
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                               r"./TestsFiles/super_saiyajin.jpg"])
+        folder2 = CABFolderUnit(name="folder2")
+        folder2.add_source("a.txt", "a" * 100000)
+        folder2.add_source("b.txt", "".join([hashlib.md5(str(i)).hexdigest() for i in range(5000)]))
+        folder2.compression = CFFOLDER.tcompTYPE_MSZIP
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           output_dir=output_dir, cfdata_size=0x1000)
+        expected = dict([(os.path.basename(filename), md5) for filename, md5 in
+                         Utils.get_hashes_of_files(folder1.filename_list).items()])
+        expected["a.txt"] = hashlib.md5("a" * 100000).hexdigest()
+        expected["b.txt"] = hashlib.md5("".join([hashlib.md5(str(i)).hexdigest() for i in range(5000)])).hexdigest()
+
+        with CabPool(workers=4, chunk_blocks=2) as pool:
+            cab = pool.open(os.path.join(output_dir, "my_cab_0.cab")).result(timeout=30)
+            members = pool.read_members(cab)
+            self.assertEquals(sorted(expected), sorted([cffile.szName[:-1] for cffile, future in members]))
+            names = dict([(future, cffile.szName[:-1]) for cffile, future in members])
+            results = [(names[future], hashlib.md5(future.result()).hexdigest())
+                       for future in as_completed(names, timeout=30)]
+            self.assertEquals(sorted(expected.items()), sorted(results))
+
+            self.assertEquals(expected["b.txt"], hashlib.md5(pool.read_member(cab, "b.txt").result(timeout=30)).hexdigest())
+            self.assertRaises(CABException, pool.read_member(cab, "missing.txt").result)
+            future = pool.submit(int, "folder")
+            self.assertTrue(isinstance(future.exception(timeout=30), ValueError))
+
+            extract_dir = os.path.join(output_dir, "extraction")
+            paths = pool.extract_to_directory(os.path.join(output_dir, "my_cab_0.cab"), extract_dir,
+                                              include=["*.txt"]).result(timeout=30)
+            self.assertEquals(["a.txt", "b.txt"], sorted([os.path.relpath(path, extract_dir) for path in paths]))
+            # Reads still pending are completed before the threads stop
+            pending = pool.read_member(cab, "a.txt")
+        self.assertTrue(pending.done())
+        self.assertEquals(expected["a.txt"], hashlib.md5(pending.result()).hexdigest())
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_extract_to_directory_in_parallel(self):
+        """
+        The folders of a set are decoded by worker processes straight into the output files
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder2 = CABFolderUnit(name="folder2", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        folder2.add_source("docs\\readme.txt", "readme " * 10000)
+        folder2.add_source("empty.txt", "")
+        folder2.compression = CFFOLDER.tcompTYPE_MSZIP
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=100000,
+                           output_dir=output_dir, cfdata_size=0x1000)
+        self.assertTrue(len(manager.cab_set.cab_files) > 1)
+        expected = dict([(os.path.basename(filename), md5) for filename, md5 in
+                         Utils.get_hashes_of_files(folder1.filename_list + folder2.filename_list[:1]).items()])
+        expected[os.path.join("docs", "readme.txt")] = hashlib.md5("readme " * 10000).hexdigest()
+        expected["empty.txt"] = hashlib.md5("").hexdigest()
+
+        extract_dir = os.path.join(output_dir, "extraction")
+        paths = CabExtractor(workers=2).extract_to_directory(os.path.join(output_dir, "my_cab_0.cab"), extract_dir)
+        self.assertEquals(sorted(expected), sorted([os.path.relpath(path, extract_dir) for path in paths]))
+        for path in paths:
+            with open(path, "rb") as f:
+                self.assertEquals(expected[os.path.relpath(path, extract_dir)], hashlib.md5(f.read()).hexdigest())
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_extract_to_directory_with_filters(self):
+        """
+        Only the wanted files are written and only the CFDATA holding them are read
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg"])
+        folder1.add_source("drivers\\net.inf", "[Version]\r\n" * 100)
+        folder1.add_source("drivers\\net.sys", "MZ" + "\x00" * 0x3000)
+        folder1.add_source("drivers\\old\\net.sys", "MZ" + "\x01" * 0x3000)
+        folder2 = CABFolderUnit(name="folder2", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+        folder2.compression = CFFOLDER.tcompTYPE_MSZIP
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                           output_dir=output_dir, cfdata_size=0x1000)
+        filename = os.path.join(output_dir, "my_cab_0.cab")
+
+        extractor = CabExtractor()
+        extract_dir = os.path.join(output_dir, "extraction")
+        paths = extractor.extract_to_directory(filename, extract_dir, include=["*.INF", "*.sys"],
+                                               exclude=re.compile(r"\\old\\"))
+        self.assertEquals([os.path.join(extract_dir, "drivers", "net.inf"),
+                           os.path.join(extract_dir, "drivers", "net.sys")], paths)
+        with open(paths[1], "rb") as f:
+            self.assertEquals("MZ" + "\x00" * 0x3000, f.read())
+        self.assertEquals(5, extractor.read_blocks)
+        self.assertEquals(["drivers"], os.listdir(extract_dir))
+
+        shutil.rmtree(extract_dir)
+        paths = extractor.extract_to_directory(filename, extract_dir, predicate=lambda cffile: cffile.cbFile > 100000)
+        self.assertEquals([os.path.join(extract_dir, "pe101.jpg")], paths)
+        self.assertEquals(Utils.get_hashes_of_files(folder1.filename_list[:1]), Utils.get_hashes_of_files(paths))
+
+        # Not even the CFDATA headers of the second folder are read
+        shutil.rmtree(extract_dir)
+        with open(filename, "r+b") as f:
+            f.truncate(CabReader.probe(filename, tables=True).cffolder_list[1].coffCabStart + 2)
+        paths = extractor.extract_to_directory(filename, extract_dir, include=["*.inf"])
+        self.assertEquals([os.path.join(extract_dir, "drivers", "net.inf")], paths)
+        with open(paths[0], "rb") as f:
+            self.assertEquals("[Version]\r\n" * 100, f.read())
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_write_rolls_over_at_the_limits(self):
+        """
+        New folders and cabs are started before cFiles, cFolders or cCFData overflow
+        (the limits are lowered here, the real ones need 65535 files)
+        """
+        output_dir = tempfile.mkdtemp()
+        limits = CABFile.MAX_FILES, CABFile.MAX_FOLDERS, CABFile.MAX_CFDATA
+        CABFile.MAX_FILES, CABFile.MAX_FOLDERS, CABFile.MAX_CFDATA = 3, 4, 10
+        try:
+            folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/pe101.jpg",
+                                                                   r"./TestsFiles/super_saiyajin.jpg"])
+            for i in range(6):
+                folder1.add_source("file_%d.txt" % i, str(i) * 5000)
+            manager = CABManager()
+            manager.create_cab(cab_folders=[folder1], cab_name="my_cab_[x].cab", cab_size=1474*1024*16,
+                               output_dir=output_dir, cfdata_size=0x1000)
+        finally:
+            CABFile.MAX_FILES, CABFile.MAX_FOLDERS, CABFile.MAX_CFDATA = limits
+
+        filenames = [os.path.join(output_dir, cab.cab_filename) for cab in manager.cab_set]
+        self.assertTrue(len(filenames) > 1)
+        for filename in filenames:
+            cab = CabReader(filename)
+            self.assertTrue(cab.cfheader.cFiles <= 3)
+            self.assertTrue(cab.cfheader.cFolders <= 4)
+            self.assertTrue(all([cffolder.cCFData <= 10 for cffolder in cab.cffolder_list]))
+        self.assertEquals([], CabValidator(deep=True).check_set(filenames))
+
+        expected = Utils.get_hashes_of_files(folder1.filename_list[:2])
+        for i in range(6):
+            expected["file_%d.txt" % i] = hashlib.md5(str(i) * 5000).hexdigest()
+        paths = CabExtractor().extract_to_directory(filenames[0], os.path.join(output_dir, "extraction"))
+        self.assertEquals(expected, Utils.get_hashes_of_files(paths))
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_write_thousands_of_files(self):
+        """
+        The offsets add_file keeps as it goes are the ones of a full update_fields
+        """
+        output_dir = tempfile.mkdtemp()
+        folder1 = CABFolderUnit(name="folder1")
+        folder2 = CABFolderUnit(name="folder2")
+        for i in range(4000):
+            (folder1 if i % 2 else folder2).add_source("file_%d.txt" % i, str(i) * (i % 13 + 1))
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder1, folder2], cab_name="my_cab_[x].cab", cab_size=20000,
+                           folder_size=8000, cfdata_size=0x400)
+        self.assertTrue(len(manager.cab_set.cab_files) > 1)
+
+        for cab_file in manager.cab_set:
+            fields = (cab_file.cfheader.cbCabinet, cab_file.cfheader.coffFiles,
+                      [cffile.uoffFolderStart for cffile in cab_file.cffile_list])
+            cab_file.update_fields()
+            self.assertEquals((cab_file.cfheader.cbCabinet, cab_file.cfheader.coffFiles,
+                               [cffile.uoffFolderStart for cffile in cab_file.cffile_list]), fields)
+        manager.flush_cabset_to_disk(output_dir=output_dir)
+
+        filenames = [os.path.join(output_dir, cab.cab_filename) for cab in manager.cab_set]
+        self.assertEquals([], CabValidator().check_set(filenames))
+        paths = CabExtractor().extract_to_directory(filenames[0], os.path.join(output_dir, "extraction"))
+        self.assertEquals(4000, len(paths))
+        with open(os.path.join(output_dir, "extraction", "file_3999.txt"), "rb") as f:
+            self.assertEquals("3999" * 9, f.read())
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_create_cabs_in_parallel(self):
+        """
+        Many independent sets are written by a pool of processes, a failing spec doesn't stop the rest
+        """
+        output_dir = tempfile.mkdtemp()
+        specs = []
+        for i in range(4):
+            folder1 = CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/super_saiyajin.jpg"])
+            folder1.add_source("customer.txt", "customer %d\n" % i * 1000)
+            specs.append({"cab_folders": [folder1], "cab_name": "customer_%d_[x].cab" % i, "output_dir": output_dir,
+                          "cab_size": 20000})
+        specs.insert(2, {"cab_folders": [CABFolderUnit(name="folder1", filename_list=[r"./TestsFiles/missing.jpg"])],
+                         "cab_name": "broken_[x].cab", "output_dir": output_dir})
+
+        class Unloadable(object):
+            """
+            A worker can't load it
+            """
+            def __init__(self, error):
+                self.error = error
+            def __reduce__(self):
+                return self.error
+        # The worker fails before building the set, or it dies
+        specs.append({"cab_folders": Unloadable((int, ("folder",))), "cab_name": "unloadable_[x].cab",
+                      "output_dir": output_dir})
+        specs.append({"cab_folders": Unloadable((os._exit, (1,))), "cab_name": "dead_[x].cab",
+                      "output_dir": output_dir})
+        # The same cab_name into the same output_dir
+        specs.append(dict(specs[0], output_dir=os.path.join(output_dir, ".")))
+
+        results = CABManager().create_cabs(iter(specs), workers=2, max_pending=2, timeout=5)
+        self.assertEquals(["customer_0_[x].cab", "customer_1_[x].cab", "broken_[x].cab", "customer_2_[x].cab",
+                           "customer_3_[x].cab", "unloadable_[x].cab", "dead_[x].cab", "customer_0_[x].cab"],
+                          [result["cab_name"] for result in results])
+        self.assertEquals([], results[2]["filenames"])
+        self.assertTrue("missing.jpg" in results[2]["error"])
+        self.assertTrue("invalid literal" in results[5]["error"])
+        self.assertTrue("5 seconds" in results[6]["error"])
+        self.assertTrue("Another spec" in results[7]["error"])
+        self.assertEquals([[], [], []], [result["filenames"] for result in results[5:]])
+        results = results[:5]
+
+        expected = Utils.get_hashes_of_files([r"./TestsFiles/super_saiyajin.jpg"])
+        for i, result in enumerate(results[:2] + results[3:]):
+            self.assertEquals(None, result["error"])
+            self.assertTrue(len(result["filenames"]) > 1)
+            paths = CabExtractor().extract_to_directory(result["filenames"][0], os.path.join(output_dir, str(i)))
+            expected["customer.txt"] = hashlib.md5("customer %d\n" % i * 1000).hexdigest()
+            self.assertEquals(expected, Utils.get_hashes_of_files(paths))
+        # Cleanup
+        shutil.rmtree(output_dir)
+
+    def test_write_directory_tree(self):
+        """
+        The files of a tree keep their relative paths, dates and attributes
+        """
+        output_dir = tempfile.mkdtemp()
+        tree_dir = os.path.join(output_dir, "tree")
+        os.makedirs(os.path.join(tree_dir, "images", "big"))
+        os.makedirs(os.path.join(tree_dir, "docs"))
+        shutil.copy(r"./TestsFiles/pe101.jpg", os.path.join(tree_dir, "images", "big"))
+        shutil.copy(r"./TestsFiles/super_saiyajin.jpg", os.path.join(tree_dir, "images"))
+        with open(os.path.join(tree_dir, "docs", "readme.txt"), "wb") as f:
+            f.write("readme " * 10000)
+        with open(os.path.join(tree_dir, "empty.txt"), "wb") as f:
+            pass
+        os.chmod(os.path.join(tree_dir, "docs", "readme.txt"), 0444)
+        os.utime(os.path.join(tree_dir, "empty.txt"), (0, 1262347200))
+
+        folder_unit = CabTreeBuilder(tree_dir).build(name="tree", compression=CFFOLDER.tcompTYPE_MSZIP)
+        self.assertEquals(["empty.txt", "docs\\readme.txt", "images\\super_saiyajin.jpg", "images\\big\\pe101.jpg"],
+                          [source.name for source in folder_unit.filename_list])
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder_unit], cab_name="my_cab_[x].cab", cab_size=100000,
+                           output_dir=output_dir, cfdata_size=0x1000)
+        self.assertTrue(len(manager.cab_set.cab_files) > 1)
+
+        reader = CabReader(os.path.join(output_dir, "my_cab_0.cab"))
+        cffile_list = dict([(cffile.szName[:-1], cffile) for cffile in reader.cffile_list])
+        self.assertEquals((2010, 1, 1), cffile_list["empty.txt"].get_date_time()[:3])
+        self.assertTrue(cffile_list["docs\\readme.txt"].attribs & CFFILE._A_RDONLY)
+        self.assertFalse(cffile_list["empty.txt"].attribs & CFFILE._A_RDONLY)
+
+        extract_dir = os.path.join(output_dir, "extraction")
+        paths = CabExtractor().extract_to_directory(os.path.join(output_dir, "my_cab_0.cab"), extract_dir)
+        self.assertEquals(4, len(paths))
+        for path in paths:
+            with open(path, "rb") as f, open(os.path.join(tree_dir, os.path.relpath(path, extract_dir)), "rb") as g:
+                self.assertEquals(hashlib.md5(g.read()).hexdigest(), hashlib.md5(f.read()).hexdigest())
+        # Cleanup
+        os.chmod(os.path.join(tree_dir, "docs", "readme.txt"), 0644)
+        shutil.rmtree(output_dir)
+
+    def test_write_tree_with_thousands_of_files(self):
+        """
+        A tree of thousands of files, and directories that go away while the tree is walked
+        """
+        output_dir = tempfile.mkdtemp()
+        tree_dir = os.path.join(output_dir, "tree")
+        for i in range(40):
+            os.makedirs(os.path.join(tree_dir, "dir_%02d" % i))
+            for j in range(100):
+                with open(os.path.join(tree_dir, "dir_%02d" % i, "file_%02d.txt" % j), "wb") as f:
+                    f.write("%d %d\n" % (i, j) * j)
+
+        folder_unit = CabTreeBuilder(tree_dir).build(name="tree", compression=CFFOLDER.tcompTYPE_MSZIP)
+        self.assertEquals(4000, len(folder_unit.filename_list))
+        manager = CABManager()
+        manager.create_cab(cab_folders=[folder_unit], cab_name="my_cab_[x].cab", cab_size=200000,
+                           output_dir=output_dir, cfdata_size=0x1000)
+        self.assertTrue(len(manager.cab_set.cab_files) > 1)
+        extract_dir = os.path.join(output_dir, "extraction")
+        paths = CabExtractor().extract_to_directory(os.path.join(output_dir, "my_cab_0.cab"), extract_dir)
+        self.assertEquals(4000, len(paths))
+        for path in paths:
+            with open(path, "rb") as f, open(os.path.join(tree_dir, os.path.relpath(path, extract_dir)), "rb") as g:
+                self.assertEquals(g.read(), f.read())
+
+        # dir_01 goes away once the files of dir_00 are listed
+        for skip_errors in (False, True):
+            builder = CabTreeBuilder(tree_dir, skip_errors=skip_errors)
+            sources = builder.iter_sources()
+            self.assertEquals("dir_00\\file_00.txt", next(sources).name)
+            shutil.rmtree(os.path.join(tree_dir, "dir_%02d" % (1 + skip_errors)))
+            if not skip_errors:
+                self.assertRaises(CABException, list, sources)
+                continue
+            self.assertEquals(3799, len(list(sources)))
+            self.assertEquals([os.path.join(tree_dir, "dir_02")], [path for path, message in builder.errors])
+        # Cleanup
+        shutil.rmtree(output_dir)
+
 def ReadCabinet():
     manager = CABManager()
     cab = manager.read_cab("my_cab_0.cab")
@@ -5,6 +5,7 @@ import random
 import datetime
 
 from pycab.CabStructs import CFHEADER, CFFOLDER, CFFILE, CFDATA
+from pycab.CabReader import CabReader
 
 
 class StructsTestCase(unittest.TestCase):
@@ -157,6 +158,41 @@ class StructsTestCase(unittest.TestCase):
         self.assertEquals(20, len(cfdata.abReserve))
         self.assertEquals(len(cfdata), len(repr(cfdata)))
 
+    def test_pack_into(self):
+        """
+        The entries packed in place are the same as their repr
+        """
+        reserve = {'cbCFHeader': 4,  'cbCFFolder': 2, 'cbCFData': 0}
+        cfheader = CFHEADER(flags=CFHEADER.cfhdrRESERVE_PRESENT | CFHEADER.cfhdrNEXT_CABINET, reserve=reserve)
+        cfheader.szCabinetNext = "next.cab\x00"
+        cfheader.szDiskNext = "disk\x00"
+        cfheader.cbCabinet = 0x12345678
+        cffolder = CFFOLDER(cfheader=cfheader)
+        cffolder.cCFData = 3
+        cffile = CFFILE(cffolder=cffolder, total_len=0x1000, filename="trav.txt\x00")
+        self.assertEquals(cfheader.get_packed_size(), len(repr(cfheader)))
+        self.assertEquals(len(cfheader), len(repr(cfheader)))
+
+        buffer = bytearray(2 + cfheader.get_packed_size() + len(cffolder) + len(cffile))
+        offset = cfheader.pack_into(buffer, 2)
+        offset = cffolder.pack_into(buffer, offset)
+        self.assertEquals(len(buffer), cffile.pack_into(buffer, offset))
+        self.assertEquals("\x00\x00MSCF", str(buffer[:6]))
+        self.assertEquals(repr(cfheader) + repr(cffolder) + repr(cffile), str(buffer[2:]))
+
+    def test_get_folder_blocks(self):
+        """
+        A CFDATA split between two cabinets is one block with the pieces of both
+        """
+        first_cab, second_cab = object(), object()
+        cfdata_list = [CFDATA(data="a" * 10), CFDATA(data="b" * 4), CFDATA(data="c" * 6), CFDATA(data="d")]
+        cfdata_list[1].cbUncomp = 0
+        blocks = [(first_cab, cfdata_list[0]), (first_cab, cfdata_list[1]),
+                  (second_cab, cfdata_list[2]), (second_cab, cfdata_list[3])]
+        self.assertEquals([([blocks[0]], 10), (blocks[1:3], 6), ([blocks[3]], 1)], CabReader.get_folder_blocks(blocks))
+        self.assertEquals(len(cfdata_list[0].get_header()), cfdata_list[0].get_data_offset())
+
+
 
 if __name__ == "__main__":
     unittest.main()